@@ -1,4 +1,11 @@
+import os
 import socket
+import sys
+
+# Length-prefixed framing so every read returns one whole message,
+# shared with the later phases in phase_4/src/protocol.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "phase_4", "src"))
+from protocol import FrameDecoder, send_message, recv_message
 
 # Create a TCP/IP socket
 client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -6,10 +13,13 @@ client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 # Connect to the server (use the correct server IP address)
 client_socket.connect((socket.gethostbyname(socket.gethostname()), 12345))
 
+# Cuts the data coming from the server back into whole messages
+decoder = FrameDecoder()
+
 while True:
     #clients message
     message = input("message: ")
-    client_socket.send(message.encode("utf-8"))
+    send_message(client_socket, message)
 
     # /exit for leaving the server
     if message.lower() == "/exit":
@@ -17,5 +27,5 @@ while True:
         break
 
     # Receive message from the server
-    sent_message = client_socket.recv(1024).decode("utf-8")
+    sent_message = recv_message(client_socket, decoder)
     print("\n\t",sent_message,"\n",sep="")
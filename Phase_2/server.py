@@ -1,6 +1,13 @@
+import os
 import socket
+import sys
 import threading
 
+# Length-prefixed framing so every read returns one whole message,
+# shared with the later phases in phase_4/src/protocol.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "phase_4", "src"))
+from protocol import FrameDecoder, send_message, recv_message
+
 # Create a TCP/IP socket
 server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
@@ -21,21 +28,24 @@ def handle_client(client_socket, client_address):
     print(f"{client_address} connected to the server")
     clients.append(client_socket)
 
+    # Cuts the byte stream from this client back into whole messages
+    decoder = FrameDecoder()
+
     while True:
         #try except for any possible errors
         try:
             #receive the message and show it on server side
-            message = client_socket.recv(1024).decode("utf-8")
+            message = recv_message(client_socket, decoder)
 
-            #/exit for leaving the server
-            if message.lower() == "/exit":
+            #/exit (or a closed connection) for leaving the server
+            if message is None or message.lower() == "/exit":
                 break
 
             print(f"{client_address}: {message}")
 
             # Send clients message back to himself
             clients_message = f"You sent ({message})"
-            client_socket.send(clients_message.encode("utf-8"))
+            send_message(client_socket, clients_message)
 
         except:
             break
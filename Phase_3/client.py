@@ -1,19 +1,29 @@
+import os
 import socket
+import sys
 import threading
 
+#length-prefixed framing so every read returns one whole message,
+#shared with the later phases in phase_4/src/protocol.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "phase_4", "src"))
+from protocol import FrameDecoder, send_message as send_frame, recv_message
+
 #creating the server socket IPV4 (AF_INET) and TCP (SOCK_STREAM)
 client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
 #connecting to the server with specified ip address (your computer ip) and port number
 client_socket.connect((socket.gethostbyname(socket.gethostname()), 12345))
 
+#cuts the data coming from the server back into whole messages
+decoder = FrameDecoder()
+
 
 def get_username():
-    message = client_socket.recv(1024).decode("utf-8")
+    message = recv_message(client_socket, decoder)
     if message == "username":
         print("please enter your username: ", end="")
         name = input()
-        client_socket.send(name.encode("utf-8"))
+        send_frame(client_socket, name)
         return 0
 
 
@@ -26,7 +36,7 @@ def send_message():
         if message == "/exit":
             client_socket.close()
             break
-        client_socket.send(message.encode("utf-8"))
+        send_frame(client_socket, message)
 
 
 def receive_message():
@@ -34,8 +44,10 @@ def receive_message():
     while True:
         #we need a try except so that our program doesn't crash
         try:
-            # receiving information from the server (buffer size is 1024)
-            message = client_socket.recv(1024).decode("utf-8")
+            # receiving the next whole message from the server
+            message = recv_message(client_socket, decoder)
+            if message is None:
+                raise ConnectionError
             print(message)
         #if there was an error
         except:
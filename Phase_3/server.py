@@ -1,6 +1,13 @@
+import os
 import socket
+import sys
 import threading
 
+#length-prefixed framing so every read returns one whole message,
+#shared with the later phases in phase_4/src/protocol.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "phase_4", "src"))
+from protocol import FrameDecoder, encode_message, send_message, recv_message
+
 #creating the server socket IPV4 (AF_INET) and TCP (SOCK_STREAM)
 server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
@@ -17,10 +24,10 @@ clients = dict()
 def broadcast(message):
     """show the messages for everyone"""
     for client in clients.keys():
-        client.send(message)
+        client.sendall(message)
 
 
-def receive_message(client_socket):
+def receive_message(client_socket, decoder):
     """receive message from client"""
 
     while True:
@@ -28,10 +35,10 @@ def receive_message(client_socket):
         # we need a try except so that our program doesn't crash
         try:
             #receive the message from the client
-            message = client_socket.recv(1024).decode("utf-8")
-            if message.lower() == "/exit":
+            message = recv_message(client_socket, decoder)
+            if message is None or message.lower() == "/exit":
                 raise Exception
-            message = f"\033[1;34m\n\t{clients[client_socket]} ({address}): {message}\n\033[0m".encode("utf-8")
+            message = encode_message(f"\033[1;34m\n\t{clients[client_socket]} ({address}): {message}\n\033[0m")
             #show the message to everyone
             broadcast(message)
         except:
@@ -42,7 +49,7 @@ def receive_message(client_socket):
             #close the connection for the client
             client_socket.close()
             #let others know that the client left the server
-            broadcast(f"\033[1;31m\n\t{name} ({address}) has left the server!\n\033[0m".encode("utf-8"))
+            broadcast(encode_message(f"\033[1;31m\n\t{name} ({address}) has left the server!\n\033[0m"))
             print(f"{name} ({address}) has left the server.")
             print("*" * 30)
             break
@@ -57,22 +64,25 @@ def connect_client():
         print(f"{client_address} has connected.")
         print("*" * 30)
 
+        #every client gets its own decoder (it keeps bytes that arrive after the name)
+        decoder = FrameDecoder()
+
         try:
 
             #request for client name
-            client_socket.send(f"username".encode('utf-8'))
-            client_name = client_socket.recv(1024).decode('utf-8')
+            send_message(client_socket, "username")
+            client_name = recv_message(client_socket, decoder)
 
             #adding the client to dictionary
-            if len(client_name) != 0:
+            if client_name:
 
                 clients.update({client_socket: client_name})
                 print(f"client: {clients[client_socket]} {str(client_socket)[-27:-1]}")
                 print("*" * 30)
 
                 #informing the client
-                client_socket.send(f"\nwelcome {clients[client_socket]}, you are connected to the server.\n".encode('utf-8'))
-                broadcast(f"\033[1;92m\n{clients[client_socket]} has joined the server.\n\033[0m".encode("utf-8"))
+                send_message(client_socket, f"\nwelcome {clients[client_socket]}, you are connected to the server.\n")
+                broadcast(encode_message(f"\033[1;92m\n{clients[client_socket]} has joined the server.\n\033[0m"))
             else:
                 raise Exception
 
@@ -83,7 +93,7 @@ def connect_client():
             continue
 
         #when a client connects to the server stat a thread
-        receive_thread = threading.Thread(target=receive_message, args=(client_socket,))
+        receive_thread = threading.Thread(target=receive_message, args=(client_socket, decoder))
         receive_thread.start()
 
 
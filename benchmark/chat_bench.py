@@ -0,0 +1,365 @@
+# Load generator and benchmark for the chat servers.
+#
+# Starts a server (phase_4 or Phase_3) on this machine, connects many
+# simulated clients that do the real handshake, sends messages at a fixed
+# rate (optionally mixed with /pm) and measures:
+#   - messages sent and delivered per second
+#   - end-to-end latency (p50 / p99 / p999) from send to every delivery
+#   - CPU use and memory (RSS) of the server process
+# The results are printed and saved as JSON so runs on different commits can
+# be compared with --compare.
+#
+# Example:
+#   python chat_bench.py --target phase4 --clients 2000 --rate 500 --duration 20 --output run.json
+#   python chat_bench.py --target phase4 --server-args "--mode selectors" --compare run.json
+
+import argparse
+import json
+import os
+import random
+import re
+import selectors
+import shlex
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "phase_4", "src"))
+
+from protocol import (FrameDecoder, MSG_SAY, encode_message, encode_record, encode_pm_to,  # noqa: E402
+                      send_message, recv_message)
+
+# psutil gives CPU and memory numbers on every platform, /proc is the fallback on Linux
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# The resource module only exists on Unix-like systems
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Where each server lives and how it is started
+TARGETS = {
+    "phase4": {"dir": os.path.join(ROOT, "phase_4", "src"), "script": "server.py", "pm": True},
+    "phase3": {"dir": os.path.join(ROOT, "Phase_3"), "script": "server.py", "pm": False},
+}
+
+# Every benchmark message carries "~b <sender> <seq> <send time in ns>~"
+MARKER = re.compile(r"~b (\d+) (\d+) (\d+)~")
+
+
+class BenchClient:
+    """One simulated client: a non-blocking socket, a decoder and unsent bytes."""
+    __slots__ = ("index", "name", "sock", "decoder", "outbound")
+
+    def __init__(self, index, sock):
+        self.index = index
+        self.name = f"bench{index}"
+        self.sock = sock
+        self.decoder = FrameDecoder()
+        self.outbound = bytearray()
+
+
+def server_host():
+    """The servers bind the address their hostname resolves to."""
+    return socket.gethostbyname(socket.gethostname())
+
+
+def raise_file_limit():
+    """Thousands of clients need thousands of file descriptors."""
+    if resource is None:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        pass
+
+
+def start_server(target, server_args, port):
+    """Launch the server as a child process and wait until it accepts connections."""
+    info = TARGETS[target]
+    command = [sys.executable, info["script"]] + shlex.split(server_args)
+    if target == "phase4" and "--port" not in server_args:
+        command += ["--port", str(port)]
+    # The load is meant to reach the server, turn the rate limits off unless asked for
+    if target == "phase4":
+        for option in ("--user-rate", "--room-rate"):
+            if option not in server_args:
+                command += [option, "0"]
+        # Nor should every benchmark message end up in the default history file
+        if "--history" not in server_args and "--no-history" not in server_args:
+            command.append("--no-history")
+    process = subprocess.Popen(command, cwd=info["dir"], stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with code {process.returncode}")
+        try:
+            socket.create_connection((server_host(), port), timeout=0.5).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("server did not start listening in time")
+
+
+class ProcessStats:
+    """CPU time and memory of the server process (None where we can't measure them)."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.process = psutil.Process(pid) if psutil is not None else None
+
+    def cpu_seconds(self):
+        if self.process is not None:
+            times = self.process.cpu_times()
+            return times.user + times.system
+        try:
+            with open(f"/proc/{self.pid}/stat") as stat:
+                fields = stat.read().rsplit(")", 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        except (OSError, ValueError, AttributeError):
+            return None
+
+    def rss_bytes(self):
+        if self.process is not None:
+            return self.process.memory_info().rss
+        try:
+            with open(f"/proc/{self.pid}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+
+def connect_clients(target, host, port, count, binary=False, compress=False):
+    """Open `count` clients and do the handshake of the target's protocol."""
+    clients = []
+    colors = ("black", "red", "green", "blue")
+    for index in range(count):
+        sock = socket.create_connection((host, port))
+        client = BenchClient(index, sock)
+        if target == "phase3":
+            # Phase 3 asks for the name first
+            recv_message(sock, client.decoder)
+            send_message(sock, client.name)
+        else:
+            options = ",".join(name for name, wanted in (("binary", binary), ("zlib", compress)) if wanted)
+            handshake = f"{client.name}|{colors[index % len(colors)]}"
+            send_message(sock, f"{handshake}|{options}" if options else handshake)
+        sock.setblocking(False)
+        clients.append(client)
+    return clients
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def run(options):
+    raise_file_limit()
+    host = server_host()
+    process = None
+    if not options.no_launch:
+        process = start_server(options.target, options.server_args, options.port)
+    stats = ProcessStats(options.pid or process.pid) if (process or options.pid) else None
+
+    pm_ratio = options.pm_ratio if TARGETS[options.target]["pm"] else 0.0
+    random_source = random.Random(options.seed)
+    selector = selectors.DefaultSelector()
+    latencies = []
+    counters = {"sent": 0, "sent_pm": 0, "delivered": 0, "bytes_received": 0}
+
+    try:
+        binary = options.binary and options.target == "phase4"
+        compress = options.zlib and options.target == "phase4"
+        clients = connect_clients(options.target, host, options.port, options.clients, binary, compress)
+        for client in clients:
+            selector.register(client.sock, selectors.EVENT_READ, client)
+
+        def flush(client):
+            if client.outbound:
+                try:
+                    sent = client.sock.send(client.outbound)
+                except (BlockingIOError, InterruptedError):
+                    sent = 0
+                del client.outbound[:sent]
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client.outbound else 0)
+            selector.modify(client.sock, events, client)
+
+        def poll(timeout, measuring):
+            for key, events in selector.select(timeout):
+                client = key.data
+                if events & selectors.EVENT_WRITE:
+                    flush(client)
+                if events & selectors.EVENT_READ:
+                    try:
+                        received = client.decoder.recv_from(client.sock)
+                    except (BlockingIOError, InterruptedError):
+                        continue
+                    if not received:
+                        raise RuntimeError(f"server closed the connection of {client.name}")
+                    now = time.perf_counter_ns()
+                    counters["bytes_received"] += received
+                    for message in client.decoder.messages():
+                        match = MARKER.search(message)
+                        if match is None or not measuring:
+                            continue
+                        counters["delivered"] += 1
+                        latencies.append(now - int(match.group(3)))
+
+        # Let join notices settle before measuring
+        warmup_end = time.perf_counter() + options.warmup
+        while time.perf_counter() < warmup_end:
+            poll(0.05, False)
+
+        padding = "x" * max(0, options.message_size - 40)
+        cpu_start = stats.cpu_seconds() if stats else None
+        start = time.perf_counter()
+        end = start + options.duration
+        sequence = 0
+        while True:
+            now = time.perf_counter()
+            if now >= end:
+                break
+            # Send every message that is due by now at the requested rate
+            due = int((now - start) * options.rate) - counters["sent"]
+            for _ in range(due):
+                client = clients[random_source.randrange(len(clients))]
+                sequence += 1
+                text = f"~b {client.index} {sequence} {time.perf_counter_ns()}~ {padding}"
+                if random_source.random() < pm_ratio and len(clients) > 1:
+                    target = clients[random_source.randrange(len(clients))]
+                    counters["sent_pm"] += 1
+                    if binary:
+                        client.outbound += encode_pm_to(target.name, text)
+                    else:
+                        client.outbound += encode_message(f"/pm {target.name} {text}")
+                elif binary:
+                    client.outbound += encode_record(MSG_SAY, text=text)
+                else:
+                    client.outbound += encode_message(text)
+                flush(client)
+                counters["sent"] += 1
+            poll(0.001, True)
+
+        # Collect the messages that are still on their way
+        drain_end = time.perf_counter() + options.drain
+        while time.perf_counter() < drain_end:
+            poll(0.05, True)
+        elapsed = time.perf_counter() - start
+
+        cpu_end = stats.cpu_seconds() if stats else None
+        rss = stats.rss_bytes() if stats else None
+    finally:
+        selector.close()
+        if process is not None:
+            process.kill()
+            process.wait()
+
+    latencies.sort()
+    to_ms = lambda ns: None if ns is None else round(ns / 1e6, 3)
+    return {
+        "target": options.target,
+        "server_args": options.server_args,
+        "binary": binary,
+        "zlib": compress,
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "clients": options.clients,
+        "rate": options.rate,
+        "duration": options.duration,
+        "message_size": options.message_size,
+        "pm_ratio": pm_ratio,
+        "sent": counters["sent"],
+        "sent_pm": counters["sent_pm"],
+        "delivered": counters["delivered"],
+        "sent_per_sec": round(counters["sent"] / options.duration, 1),
+        "delivered_per_sec": round(counters["delivered"] / elapsed, 1),
+        "bytes_received": counters["bytes_received"],
+        "latency_ms": {
+            "p50": to_ms(percentile(latencies, 0.50)),
+            "p99": to_ms(percentile(latencies, 0.99)),
+            "p999": to_ms(percentile(latencies, 0.999)),
+            "max": to_ms(latencies[-1] if latencies else None),
+        },
+        "server_cpu_percent": (None if cpu_start is None or cpu_end is None
+                               else round(100 * (cpu_end - cpu_start) / elapsed, 1)),
+        "server_rss_mb": None if rss is None else round(rss / (1024 * 1024), 1),
+    }
+
+
+def git_commit():
+    """Commit the benchmark ran on, so saved results can be told apart."""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    """Print how the main numbers changed between two runs."""
+    rows = [
+        ("delivered/s", old["delivered_per_sec"], new["delivered_per_sec"]),
+        ("p50 ms", old["latency_ms"]["p50"], new["latency_ms"]["p50"]),
+        ("p99 ms", old["latency_ms"]["p99"], new["latency_ms"]["p99"]),
+        ("p999 ms", old["latency_ms"]["p999"], new["latency_ms"]["p999"]),
+        ("cpu %", old["server_cpu_percent"], new["server_cpu_percent"]),
+        ("rss MB", old["server_rss_mb"], new["server_rss_mb"]),
+    ]
+    print(f"{'':12} {old.get('commit') or 'old':>12} {new.get('commit') or 'new':>12} {'change':>9}")
+    for name, before, after in rows:
+        change = ""
+        if before and after is not None:
+            change = f"{100 * (after - before) / before:+.1f}%"
+        print(f"{name:12} {str(before):>12} {str(after):>12} {change:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the chat servers")
+    parser.add_argument("--target", choices=sorted(TARGETS), default="phase4")
+    parser.add_argument("--server-args", default="", help="extra arguments for server.py")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--no-launch", action="store_true", help="use a server that is already running")
+    parser.add_argument("--pid", type=int, help="pid of an already running server, for CPU/RSS numbers")
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=200, help="messages per second from all clients")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to send for")
+    parser.add_argument("--message-size", type=int, default=64, help="approximate message length")
+    parser.add_argument("--pm-ratio", type=float, default=0.0, help="fraction of messages sent as /pm")
+    parser.add_argument("--binary", action="store_true", help="use the binary wire format (phase4 only)")
+    parser.add_argument("--zlib", action="store_true", help="accept compressed frames (phase4 only)")
+    parser.add_argument("--warmup", type=float, default=1.0)
+    parser.add_argument("--drain", type=float, default=2.0, help="seconds to wait for late messages")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="save the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    options = parser.parse_args()
+
+    results = run(options)
+    print(json.dumps(results, indent=2))
+    if options.output:
+        with open(options.output, "w") as output:
+            json.dump(results, output, indent=2)
+    if options.compare:
+        with open(options.compare) as previous:
+            compare(json.load(previous), results)
+
+
+if __name__ == "__main__":
+    main()
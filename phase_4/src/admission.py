@@ -0,0 +1,100 @@
+# Admission control for new connections.
+#
+# Accepting a connection is cheap, the handshake after it is not: the TLS
+# handshake costs CPU, and a client that connects and then says nothing ties
+# up a thread (threaded mode) or a socket and a buffer (selectors mode). A
+# connection counts as a pending handshake from accept() until its
+# "username|color" greeting has been handled, and:
+#   - a handshake that isn't done within `timeout` seconds is dropped;
+#   - at most `max_handshakes` handshakes may be pending at once;
+#   - at most `max_clients` clients (signed in or still in their handshake)
+#     may be connected.
+# A connection over a limit is answered "busy|<seconds>" at once and closed,
+# telling the client how long to wait before trying again. Accepting it keeps
+# the kernel's listen backlog (--backlog) moving, so clients are turned away
+# quickly instead of timing out in the queue while the server is full.
+
+import threading
+import time
+from collections import OrderedDict
+
+from protocol import BUSY, encode_message
+
+# Seconds a rejected client is asked to wait before trying again
+BUSY_RETRY = 5
+
+
+class Admission:
+    """
+    Pending handshakes and the limits on them. A limit of 0 (or None) is no limit.
+    """
+
+    def __init__(self, timeout=None, max_handshakes=0, max_clients=0, retry=BUSY_RETRY):
+        self.timeout = timeout or None
+        self.max_handshakes = max_handshakes
+        self.max_clients = max_clients
+        self.retry = retry
+        self.lock = threading.Lock()
+        self.pending = OrderedDict()  # Connection -> deadline of its handshake, oldest first
+
+    def __len__(self):
+        return len(self.pending)
+
+    def admit(self, clients):
+        """True if a new connection may start its handshake, `clients` = clients signed in now."""
+        pending = len(self.pending)
+        if self.max_handshakes and pending >= self.max_handshakes:
+            return False
+        if self.max_clients and clients + pending >= self.max_clients:
+            return False
+        return True
+
+    def start(self, connection):
+        """A connection was accepted and starts its handshake. Returns its deadline (None = no timeout)."""
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self.lock:
+            self.pending[connection] = deadline
+        return deadline
+
+    def done(self, connection):
+        """The connection finished (or gave up) its handshake."""
+        with self.lock:
+            self.pending.pop(connection, None)
+
+    def next_deadline(self):
+        """Seconds until the oldest pending handshake times out, None if there is none."""
+        with self.lock:
+            if self.timeout is None or not self.pending:
+                return None
+            deadline = next(iter(self.pending.values()))
+        return max(deadline - time.monotonic(), 0)
+
+    def expired(self, now=None):
+        """Remove and return the connections whose handshake took too long."""
+        if self.timeout is None:
+            return []
+        if now is None:
+            now = time.monotonic()
+        expired = []
+        with self.lock:
+            # Every handshake gets the same timeout, so the deadlines are in order
+            while self.pending:
+                connection, deadline = next(iter(self.pending.items()))
+                if deadline > now:
+                    break
+                del self.pending[connection]
+                expired.append(connection)
+        return expired
+
+    def reject(self, sock, reply=True):
+        """
+        Turn a connection away: answer "busy|<seconds>" (if `reply`, which a TLS client
+        can't read before its handshake) and close it. Never blocks.
+        """
+        if reply:
+            try:
+                sock.setblocking(False)
+                sock.send(encode_message(f"{BUSY}{self.retry:g}"))
+            except OSError:
+                pass  # The client is gone already, or its buffer is full
+        sock.close()
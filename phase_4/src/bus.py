@@ -0,0 +1,478 @@
+# Message bus between server nodes.
+#
+# A "node" is one server process: a worker started with --workers, or a whole
+# server.py instance on another machine behind a load balancer. Clients of one
+# node still have to see room messages from clients of the others, be listed
+# by get_connected_clients() and be reachable with /pm, so the nodes exchange
+# events over a bus:
+#   {"type": "hello"}                               a node joined the bus
+#   {"type": "room", "room": ..., "text": ...}      a message for a room
+#   {"type": "online"/"offline", "name": ..., ...}  presence
+#   {"type": "pm", "to": node, "name": ..., ...}    a /pm for a user on another node
+#   {"type": "mailbox", "to": node, "name": ..., "messages": [...]}
+#                                                   /pm kept for a user while offline
+# Every event carries the id of the node that sent it in "node". Events are
+# delivered to every other node, or only to the node named in "to".
+# A hub started with a shared secret only relays for nodes whose hello carries
+# it in "secret" (taken out before the hello is passed on), and drops the others.
+#
+# Two implementations share the MessageBus interface:
+#   InProcessBus  nodes living in the same process (tests, embedding, see
+#                 ChatServer's `bus` argument)
+#   HubBus        nodes connected over TCP or a Unix socket to a BusHub relay
+#
+# HubBus sends events in batches: whatever was published while the previous
+# write was in progress goes out as one JSON list in one frame (several frames
+# of at most BATCH_SIZE bytes when a lot piled up), and the hub
+# encodes a broadcast batch once and hands the same bytes to every node. More
+# nodes therefore add one write per batch, not one per message.
+
+import argparse
+import hmac
+import json
+import os
+import selectors
+import socket
+import tempfile
+import threading
+from collections import deque
+
+from protocol import FrameDecoder, ProtocolError, MAX_FRAME_SIZE, encode_message
+from outbound import DROP_OLDEST, DISCONNECT
+import log
+
+# A batch longer than this (bytes of JSON) is sent as several frames
+BATCH_SIZE = MAX_FRAME_SIZE
+
+# Largest frame the hub and the nodes accept. Bigger than BATCH_SIZE so one event
+# can travel on its own even when escaping a long chat message into JSON made it grow
+MAX_BUS_FRAME = 8 * MAX_FRAME_SIZE
+
+# Bytes the hub keeps queued for one node, a node that falls further behind is dropped
+NODE_QUEUE_LIMIT = 64 * 1024 * 1024
+
+# Events a node keeps queued for the hub while its writes are stuck
+PENDING_LIMIT = 100000
+
+
+def parse_address(text):
+    """Turn "host:port" into a (host, port) tuple, anything else is a Unix socket path."""
+    host, sep, port = text.rpartition(":")
+    if sep and port.isdigit():
+        return host, int(port)
+    return text
+
+
+def default_bus_address():
+    """A Unix socket path for the workers' hub (or a loopback TCP port where AF_UNIX is missing)."""
+    if hasattr(socket, "AF_UNIX"):
+        return os.path.join(tempfile.gettempdir(), f"chat-bus-{os.getpid()}.sock")
+    return ("127.0.0.1", 0)
+
+
+def listen_bus(address):
+    """Create the hub's listening socket. Returns the socket and its actual address."""
+    if isinstance(address, str):
+        # Remove a socket file left behind by a crashed server
+        if os.path.exists(address):
+            os.unlink(address)
+        hub_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        hub_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        hub_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    hub_socket.bind(address)
+    hub_socket.listen()
+    return hub_socket, hub_socket.getsockname()
+
+
+def encode_batches(events, size=BATCH_SIZE):
+    """
+    Encode a list of events as frames holding at most `size` bytes of JSON each,
+    so a node that fell behind doesn't send the hub one frame too large to read.
+    An event longer than `size` gets a frame of its own.
+    """
+    frames = []
+    parts = []
+    length = 1  # "[", then every event and the "," or "]" after it
+    for event in events:
+        part = json.dumps(event)  # ASCII only, so characters are bytes
+        if parts and length + len(part) + 1 > size:
+            frames.append(encode_message("[" + ",".join(parts) + "]", MAX_BUS_FRAME))
+            parts = []
+            length = 1
+        parts.append(part)
+        length += len(part) + 1
+    if parts:
+        frames.append(encode_message("[" + ",".join(parts) + "]", MAX_BUS_FRAME))
+    return frames
+
+
+class MessageBus:
+    """
+    Interface every bus implementation provides.
+    publish() sends an event to the other nodes. Incoming events are passed to
+    `handler`, either from the event loop (it waits on fileno() and then calls
+    read_ready()) or from a background thread running run().
+    """
+
+    def __init__(self, node_id):
+        self.node_id = node_id
+        self.handler = None
+
+    def publish(self, event):
+        raise NotImplementedError
+
+    def fileno(self):
+        raise NotImplementedError
+
+    def read_ready(self):
+        """Handle the events that have arrived. Returns False once the bus is gone."""
+        raise NotImplementedError
+
+    def run(self):
+        """Blocking loop for the threaded server: handle events until the bus is gone."""
+        raise NotImplementedError
+
+    def dispatch(self, events):
+        for event in events:
+            self.handler(event)
+
+
+class InProcessHub:
+    """Connects InProcessBus nodes that live in the same process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.nodes = dict()  # node id -> InProcessBus
+
+    def connect(self, node_id):
+        """Create a bus for a new node and announce it to the others."""
+        bus = InProcessBus(self, node_id)
+        with self.lock:
+            self.nodes[node_id] = bus
+        bus.publish({"type": "hello"})
+        return bus
+
+    def route(self, origin, event):
+        with self.lock:
+            target = event.get("to")
+            if target is not None:
+                targets = [self.nodes[target]] if target in self.nodes else []
+            else:
+                targets = [bus for bus in self.nodes.values() if bus is not origin]
+        for bus in targets:
+            bus.receive(event)
+
+    def disconnect(self, origin):
+        with self.lock:
+            self.nodes.pop(origin.node_id, None)
+        self.route(origin, {"type": "node-down", "node": origin.node_id})
+
+
+class InProcessBus(MessageBus):
+    """
+    Bus node for servers running in the same process.
+    Events are handed over through an inbox; a socket pair wakes up the
+    receiving side so it works with the event loop like a real socket.
+    """
+
+    def __init__(self, hub, node_id):
+        super().__init__(node_id)
+        self.hub = hub
+        self.inbox = deque()
+        self.lock = threading.Lock()
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.closed = False
+
+    def publish(self, event):
+        event["node"] = self.node_id
+        self.hub.route(self, event)
+
+    def receive(self, event):
+        """Called by the hub from the publishing node's thread."""
+        with self.lock:
+            was_empty = not self.inbox
+            self.inbox.append(event)
+        if was_empty:
+            self.wake_writer.send(b"\0")
+
+    def fileno(self):
+        return self.wake_reader.fileno()
+
+    def read_ready(self):
+        if not self.wake_reader.recv(4096):
+            return False
+        with self.lock:
+            events = list(self.inbox)
+            self.inbox.clear()
+        self.dispatch(events)
+        return not self.closed
+
+    def run(self):
+        try:
+            while self.read_ready():
+                pass
+        except OSError:
+            pass  # close() closed the socket before we saw the end of it
+
+    def close(self):
+        self.closed = True
+        self.hub.disconnect(self)
+        # The reader sees the end of the socket pair and stops
+        self.wake_writer.close()
+        self.wake_reader.close()
+
+
+class HubBus(MessageBus):
+    """
+    Bus node connected to a BusHub over TCP ((host, port)) or a Unix socket (path).
+    publish() only queues the event, a writer thread sends everything queued
+    so far as one batch. `secret` is the hub's shared secret, if it has one.
+    At most `limit` events wait to be sent: past that `policy` either drops the
+    oldest (DROP_OLDEST) or gives up on the hub (DISCONNECT, the server then
+    carries on with its own clients only), like a slow client's OutboundQueue.
+    """
+
+    def __init__(self, address, node_id, secret=None, limit=PENDING_LIMIT, policy=DISCONNECT):
+        super().__init__(node_id)
+        family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(address)
+        self.decoder = FrameDecoder(max_frame_size=MAX_BUS_FRAME)
+        self.pending = deque()
+        self.limit = limit
+        self.policy = policy
+        self.condition = threading.Condition()
+        self.closed = False
+        # The first batch names this node
+        hello = {"type": "hello"}
+        if secret is not None:
+            hello["secret"] = secret
+        self.publish(hello)
+        threading.Thread(target=self.send_batches, daemon=True).start()
+
+    def publish(self, event):
+        event["node"] = self.node_id
+        with self.condition:
+            if self.closed:
+                return
+            if len(self.pending) >= self.limit:
+                if self.policy == DROP_OLDEST:
+                    self.pending.popleft()
+                else:
+                    log.warning("bus_overflow", node=self.node_id, pending=len(self.pending))
+                    self.closed = True
+                    self.pending.clear()
+                    self.condition.notify()
+                    # The reader sees the connection end, the server goes on without the bus
+                    try:
+                        self.sock.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+                    return
+            self.pending.append(event)
+            if len(self.pending) == 1:
+                self.condition.notify()
+
+    def send_batches(self):
+        """Writer thread: send everything published since the last write in one go."""
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending or self.closed)
+                if self.closed:
+                    return
+                events, self.pending = self.pending, deque()
+            try:
+                for frame in encode_batches(events):
+                    self.sock.sendall(frame)
+            except OSError:
+                return
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read_ready(self):
+        if self.decoder.recv_from(self.sock) == 0:
+            return False
+        while True:
+            frame = self.decoder.next_frame()
+            if frame is None:
+                return True
+            self.dispatch(json.loads(frame))
+
+    def run(self):
+        try:
+            while self.read_ready():
+                pass
+        except OSError:
+            pass  # The hub went away (or close() closed the socket), same as the end of it
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.sock.close()
+
+
+class BusHub:
+    """
+    Relay between HubBus nodes.
+    Runs in the parent of the --workers processes, or on its own for a cluster
+    (python bus.py --listen HOST:PORT --secret ...). With a `secret`, nodes
+    that don't say it in their hello are dropped.
+    """
+
+    def __init__(self, hub_socket, secret=None):
+        self.hub_socket = hub_socket
+        self.secret = secret
+        self.selector = selectors.DefaultSelector()
+        self.nodes = dict()  # node id -> NodeLink
+
+    def serve_forever(self):
+        """Relay events until the process is stopped."""
+        self.hub_socket.setblocking(False)
+        self.selector.register(self.hub_socket, selectors.EVENT_READ, None)
+        while True:
+            for key, events in self.selector.select():
+                if key.data is None:
+                    self.accept_node()
+                    continue
+                link = key.data
+                if events & selectors.EVENT_READ:
+                    self.read_from(link)
+                if events & selectors.EVENT_WRITE and link.sock.fileno() != -1:
+                    self.flush(link)
+
+    def accept_node(self):
+        """Accept a node that connects to the bus."""
+        try:
+            node_socket, _ = self.hub_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        node_socket.setblocking(False)
+        link = NodeLink(node_socket)
+        self.selector.register(node_socket, selectors.EVENT_READ, link)
+
+    def read_from(self, link):
+        """Read batches from one node and relay them."""
+        try:
+            received = link.decoder.recv_from(link.sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            received = 0
+        if not received:
+            self.drop(link)
+            return
+
+        try:
+            while True:
+                frame = link.decoder.next_frame()
+                if frame is None:
+                    break
+                events = json.loads(frame)
+                if link.node is None:
+                    # The first event of a node is its hello
+                    hello = events[0]
+                    secret = str(hello.pop("secret", ""))
+                    if self.secret is not None and not hmac.compare_digest(secret.encode(), self.secret.encode()):
+                        log.warning("bus_node_refused", node=hello["node"], address=link.sock.getpeername())
+                        self.drop(link)
+                        return
+                    link.node = hello["node"]
+                    self.nodes[link.node] = link
+                self.route(link, events)
+        except (ProtocolError, ValueError, KeyError, IndexError, TypeError):
+            self.drop(link)
+
+    def route(self, origin, events):
+        """Forward a batch: targeted events to their node, the rest to every other node."""
+        broadcast = []
+        targeted = dict()  # node id -> events
+        for event in events:
+            target = event.get("to")
+            if target is None:
+                broadcast.append(event)
+            elif target in self.nodes:
+                targeted.setdefault(target, []).append(event)
+
+        if broadcast:
+            # Encoded once, the same bytes go to every node
+            frames = encode_batches(broadcast)
+            for link in list(self.nodes.values()):
+                if link is not origin:
+                    for frame in frames:
+                        self.send(link, frame)
+        for target, batch in targeted.items():
+            for frame in encode_batches(batch):
+                self.send(self.nodes.get(target), frame)
+
+    def send(self, link, frame):
+        """Queue a frame for a node and write what the socket takes right now."""
+        if link is None or link.sock.fileno() == -1:
+            return  # Dropped while this batch was being routed
+        was_empty = not link.outbound
+        link.outbound += frame
+        if len(link.outbound) > NODE_QUEUE_LIMIT:
+            # The node stopped reading, holding on to everything for it would use up the hub's memory
+            log.warning("bus_node_dropped", node=link.node, queued=len(link.outbound))
+            self.drop(link)
+            return
+        if was_empty:
+            self.flush(link)
+
+    def flush(self, link):
+        """Write pending bytes without blocking."""
+        try:
+            sent = link.sock.send(link.outbound)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self.drop(link)
+            return
+        del link.outbound[:sent]
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if link.outbound else 0)
+        self.selector.modify(link.sock, events, link)
+
+    def drop(self, link):
+        """Forget a node whose connection closed and tell the others its users are gone."""
+        if link.sock.fileno() == -1:
+            return
+        self.selector.unregister(link.sock)
+        link.sock.close()
+        if link.node is not None and self.nodes.get(link.node) is link:
+            del self.nodes[link.node]
+            self.route(link, [{"type": "node-down", "node": link.node}])
+
+
+class NodeLink:
+    """The hub's end of the connection to one node."""
+    __slots__ = ("sock", "node", "decoder", "outbound")
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.node = None  # Set by the node's hello event
+        self.decoder = FrameDecoder(max_frame_size=MAX_BUS_FRAME)
+        self.outbound = bytearray()  # At most NODE_QUEUE_LIMIT bytes
+
+
+if __name__ == "__main__":
+    # Standalone hub for a cluster of servers started with --bus HOST:PORT --bus-secret ...
+    parser = argparse.ArgumentParser(description="Message bus hub for clustered chat servers")
+    parser.add_argument("--listen", default="127.0.0.1:12346",
+                        help="HOST:PORT (or Unix socket path) the nodes connect to")
+    parser.add_argument("--secret", default=os.environ.get("CHAT_BUS_SECRET"),
+                        help="shared secret the nodes must send (default: $CHAT_BUS_SECRET)")
+    args = parser.parse_args()
+    listen = parse_address(args.listen)
+    # Anyone who can reach the hub could read and inject every message
+    if not isinstance(listen, str) and listen[0] not in ("127.0.0.1", "::1", "localhost") and not args.secret:
+        parser.error("a hub listening beyond this machine needs --secret (or CHAT_BUS_SECRET)")
+    hub_socket, address = listen_bus(listen)
+    log.info("bus_hub_listening", address=address, secret=args.secret is not None)
+    try:
+        BusHub(hub_socket, args.secret).serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log.LOG.flush()
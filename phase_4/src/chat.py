@@ -0,0 +1,743 @@
+# Chat logic shared by the threaded server and the event loop server.
+#
+# The servers only move bytes around: they accept sockets, read framed
+# messages and write queued frames. Everything a message means (the
+# "username|color" handshake, /pm, rooms, /exit, ...) is handled here,
+# so both server modes behave exactly the same.
+
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import log
+import metrics
+from protocol import (COLORS, MSG_NOTICE, MSG_USER, MSG_ROOM_NAME, MSG_ROOM, MSG_PM, MSG_SAY, MSG_PM_TO,
+                      MSG_ROOM_SEQ, MSG_PRESENCE, MSG_PING, MSG_PONG, PING, PONG, PRESENCE, COMPRESS_THRESHOLD, encode_message, encode_record,
+                      decode_record, compress_frames, REFUSED, MAX_MESSAGE_SIZE, ProtocolError)
+from registry import SessionRegistry
+from rooms import RoomDirectory, DEFAULT_ROOM, valid_room_name
+from ratelimit import make_bucket
+from presence import Presence, PRESENCE_INTERVAL
+from mailboxes import Mailboxes, MAILBOX_SIZE, MAILBOX_LIMIT
+from outbound import Pinned
+from idtable import IdTable
+
+# Define allowed colors
+VALID_COLORS = COLORS
+
+# Options a client can ask for in its handshake ("username|color|binary,zlib,ping,resume,presence")
+OPTIONS = ("binary", "zlib", "ping", "resume", "presence")
+
+# Ping frames for text and binary clients
+PING_FRAMES = (encode_message(PING), encode_record(MSG_PING))
+
+# Told to a client that goes over its rate limit
+TOO_FAST = "You are sending messages too fast, slow down."
+
+
+# Longest username we accept
+MAX_USERNAME = 32
+
+
+def valid_username(name):
+    """Usernames are short and can't contain spaces, "/pm <username> <message>" couldn't address them."""
+    return 0 < len(name) <= MAX_USERNAME and not any(c.isspace() for c in name)
+
+
+def define_user(user_id, user):
+    """Definition frame of a user id, `user` is (name, color)."""
+    name, color = user
+    return Pinned(encode_record(MSG_USER, user_id, COLORS.index(color) if color in COLORS else 0, text=name))
+
+
+def define_room(room_id, room):
+    """Definition frame of a room id."""
+    return Pinned(encode_record(MSG_ROOM_NAME, room_id, text=room))
+
+
+class ChatMessage:
+    """
+    One message for clients: a notice from the server, a room message or a /pm.
+    It is encoded only when first needed, once per wire format (text or binary,
+    compressed or not), and the same bytes are queued for every recipient that
+    uses that format. A large broadcast is therefore compressed once, not once
+    per recipient.
+    """
+    __slots__ = ("kind", "name", "color", "body", "user_id", "user_definition", "room_id", "room_definition",
+                 "seq", "frames")
+
+    def __init__(self, kind, body, name=None, color=None, user=(None, None), room=(None, None)):
+        self.kind = kind  # MSG_NOTICE, MSG_ROOM, MSG_PM or MSG_PRESENCE
+        self.body = body
+        self.name = name
+        self.color = color
+        # Ids of the sender and the room in the binary format, with the definitions they had (see idtable.py)
+        self.user_id, self.user_definition = user
+        self.room_id, self.room_definition = room
+        self.seq = None   # Sequence number in its room, for clients that can resume
+        # Encoded frames: text, binary, binary with sequence number, then the same three compressed
+        self.frames = [None] * 6
+
+    def text(self):
+        """The message in the text format."""
+        if self.kind == MSG_ROOM:
+            return f"{self.name}|{self.color}|{self.body}"
+        if self.kind == MSG_PM:
+            return f"[PM from {self.name}] {self.body}"
+        if self.kind == MSG_PRESENCE:
+            return PRESENCE + self.body
+        return self.body
+
+    def frame(self, binary, compress_threshold=None, sequenced=False):
+        """
+        The framed message for a text or a binary client.
+        With a compress_threshold, frames at least that long are compressed.
+        `sequenced` binary clients get room messages with their sequence number.
+        """
+        variant = 2 if binary and sequenced and self.seq is not None else int(binary)
+        index = variant + (3 if compress_threshold is not None else 0)
+        frame = self.frames[index]
+        if frame is not None:
+            return frame
+
+        if compress_threshold is not None:
+            frame = self.frame(binary, None, sequenced)
+            if len(frame) >= compress_threshold:
+                frame = compress_frames([frame])[0]
+        elif not binary:
+            frame = encode_message(self.text())
+        elif variant == 2:
+            frame = encode_record(MSG_ROOM_SEQ, self.room_id, self.user_id, self.seq, text=self.body)
+        elif self.kind == MSG_ROOM:
+            frame = encode_record(MSG_ROOM, self.room_id, self.user_id, text=self.body)
+        elif self.kind == MSG_PM:
+            frame = encode_record(MSG_PM, self.user_id, text=self.body)
+        elif self.kind == MSG_PRESENCE:
+            frame = encode_record(MSG_PRESENCE, text=self.body)
+        else:
+            frame = encode_record(MSG_NOTICE, text=self.body)
+        self.frames[index] = frame
+        return frame
+
+
+class ChatService:
+    """
+    Keeps track of who is connected and in which room, and decides who gets each message.
+    `deliver(session, frame, sender)` queues a framed message for one client;
+    `sender` is the client whose message caused it (used for backpressure).
+    With a bus (see bus.py) rooms and /pm also reach clients of other server processes.
+    With a history store (see history.py) messages are saved and replayed to users who join.
+    `user_limit` and `room_limit` are the (messages per second, burst) allowed for
+    each client and in each room (see ratelimit.py), None for no limit.
+    Clients that asked for "resume" can get their session back for `resume_grace`
+    seconds after their connection drops, with the last `resume_backlog` messages
+    of their room; `kick(session)` closes the old connection of a client that
+    resumed before the server noticed it was gone.
+    Roster changes are sent to clients that asked for "presence" at most once
+    every `presence_interval` seconds (see presence.py); the servers call
+    flush_presence() when presence.due().
+    Usernames are unique. A /pm to a user who is offline is kept in a mailbox of
+    the last `mailbox_size` messages (for at most `mailbox_limit` users, see
+    mailboxes.py) and sent when the user logs in; 0 turns mailboxes off.
+    """
+
+    def __init__(self, deliver, bus=None, history=None, compress_threshold=COMPRESS_THRESHOLD,
+                 ping_interval=None, user_limit=None, room_limit=None,
+                 resume_grace=None, resume_backlog=0, kick=None, presence_interval=PRESENCE_INTERVAL,
+                 mailbox_size=MAILBOX_SIZE, mailbox_limit=MAILBOX_LIMIT):
+        self.deliver = deliver
+        self.history = history
+        # Frames at least this long are compressed for clients that accept zlib
+        self.compress_threshold = compress_threshold
+        # Seconds between pings to quiet clients (see heartbeat.py), None if the server doesn't ping
+        self.ping_interval = ping_interval
+        # Connected clients by socket and by username
+        self.registry = SessionRegistry()
+        self.user_limit = user_limit
+        # Room membership, and the recent messages of each room if clients can resume
+        self.rooms = RoomDirectory(room_limit, resume_backlog if resume_grace else 0, resume_grace or 0)
+        self.resume_grace = resume_grace
+        self.kick = kick
+        # Sessions whose connection dropped: token -> (username, room, expiry time), oldest first
+        self.parked = OrderedDict()
+        self.parked_names = dict()  # Username -> token of its parked session, the name stays taken
+        self.parked_lock = threading.Lock()
+        # Users connected to other nodes of the bus: username -> (node id, color)
+        self.remote_users = dict()
+        # Everyone online, here and on the other nodes
+        self.presence = Presence(presence_interval)
+        # Private messages for users who are offline
+        self.mailboxes = Mailboxes(mailbox_size, mailbox_limit)
+        # Ids of users and rooms for the binary format, and their definition frames
+        self.user_ids = IdTable(define_user)  # (name, color) -> id
+        self.room_ids = IdTable(define_room)  # room name -> id
+        self.bus = None
+        if bus is not None:
+            self.attach_bus(bus)
+
+    def attach_bus(self, bus):
+        """Share rooms and /pm with the other nodes on a message bus."""
+        self.bus = bus
+        bus.handler = self.on_bus_event
+
+    def join(self, session, client_info):
+        """
+        Register a client from its "username|color[|options[|token room seq]]"
+        handshake and announce it. The fourth field resumes an earlier session.
+        Returns False if the username was refused (the client was told why and
+        should be disconnected), True if the client joined.
+        """
+        client_info = client_info.split("|")
+        client_name = client_info[0]
+        client_color = client_info[1] if len(client_info) > 1 else "black"
+        options = client_info[2].split(",") if len(client_info) > 2 else []
+        resume = client_info[3].split() if len(client_info) > 3 else []
+
+        # If color is not valid, assign default (black)
+        if client_color not in VALID_COLORS:
+            client_color = "black"
+
+        # Tell a client that asked for options which ones it got, in text, before anything else
+        accepted = [option for option in options if option in OPTIONS]
+        if "ping" in accepted and self.ping_interval is None:
+            accepted.remove("ping")
+        # Sequence numbers only exist in the binary format
+        if "resume" in accepted and (self.resume_grace is None or "binary" not in accepted):
+            accepted.remove("resume")
+
+        if not valid_username(client_name):
+            return self.refuse(session, options, f"Invalid username '{client_name}'.")
+
+        # A known token gives the client its session back, anyone else gets a new token
+        room = DEFAULT_ROOM
+        resumed = None
+        previous = None
+        if "resume" in accepted:
+            resumed = self.resume(client_name, resume[0]) if resume else None
+            if resumed is not None:
+                session.token = resume[0]
+                room, previous = resumed
+            else:
+                session.token = secrets.token_hex(16)
+
+        # Usernames are unique: a name that is online here or on another node, or kept
+        # for a client whose connection dropped and that may still resume, is refused
+        if resumed is None and (client_name in self.remote_users or self.is_parked(client_name)):
+            return self.refuse(session, options, f"Username '{client_name}' is taken.")
+
+        session.name = client_name
+        session.color = client_color
+        if "binary" in accepted:
+            session.binary = True
+            session.known_users = dict()
+            session.known_rooms = dict()
+        session.compress = "zlib" in accepted
+        session.heartbeat = "ping" in accepted
+        session.presence = "presence" in accepted
+        session.bucket = make_bucket(self.user_limit)
+
+        def send_reply():
+            if options:
+                reply = []
+                for option in accepted:
+                    if option == "ping":
+                        reply.append(f"ping={self.ping_interval:g}")
+                    elif option == "resume":
+                        reply.append(f"resume={session.token}")
+                    else:
+                        reply.append(option)
+                self.deliver(session, encode_message("ok|" + ",".join(reply)), None)
+
+        # Take the name, a resumed client takes it over from its old connection.
+        # The reply is queued while the name is claimed, so a /pm to the new user can't get ahead of it
+        if not self.registry.claim(session, previous, send_reply):
+            session.name = None
+            return self.refuse(session, options, f"Username '{client_name}' is taken.")
+
+        # Store the client in the registry (by socket) and the default room
+        # (or the room it was in before its connection dropped)
+        self.registry.add(session)
+        self.mailboxes.seen(client_name)
+        self.rooms.join(session, room)
+        self.presence.join(client_name, client_color)
+        metrics.HANDSHAKES.inc()
+
+        # Log client details on the server side
+        log.info("handshake", name=client_name, address=session.address, color=client_color,
+                 options=accepted, resumed=resumed is not None)
+
+        if resumed is not None:
+            metrics.RESUMES.inc()
+            if previous is not None and self.kick is not None:
+                # The old connection is dead but the server hasn't noticed yet
+                self.kick(previous)
+            # Send only what the client missed, if it tells us where it left off in this room
+            self.notify(session, f"welcome back {client_name}\n")
+            seq = int(resume[2]) if len(resume) > 2 and resume[1] == room and resume[2].isdigit() else None
+            self.catch_up(session, room, seq, client_name)
+            self.deliver_mailbox(session, self.mailboxes.take(client_name))
+            if previous is None:
+                self.publish(room, session, "is back")
+        else:
+            # Send a welcome message to the client, then what was said while it was away
+            self.notify(session, f"welcome {client_name}\n")
+            self.replay(session, DEFAULT_ROOM, client_name)
+            self.deliver_mailbox(session, self.mailboxes.take(client_name))
+
+            # Let everyone in the default room know that a new client has joined
+            self.publish(DEFAULT_ROOM, session, "has joined the server")
+        if self.bus is not None:
+            self.bus.publish({"type": "online", "name": client_name, "color": client_color})
+        return True
+
+    def refuse(self, session, options, reason):
+        """Turn a handshake down, telling the client why. Always returns False."""
+        metrics.NAMES_REFUSED.inc()
+        log.info("handshake_refused", address=session.address, reason=reason)
+        # Clients that sent options read the reply to their handshake, older ones just show it
+        self.deliver(session, encode_message(REFUSED + reason if options else reason), None)
+        return False
+
+    def leave(self, session):
+        """
+        Forget a client that disconnected and tell its room.
+        Returns False if the client was already gone (so cleanup runs only once).
+        """
+        if self.registry.remove(session.sock) is not session:
+            return False
+        room = self.rooms.leave(session)
+
+        # A client that already resumed on a new connection hasn't really left
+        current = self.registry.find(session.name) if session.token is not None else None
+        if current is None or current.token != session.token:
+            # Keep the session a while in case the client comes back
+            if session.token is not None:
+                self.park(session, room)
+
+            # Notify the other clients in the room that this client has left the chat
+            self.publish(room, session, "has left the server")
+            if self.bus is not None:
+                self.bus.publish({"type": "offline", "name": session.name})
+            if self.registry.find(session.name) is None:
+                self.presence.leave(session.name)
+
+        # Log the disconnection on the server side (just the number of users, the roster can be huge)
+        log.info("disconnect", name=session.name, address=session.address, users=len(self.presence))
+        return True
+
+    def park(self, session, room):
+        """Keep the session of a disconnected client for resume_grace seconds."""
+        now = time.monotonic()
+        with self.parked_lock:
+            # Entries are added in order of expiry, the expired ones are at the front
+            while self.parked and next(iter(self.parked.values()))[2] <= now:
+                token, (name, _, _) = self.parked.popitem(last=False)
+                if self.parked_names.get(name) == token:
+                    del self.parked_names[name]
+            self.parked[session.token] = (session.name, room, now + self.resume_grace)
+            self.parked_names[session.name] = session.token
+
+    def is_parked(self, name):
+        """True if `name` belongs to a parked session that can still be resumed."""
+        with self.parked_lock:
+            token = self.parked_names.get(name)
+            if token is None:
+                return False
+            parked = self.parked.get(token)
+            if parked is not None and time.monotonic() < parked[2]:
+                return True
+            # Expired, the name is free again
+            del self.parked_names[name]
+            return False
+
+    def resume(self, name, token):
+        """
+        Find the session a reconnecting client left behind: parked after its connection
+        dropped, or still registered because the server hasn't noticed it is gone yet.
+        Returns (room, the old session if still registered), None for an unknown or expired token.
+        """
+        with self.parked_lock:
+            parked = self.parked.get(token)
+            if parked is not None:
+                parked_name, room, expires = parked
+                # A token presented with another name leaves the parked session alone
+                if parked_name != name:
+                    return None
+                del self.parked[token]
+                if self.parked_names.get(name) == token:
+                    del self.parked_names[name]
+                return (room, None) if time.monotonic() < expires else None
+        previous = self.registry.find(name)
+        if previous is not None and previous.token == token:
+            return previous.room, previous
+        return None
+
+    def handle_frame(self, session, payload):
+        """
+        Handle one frame from a registered client, in the client's wire format.
+        Returns False if the client asked to leave with /exit.
+        """
+        if not session.binary:
+            return self.handle_message(session, str(payload, "utf-8", "replace"))
+
+        kind, fields, text = decode_record(payload)
+        if kind == MSG_PONG:
+            return True
+        if kind == MSG_SAY:
+            return self.handle_message(session, text)
+        if kind == MSG_PM_TO:
+            metrics.MESSAGES_IN.inc()
+            if self.too_long(session, text):
+                return True
+            if self.allow(session, session.bucket is None or session.bucket.take(), TOO_FAST):
+                self.private_message(session, fields[0], text)
+            return True
+        raise ProtocolError(f"clients can't send records of type {kind}")
+
+    def handle_message(self, session, message):
+        """
+        Handle one message from a registered client.
+        Returns False if the client asked to leave with /exit.
+        """
+        # Answer to a ping, receiving it was all that mattered
+        if message == PONG:
+            return True
+        metrics.MESSAGES_IN.inc()
+        if self.too_long(session, message):
+            return True
+
+        # Refuse the message before doing any work for it if the client sends too fast
+        who = message == "/who" or message.startswith("/who ")
+        if message.lower() != "/exit" and session.bucket is not None:
+            allowed = session.bucket.take()
+            if not allowed and who and session.presence:
+                # Clients with presence ask for every page of the snapshot after connecting,
+                # a big roster is more pages than a burst: tell them to ask again shortly
+                metrics.THROTTLED.inc()
+                page = message[len("/who "):].strip()
+                self.send(session, ChatMessage(MSG_PRESENCE, f"!{int(page) if page.isdigit() else 1}"))
+                return True
+            if not self.allow(session, allowed, TOO_FAST):
+                return True
+
+        # The roster, one page at a time ("/who" or "/who <page>")
+        if who:
+            page = message[len("/who "):].strip()
+            self.who(session, int(page) if page.isdigit() else 1)
+            return True
+
+        # Handle private messages (format: "/pm <username> <message>")
+        if message.startswith("/pm "):
+            parts = message.split(" ", 2)  # Split into ["/pm", "username", "message"]
+            if len(parts) == 3:
+                self.private_message(session, parts[1], parts[2])
+            return True
+
+        # Room commands: "/join <room>", "/leave", "/rooms"
+        if message.startswith("/join "):
+            self.change_room(session, message[len("/join "):].strip())
+            return True
+        if message == "/leave":
+            self.change_room(session, DEFAULT_ROOM)
+            return True
+        if message == "/rooms":
+            self.list_rooms(session)
+            return True
+
+        # If the client types '/exit', treat it as a disconnect request
+        if message.lower() == "/exit":
+            session.token = None  # Leaving on purpose, nothing to resume
+            return False
+
+        # A room can only take so many messages, however many clients are talking
+        if not self.allow(session, self.rooms.allow(session.room),
+                          f"Room '{session.room}' is too busy, try again shortly."):
+            return True
+
+        # Send it with the client's name and color to everyone in the sender's room
+        self.publish(session.room, session, message, session)
+        if self.history is not None:
+            self.history.record(session.room, session.name, session.color, message)
+        return True
+
+    def too_long(self, session, text):
+        """
+        True (and the client is told) if a message is over MAX_MESSAGE_SIZE: with the
+        sender's name added it wouldn't fit in a frame, so nobody could be sent it.
+        """
+        # A character is at most 4 bytes, only long messages have to be measured
+        if len(text) * 4 <= MAX_MESSAGE_SIZE or len(text.encode("utf-8")) <= MAX_MESSAGE_SIZE:
+            return False
+        self.notify(session, f"Message not sent, it is longer than {MAX_MESSAGE_SIZE} bytes.")
+        return True
+
+    def allow(self, session, allowed, notice):
+        """
+        Act on the result of a rate limit check and return it.
+        A refused client is told once, not for every message it sends too fast.
+        """
+        if allowed:
+            session.throttled = False
+            return True
+        metrics.THROTTLED.inc()
+        if not session.throttled:
+            session.throttled = True
+            self.notify(session, notice)
+        return False
+
+    def private_message(self, session, target_username, pm_content):
+        """Send a /pm only to the target user and confirm it to the sender."""
+        target = self.registry.find(target_username)
+        if target is not None:
+            self.send(target, self.pm_message(session.name, session.color, pm_content), session)
+        elif target_username in self.remote_users:
+            # The user is connected to another node, send it only there
+            self.bus.publish({"type": "pm", "to": self.remote_users[target_username][0],
+                              "name": target_username, "from": session.name,
+                              "color": session.color, "text": pm_content})
+        elif self.mailboxes.put(target_username, session.name, session.color, pm_content):
+            # Offline, the user gets it on their next login
+            metrics.PM_MAILBOXED.inc()
+            self.notify(session, f'{session.name}: {pm_content} ({datetime.now().strftime("%H:%M")})')
+            self.notify(session, f"User '{target_username}' is offline and will get your message when they log in.")
+            # The user may have logged in (and found an empty mailbox) since we looked
+            target = self.registry.find(target_username)
+            if target is not None:
+                self.deliver_mailbox(target, self.mailboxes.take(target_username))
+            return
+        else:
+            self.notify(session, f"User '{target_username}' not found.")
+            return
+        if self.history is not None:
+            self.history.record(None, session.name, session.color, pm_content, target_username)
+
+        # Confirm delivery to sender
+        self.notify(session, f'{session.name}: {pm_content} ({datetime.now().strftime("%H:%M")})')
+
+    def deliver_mailbox(self, session, messages):
+        """Send a user who just logged in the /pm kept for them while they were offline, in one batch."""
+        if not messages:
+            return
+        count = len(messages)
+        batch = [ChatMessage(MSG_NOTICE, f"{count} private message{'' if count == 1 else 's'} "
+                                         "while you were offline:")]
+        for sender, color, text in messages:
+            batch.append(self.pm_message(sender, color, text))
+            # Saved only now that it was delivered, so the history replay on join doesn't send it twice
+            if self.history is not None:
+                self.history.record(None, sender, color, text, session.name)
+        self.send_all(session, batch)
+
+    def change_room(self, session, room):
+        """Move a client to another room and tell both rooms."""
+        if not valid_room_name(room):
+            self.notify(session, f"Invalid room name '{room}'.")
+            return
+        if room == session.room:
+            self.notify(session, f"You are already in room '{room}'.")
+            return
+
+        previous = self.rooms.join(session, room)
+        self.publish(previous, session, "has left the room")
+        self.notify(session, f"You are now in room '{room}'.")
+        self.replay(session, room)
+        self.publish(room, session, "has joined the room")
+
+    def list_rooms(self, session):
+        """Send the client every room and how many users are in it."""
+        lines = [f"{name} ({count} user{'' if count == 1 else 's'})" for name, count in self.rooms.list_rooms()]
+        self.notify(session, "Rooms:\n" + "\n".join(lines))
+
+    def who(self, session, page):
+        """Send a client one page of the roster."""
+        lines = self.presence.page(page)
+        if session.presence:
+            self.send(session, ChatMessage(MSG_PRESENCE, lines))
+            return
+        # People typing /who get a readable list
+        header, *users = lines.split("\n")
+        number, pages, total = header[1:].split()
+        names = [user.split(" ", 1)[1] for user in users]
+        self.notify(session, f"{total} user{'' if total == '1' else 's'} online (page {number} of {pages}):\n"
+                    + "\n".join(names))
+
+    def flush_presence(self):
+        """Send the roster changes since the last update to every client that asked for them."""
+        delta = self.presence.take_delta()
+        if delta is None:
+            return
+        message = ChatMessage(MSG_PRESENCE, delta)  # Encoded once for everyone
+        for session in self.registry.snapshot():
+            if session.presence:
+                self.send(session, message)
+
+    def replay(self, session, room, user=None):
+        """Send a client the last messages of a room (and the /pm sent to `user`) from the history."""
+        if self.history is None:
+            return
+        rows = self.history.replay(room, user)
+        if not rows:
+            return
+        count = len(rows)
+        messages = [ChatMessage(MSG_NOTICE, f"Last {count} message{'' if count == 1 else 's'} in '{room}':")]
+        for room_name, sender, color, recipient, body in rows:
+            if recipient is None:
+                messages.append(self.room_message(room_name, sender, color, body))
+            else:
+                messages.append(self.pm_message(sender, color, body))
+        self.send_all(session, messages)
+
+    def catch_up(self, session, room, seq, user):
+        """
+        Send a resumed client the messages of its room after sequence number `seq`,
+        or the usual replay if they are no longer all kept (or seq is None).
+        """
+        missed = self.rooms.missed(room, seq) if seq is not None else None
+        if missed is None:
+            self.replay(session, room, user)
+        elif missed:
+            count = len(missed)
+            notice = ChatMessage(MSG_NOTICE, f"You missed {count} message{'' if count == 1 else 's'} in '{room}':")
+            self.send_all(session, [notice] + missed)
+
+    def send_all(self, session, messages):
+        """Send a client several messages, compressed together if it accepts zlib."""
+        if not session.compress:
+            for message in messages:
+                self.send(session, message)
+            return
+
+        # The definitions it needs go first on their own: a slow client's queue may
+        # throw a compressed replay away, but never a definition (see outbound.Pinned)
+        users = dict()
+        rooms = dict()
+        if session.binary:
+            users = {message.user_id: message.user_definition for message in messages if message.user_id is not None}
+            rooms = {message.room_id: message.room_definition for message in messages if message.room_id is not None}
+            # An id given to someone else during the replay needs its new definition
+            # between the messages: send them one by one instead
+            if any(message.user_id is not None and users[message.user_id] is not message.user_definition or
+                   message.room_id is not None and rooms[message.room_id] is not message.room_definition
+                   for message in messages):
+                for message in messages:
+                    self.send(session, message)
+                return
+            for known, definitions in ((session.known_users, users), (session.known_rooms, rooms)):
+                for message_id, definition in definitions.items():
+                    if known.get(message_id) is not definition:
+                        self.deliver(session, definition, None)
+
+        # Compress the whole replay together, which shrinks it far more than
+        # compressing each short message on its own
+        frames = [message.frame(session.binary, None, session.token is not None) for message in messages]
+        for packed in compress_frames(frames):
+            self.deliver(session, packed, None)
+        if session.binary:
+            session.known_users.update(users)
+            session.known_rooms.update(rooms)
+
+    def ping(self, session):
+        """Ask a quiet client to show it is still there."""
+        self.deliver(session, PING_FRAMES[session.binary], None)
+
+    def notify(self, session, text):
+        """Send one client a text notice from the server."""
+        self.send(session, ChatMessage(MSG_NOTICE, text))
+
+    def room_message(self, room, name, color, body):
+        return ChatMessage(MSG_ROOM, body, name, color, self.user_ids.get((name, color)), self.room_ids.get(room))
+
+    def pm_message(self, name, color, body):
+        return ChatMessage(MSG_PM, body, name, color, self.user_ids.get((name, color)))
+
+    def send(self, session, message, sender=None):
+        """
+        Queue a message for one client in the client's wire format.
+        A binary client first gets the definitions of the user and room ids it hasn't seen yet
+        (or last saw with another meaning, see idtable.py).
+        An id is marked as known only after its definition is queued, so another thread
+        that sees it as known can't queue a message ahead of the definition (at worst
+        the definition is sent twice).
+        """
+        if session.binary:
+            if message.user_id is not None and session.known_users.get(message.user_id) is not message.user_definition:
+                self.deliver(session, message.user_definition, None)
+                session.known_users[message.user_id] = message.user_definition
+            if message.room_id is not None and session.known_rooms.get(message.room_id) is not message.room_definition:
+                self.deliver(session, message.room_definition, None)
+                session.known_rooms[message.room_id] = message.room_definition
+        threshold = self.compress_threshold if session.compress else None
+        self.deliver(session, message.frame(session.binary, threshold, session.token is not None), sender)
+
+    def publish(self, room, session, body, sender=None):
+        """Send a message from `session` to every client in one room, on this node and on the bus."""
+        self.publish_local(room, self.room_message(room, session.name, session.color, body), sender)
+        if self.bus is not None:
+            self.bus.publish({"type": "room", "room": room, "name": session.name,
+                              "color": session.color, "text": body})
+
+    def publish_local(self, room, message, sender=None):
+        """
+        Send a message to every client in one room connected to this node.
+        It is encoded at most once per wire format, everyone gets the same bytes.
+        """
+        started = time.perf_counter()
+        if self.rooms.backlog:
+            # Numbered and kept so clients that resume can be sent what they missed
+            self.rooms.sequence(room, message)
+        members = self.rooms.members(room)
+        for session in members:
+            self.send(session, message, sender)
+        metrics.BROADCAST_SECONDS.observe(time.perf_counter() - started)
+        metrics.FANOUT.observe(len(members))
+
+    def on_bus_event(self, event):
+        """Handle an event sent by another node."""
+        kind = event["type"]
+        if kind == "room":
+            self.publish_local(event["room"], self.room_message(
+                event["room"], event["name"], event["color"], event["text"]))
+        elif kind == "pm":
+            target = self.registry.find(event["name"])
+            if target is not None:
+                self.send(target, self.pm_message(event["from"], event["color"], event["text"]))
+        elif kind == "mailbox":
+            target = self.registry.find(event["name"])
+            if target is not None:
+                self.deliver_mailbox(target, event["messages"])
+        elif kind == "online":
+            self.remote_users[event["name"]] = (event["node"], event["color"])
+            self.presence.join(event["name"], event["color"])
+            self.mailboxes.seen(event["name"])
+            # Hand over the /pm kept here for a user who logged in on another node
+            messages = self.mailboxes.take(event["name"])
+            if messages:
+                self.bus.publish({"type": "mailbox", "to": event["node"], "name": event["name"],
+                                  "messages": messages})
+        elif kind == "offline":
+            if self.remote_users.get(event["name"], (None,))[0] == event["node"]:
+                del self.remote_users[event["name"]]
+                if self.registry.find(event["name"]) is None:
+                    self.presence.leave(event["name"])
+        elif kind == "hello":
+            # A new node joined the bus, tell it who is connected here
+            for session in self.registry.snapshot():
+                self.bus.publish({"type": "online", "to": event["node"],
+                                  "name": session.name, "color": session.color})
+        elif kind == "node-down":
+            # A node went away, so did all of its users
+            gone = [name for name, user in self.remote_users.items() if user[0] == event["node"]]
+            self.remote_users = {name: user for name, user in self.remote_users.items()
+                                 if user[0] != event["node"]}
+            self.presence.remove_all(name for name in gone if self.registry.find(name) is None)
+
+    def broadcast(self, message, sender=None):
+        """Send a message to every connected client, in every room."""
+        for session in self.registry.snapshot():
+            self.send(session, message, sender)
+
+    def get_connected_clients(self):
+        """Return formatted string of connected clients (on every node of the bus)"""
+        return "\n".join(f"{name} (Color: {color})" for name, color in list(self.presence.users.items()))
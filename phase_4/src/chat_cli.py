@@ -0,0 +1,162 @@
+# Command line chat client, built on the same networking core as the GUI (chat_client.py).
+#
+# Chat from a terminal:
+#   python chat_cli.py --host 127.0.0.1 --name alice --color red
+# Lines typed are sent as they are (so /join, /pm, /rooms and /exit work),
+# messages from the server are printed as they arrive.
+#
+# Or start a crowd of bots to load-test a server:
+#   python chat_cli.py --bots 200 --rate 2 --duration 30
+# Every bot sends --rate messages per second for --duration seconds; at the
+# end the number of messages sent and received is printed. Start the server
+# with --user-rate 0 --room-rate 0 so the bots aren't throttled.
+#
+# --tls connects with TLS, --tls-ca PATH trusts the server's self-signed
+# certificate. All bots share one TLS context, so after the first full
+# handshake the others resume its session.
+
+import argparse
+import asyncio
+import sys
+import threading
+import time
+from datetime import datetime
+
+from chat_client import ChatClient, format_record
+from tls import client_context
+
+
+def read_lines(loop, lines):
+    """Read stdin in a daemon thread (it blocks) and hand every line to the event loop."""
+    for line in sys.stdin:
+        loop.call_soon_threadsafe(lines.put_nowait, line.rstrip("\n"))
+    loop.call_soon_threadsafe(lines.put_nowait, None)  # End of input (Ctrl+D)
+
+
+async def chat(args, tls):
+    """Interactive mode: print what arrives, send what is typed."""
+    loop = asyncio.get_running_loop()
+    lines = asyncio.Queue()
+    closed = loop.create_future()
+
+    def show(record):
+        text, color = format_record(record, datetime.now().strftime("%H:%M"))
+        print(text, flush=True)
+
+    def on_close(error):
+        if not closed.done():
+            closed.set_result(error)
+        lines.put_nowait(None)
+
+    client = ChatClient(args.name, args.color, on_message=show, on_close=on_close, tls=tls)
+    await client.connect(args.host, args.port, args.timeout)
+    threading.Thread(target=read_lines, args=(loop, lines), daemon=True).start()
+
+    while True:
+        line = await lines.get()
+        if line is None or line.lower() == "/exit":
+            break
+        if line:
+            client.send(line)
+
+    await client.close()
+    error = closed.result() if closed.done() else None
+    print(f"Disconnected from server ({error})" if error else "Disconnected from server")
+
+
+class Bot:
+    """One simulated user of the load test."""
+
+    def __init__(self, index, args, tls):
+        self.index = index
+        self.received = 0
+        self.sent = 0
+        self.error = None
+        self.client = ChatClient(f"{args.name}{index}", args.color,
+                                 on_message=self.on_message, on_close=self.on_close, tls=tls)
+
+    def on_message(self, record):
+        self.received += 1
+
+    def on_close(self, error):
+        self.error = error
+
+    async def run(self, args, start, deadline):
+        # Spread the messages of all bots evenly over each interval
+        interval = 1 / args.rate
+        next_send = start + interval * self.index / args.bots
+        while True:
+            now = time.monotonic()
+            if now >= deadline or self.client.closed:
+                break
+            if now >= next_send:
+                self.client.send(f"message {self.sent} from {self.client.username}")
+                self.sent += 1
+                next_send += interval
+            await asyncio.sleep(max(min(next_send, deadline) - time.monotonic(), 0))
+
+
+async def run_bots(args, tls):
+    """Load test mode: connect --bots clients and let them talk for --duration seconds."""
+    bots = [Bot(index, args, tls) for index in range(args.bots)]
+    started = time.monotonic()
+    # Connect a batch at a time so the server's backlog isn't flooded
+    for first in range(0, len(bots), 50):
+        await asyncio.gather(*(bot.client.connect(args.host, args.port, args.timeout)
+                               for bot in bots[first:first + 50]))
+    connected = time.monotonic()
+    print(f"{len(bots)} bots connected in {connected - started:.2f}s", flush=True)
+
+    deadline = connected + args.duration
+    await asyncio.gather(*(bot.run(args, connected, deadline) for bot in bots))
+    # Give the last messages time to arrive before counting
+    await asyncio.sleep(args.linger)
+    elapsed = time.monotonic() - connected
+
+    sent = sum(bot.sent for bot in bots)
+    received = sum(bot.received for bot in bots)
+    failed = sum(1 for bot in bots if bot.client.closed)
+    await asyncio.gather(*(bot.client.close() for bot in bots))
+
+    print(f"sent:     {sent} messages ({sent / args.duration:.0f}/s)")
+    print(f"received: {received} messages ({received / elapsed:.0f}/s)")
+    if failed:
+        print(f"lost:     {failed} connections")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Command line chat client and load-test bots")
+    parser.add_argument("--host", default="127.0.0.1", help="address of the chat server")
+    parser.add_argument("--port", type=int, default=12345, help="port of the chat server")
+    parser.add_argument("--name", default="user", help="username (bots add their number to it)")
+    parser.add_argument("--color", default="black", choices=("black", "red", "green", "blue"),
+                        help="color of your messages")
+    parser.add_argument("--timeout", type=float, default=10, metavar="SECONDS",
+                        help="give up connecting after this long")
+    parser.add_argument("--tls", action="store_true",
+                        help="connect with TLS, trusting the system's certificate authorities")
+    parser.add_argument("--tls-ca", metavar="PATH",
+                        help="connect with TLS, trusting this (self-signed) certificate")
+    parser.add_argument("--bots", type=int, default=0, metavar="N",
+                        help="start N bots instead of chatting (load test)")
+    parser.add_argument("--rate", type=float, default=1, metavar="PER_SECOND",
+                        help="messages each bot sends per second")
+    parser.add_argument("--duration", type=float, default=10, metavar="SECONDS",
+                        help="how long the bots keep talking")
+    parser.add_argument("--linger", type=float, default=1, metavar="SECONDS",
+                        help="how long the bots keep listening after they stop talking")
+    args = parser.parse_args(argv)
+    if args.rate <= 0:
+        parser.error("--rate must be more than 0")
+
+    try:
+        tls = client_context(args.tls_ca) if args.tls or args.tls_ca else None
+        asyncio.run(run_bots(args, tls) if args.bots else chat(args, tls))
+    except (OSError, asyncio.TimeoutError) as error:
+        sys.exit(f"Failed to connect: {str(error) or 'timed out'}")
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,422 @@
+# Client networking shared by the GUI (client.py) and the command line
+# client (chat_cli.py).
+#
+# Everything runs on an asyncio event loop, so connecting, the handshake,
+# reading and writing never block the program using it. Outgoing messages
+# go into a queue that a writer task empties, so sending from a UI returns
+# at once. Incoming frames are cut out of the stream by FrameDecoder (which
+# also unpacks compressed frames) and handed over as records
+#   (kind, room, name, color, text)
+# in the same shape for the text and the binary wire format. Pings from the
+# server are answered here.
+#
+# When the connection drops the client reconnects by itself, waiting twice as
+# long after every failed attempt (and at least as long as a busy server asks). It resumes its session with the token the
+# server gave it and the sequence number of the last room message it got, so
+# the server sends only the messages that were missed instead of the whole
+# history. Lines sent meanwhile are kept and go out once it is back.
+#
+# With a TLS context (tls.client_context()) the connection is encrypted. The
+# TLS session of the last connection is offered again when reconnecting, so
+# the server resumes it instead of doing a full handshake.
+#
+# With "presence" the client keeps a Roster of who is online: it asks for the
+# roster page by page after connecting and then applies the server's updates
+# (see presence.py), passing only the changes on to on_roster.
+#
+# Programs that have their own main loop (Qt) run the asyncio loop in a
+# background thread with ClientThread; asyncio programs use ChatClient directly.
+
+import asyncio
+import random
+import socket
+import threading
+
+from protocol import (FrameDecoder, BinaryReader, ProtocolError, MSG_NOTICE, MSG_ROOM, MSG_PM, MSG_SAY,
+                      MSG_PRESENCE, MSG_PING, MSG_PONG, PING, PONG, PRESENCE, BUSY, REFUSED, encode_message, encode_record,
+                      encode_pm_to)
+from tls import ClientContext
+
+# Handshake options asked for by default (see protocol.py)
+DEFAULT_OPTIONS = ("binary", "zlib", "ping", "resume", "presence")
+
+# The server is taken to be gone after this many ping intervals without a word from it
+MISSED_PINGS = 3
+
+# Bytes asked for in one read
+READ_SIZE = 65536
+
+# Seconds to wait before the first reconnect attempt, doubled after every failure up to the maximum
+RECONNECT_DELAY = 0.5
+MAX_RECONNECT_DELAY = 30
+
+# Seconds to wait before asking again for a roster page refused by the rate limit
+ROSTER_RETRY = 1.0
+
+# Reconnect attempts before giving up
+RECONNECT_ATTEMPTS = 10
+
+
+class ServerBusy(ConnectionRefusedError):
+    """The server is full and turned us away, `retry` is how many seconds it asks us to wait."""
+
+    def __init__(self, retry):
+        super().__init__(f"the server is busy, try again in {retry:g}s")
+        self.retry = retry
+
+
+class HandshakeRefused(ConnectionRefusedError):
+    """The server refused our handshake (the username is taken or invalid), trying again won't help."""
+
+
+def parse_text(message):
+    """Turn a message of the text format into a (kind, room, name, color, text) record."""
+    # Roster changes ("/presence\n+red alice\n-bob")
+    if message.startswith(PRESENCE):
+        return MSG_PRESENCE, None, None, None, message[len(PRESENCE):]
+
+    # Private messages (format: "[PM from someone] Hello")
+    if message.startswith("[PM from ") and "] " in message:
+        name, text = message[len("[PM from "):].split("] ", 1)
+        return MSG_PM, None, name, None, text
+
+    # Public messages (format: "username|color|message")
+    parts = message.split("|", 2)
+    if len(parts) == 3:
+        return MSG_ROOM, None, parts[0], parts[1], parts[2]
+
+    # Plain text from the server (welcome, room lists, ...)
+    return MSG_NOTICE, None, None, None, message
+
+
+def format_record(record, time):
+    """Turn a record into the (text, color) of one chat line."""
+    kind, room, name, color, text = record
+    if kind == MSG_PM:
+        return f"[Private from {name}]: {text} ({time})", "purple"
+    if kind == MSG_ROOM:
+        return f"{name}: {text} ({time})", color
+    return text, "black"
+
+
+class Roster:
+    """The users online, kept up to date from the server's presence updates."""
+
+    def __init__(self):
+        self.users = dict()  # username -> color
+
+    def apply(self, update):
+        """
+        Apply one presence update. Returns the changes as (name, color) pairs,
+        color None for a user who went offline, the number of the next
+        roster page to ask for (None when there is none) and whether to wait
+        ROSTER_RETRY seconds before asking (the request went over the rate limit).
+        """
+        changes = []
+        next_page = None
+        later = False
+        for line in update.split("\n"):
+            if line.startswith("+"):
+                color, _, name = line[1:].partition(" ")
+                if self.users.get(name) != color:
+                    self.users[name] = color
+                    changes.append((name, color))
+            elif line.startswith("-"):
+                if self.users.pop(line[1:], None) is not None:
+                    changes.append((line[1:], None))
+            elif line.startswith("*"):
+                page, pages, total = (int(field) for field in line[1:].split())
+                if page == 1:
+                    # The first page starts the roster over
+                    changes += [(name, None) for name in self.users]
+                    self.users.clear()
+                if page < pages:
+                    next_page = page + 1
+            elif line.startswith("!") and line[1:].isdigit():
+                next_page = int(line[1:])
+                later = True
+        return changes, next_page, later
+
+
+class ChatClient:
+    """
+    One connection to the chat server, used from an asyncio event loop.
+    `on_message(record)` is called for every message to show,
+    `on_close(error)` once when the client stops for good (error is None after close()),
+    `on_roster(changes)` with the (name, color) pairs of every roster change (color None = offline).
+    They are called on the event loop.
+    With `reconnect`, a dropped connection is opened again and the session resumed.
+    `tls` is an SSLContext (see tls.client_context()) to connect with TLS, None for plain TCP.
+    """
+
+    def __init__(self, username, color="black", options=DEFAULT_OPTIONS, on_message=None, on_close=None,
+                 reconnect=True, on_roster=None, tls=None):
+        self.username = username
+        self.color = color
+        self.options = options
+        self.on_message = on_message
+        self.on_close = on_close
+        self.reconnect = reconnect
+        self.on_roster = on_roster
+        self.tls = tls
+        self.roster = Roster()
+        self.host = None
+        self.port = None
+        self.accepted = []      # Options the server agreed to
+        self.binary = False     # True if the server agreed to the binary format
+        self.timeout = None     # Longest silence from the server before giving up (with pings)
+        self.token = None       # Session token for resuming, if the server gave us one
+        self.reader = None
+        self.writer = None      # None while not connected
+        self.decoder = None
+        self.definitions = BinaryReader()  # User and room ids of the binary format, last sequence number
+        self.outbound = []      # Frames waiting for the writer task
+        self.pending = None     # asyncio.Event set when outbound has frames
+        self.tasks = []
+        self.stopping = False   # True once close() was called
+        self.closed = False
+
+    async def connect(self, host, port, timeout=10.0):
+        """Connect, do the handshake and start reading and writing in the background."""
+        self.host = host
+        self.port = port
+        self.pending = asyncio.Event()
+        await self.open(timeout)
+
+    async def open(self, timeout):
+        """Open a connection and do the handshake, resuming the session if we have a token."""
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port, ssl=self.tls), timeout)
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            # Chat lines are small, send each one at once
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        # Send username and color (separated by pipe) and the options we would like,
+        # and where we left off if this is a reconnect
+        handshake = f"{self.username}|{self.color}"
+        if self.options:
+            handshake += "|" + ",".join(self.options)
+        if self.token is not None:
+            handshake += f"|{self.token}"
+            if self.definitions.room is not None:
+                handshake += f" {self.definitions.room} {self.definitions.seq}"
+        writer.write(encode_message(handshake))
+
+        # A server that supports options answers "ok|binary,zlib,ping=30,resume=<token>", an older
+        # one just sends its welcome. Wait for that answer so nothing is sent in the wrong format.
+        self.reader = reader
+        self.decoder = FrameDecoder()
+        try:
+            reply = await asyncio.wait_for(self.read_frame(), timeout)
+            if reply is None:
+                raise ConnectionError("the server closed the connection")
+        except BaseException:
+            writer.close()
+            raise
+        if isinstance(self.tls, ClientContext):
+            # The server's session ticket came before its reply, keep it for reconnecting
+            self.tls.remember(writer.get_extra_info("ssl_object"))
+        reply = str(reply, "utf-8", "replace")
+        if reply.startswith(BUSY):
+            writer.close()
+            try:
+                retry = float(reply[len(BUSY):])
+            except ValueError:
+                retry = RECONNECT_DELAY
+            raise ServerBusy(retry)
+        if reply.startswith(REFUSED):
+            writer.close()
+            raise HandshakeRefused(reply[len(REFUSED):])
+        self.accepted = reply[3:].split(",") if reply.startswith("ok|") else []
+        self.binary = "binary" in self.accepted
+        self.timeout = None
+        self.token = None
+        for option in self.accepted:
+            if option.startswith("ping="):
+                # The server pings us when we are quiet, so a long silence means it is gone
+                self.timeout = float(option[len("ping="):]) * MISSED_PINGS
+            elif option.startswith("resume="):
+                self.token = option[len("resume="):]
+        if not reply.startswith("ok|") and self.on_message is not None:
+            self.on_message(parse_text(reply))
+
+        self.writer = writer
+        self.tasks = [asyncio.create_task(self.read_loop()), asyncio.create_task(self.write_loop())]
+        if "presence" in self.accepted:
+            # Fetch the roster, the next page is asked for when one arrives
+            self.send("/who 1")
+
+    def encode(self, text):
+        """Frame a chat line (or command) in the wire format agreed on in the handshake."""
+        if not self.binary:
+            return encode_message(text)
+        parts = text.split(" ", 2)
+        if parts[0] == "/pm" and len(parts) == 3:
+            # The target name travels in its own field, the server doesn't have to parse the line
+            return encode_pm_to(parts[1], parts[2])
+        return encode_record(MSG_SAY, text=text)
+
+    def send(self, text):
+        """Queue a chat line or command for the server. Returns at once."""
+        self.queue_frame(self.encode(text))
+
+    def queue_frame(self, frame):
+        """Queue a frame for the writer task, kept until we are connected again if we aren't."""
+        if self.closed:
+            return
+        self.outbound.append(frame)
+        self.pending.set()
+
+    async def close(self):
+        """Say /exit, wait until everything queued has been written and close the connection."""
+        if self.closed:
+            return
+        self.stopping = True
+        if self.writer is None:
+            # Waiting to reconnect, stop trying
+            for task in self.tasks:
+                task.cancel()
+            self.stop(None)
+            return
+        self.send("/exit")
+        self.outbound.append(None)  # Tells the writer task to finish
+        self.pending.set()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def read_frame(self):
+        """Return the payload of the next frame, or None when the server closed the connection."""
+        while True:
+            frame = self.decoder.next_frame()
+            if frame is not None:
+                return frame
+            data = await self.reader.read(READ_SIZE)
+            if not data:
+                return None
+            self.decoder.feed(data)
+
+    def read_record(self, frame):
+        """Turn a frame into a record, None for a definition of the binary format."""
+        if self.binary:
+            return self.definitions.read(frame)
+        message = str(frame, "utf-8", "replace")
+        if message == PING:
+            return MSG_PING, None, None, None, ""
+        return parse_text(message)
+
+    async def read_loop(self):
+        """Reader task: hand every message to on_message and answer pings."""
+        error = None
+        try:
+            while True:
+                frame = await asyncio.wait_for(self.read_frame(), self.timeout)
+                if frame is None:
+                    error = ConnectionError("the server closed the connection")
+                    break
+                record = self.read_record(frame)
+                if record is None:
+                    continue
+                if record[0] == MSG_PING:
+                    self.queue_frame(encode_record(MSG_PONG) if self.binary else encode_message(PONG))
+                elif record[0] == MSG_PRESENCE:
+                    changes, next_page, later = self.roster.apply(record[4])
+                    if next_page is not None and later:
+                        asyncio.get_running_loop().call_later(ROSTER_RETRY, self.send, f"/who {next_page}")
+                    elif next_page is not None:
+                        self.send(f"/who {next_page}")
+                    if changes and self.on_roster is not None:
+                        self.on_roster(changes)
+                elif record[0] == MSG_NOTICE and record[4].lower() == "/exit":
+                    break  # The server asked us to go
+                elif self.on_message is not None:
+                    self.on_message(record)
+        except asyncio.CancelledError:
+            pass  # close() finished writing
+        except asyncio.TimeoutError:
+            error = ConnectionError("the server stopped answering")
+        except (OSError, ProtocolError) as exception:
+            error = exception
+        self.finish(error)
+
+    async def write_loop(self):
+        """Writer task: write everything queued, one drain() per batch."""
+        try:
+            while True:
+                await self.pending.wait()
+                self.pending.clear()
+                frames, self.outbound = self.outbound, []
+                done = None in frames
+                self.writer.writelines(frame for frame in frames if frame is not None)
+                await self.writer.drain()
+                if done:
+                    self.finish(None)
+                    return
+        except OSError as error:
+            self.finish(error)
+
+    def finish(self, error):
+        """Close the connection once, then reconnect if it was lost or tell on_close."""
+        if self.writer is None:
+            return
+        for task in self.tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+        self.writer.close()
+        self.writer = None
+        if error is not None and self.reconnect and not self.stopping:
+            self.tasks = [asyncio.create_task(self.reconnect_loop(error))]
+        else:
+            self.stop(error)
+
+    def stop(self, error):
+        """The client is done for good."""
+        self.closed = True
+        if self.on_close is not None:
+            self.on_close(error)
+
+    async def reconnect_loop(self, error):
+        """Reconnect after a lost connection, waiting longer after every failed attempt."""
+        delay = RECONNECT_DELAY
+        for attempt in range(RECONNECT_ATTEMPTS):
+            if self.on_message is not None:
+                what = "Connection lost" if attempt == 0 else "Reconnecting failed"
+                self.on_message((MSG_NOTICE, None, None, None,
+                                 f"{what} ({str(error) or 'timed out'}), trying again in {delay:g}s..."))
+            # Some randomness so clients dropped together don't all come back at the same moment
+            await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+            try:
+                await self.open(max(delay, 5))
+                return
+            except HandshakeRefused as exception:
+                # Someone else has our name now
+                error = exception
+                break
+            except (OSError, asyncio.TimeoutError) as exception:
+                error = exception
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+            if isinstance(error, ServerBusy):
+                delay = max(delay, error.retry)
+        self.stop(error)
+
+
+class ClientThread:
+    """
+    An asyncio event loop running in a daemon thread, for programs (like the
+    Qt GUI) whose own thread must never wait for the network.
+    Every method can be called from any thread.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def run(self, coroutine):
+        """Run a coroutine on the loop, returns a concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def call(self, function, *args):
+        """Call a function on the loop (for ChatClient.send)."""
+        self.loop.call_soon_threadsafe(function, *args)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
@@ -1,17 +1,30 @@
 
 # Import necessary PyQt6 modules for GUI components
 from PyQt6.QtWidgets import QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QGroupBox, QLabel, QLineEdit, \
-    QPushButton, QRadioButton, QTextEdit, QGridLayout, QMessageBox
-from PyQt6.QtGui import QIcon, QIntValidator, QFont  # For icons and input validation
-from PyQt6.QtCore import pyqtSignal, QObject  # For custom signals and QObject base class
+    QPushButton, QRadioButton, QGridLayout, QMessageBox, QListView, QCheckBox
+from PyQt6.QtGui import QIcon, QIntValidator, QFont, QColor  # For icons, input validation and message colors
+from PyQt6.QtCore import pyqtSignal, QObject, QAbstractListModel, QModelIndex, Qt, QTimer  # Signals and the message model
 
 # Import standard library modules
-import socket  # For network communication
-import threading  # For running network operations in separate threads
+import socket  # For looking up the local address shown as default server
+import threading  # For the lock around the queue of received messages
+from bisect import bisect_left
+from collections import deque
 from datetime import datetime
 
-# Create a TCP socket for client-server communication
-client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+# Non-blocking networking shared with the command line client: connecting,
+# the handshake, reading and writing all happen on an asyncio loop in a
+# background thread, so the window never waits for the network
+from chat_client import ChatClient, ClientThread, parse_text, format_record
+
+# TLS contexts that offer the last session again when reconnecting
+from tls import client_context
+
+# Most chat lines kept in the window, older ones are dropped
+MAX_SCROLLBACK = 2000
+
+# Received messages are added to the window at most once per frame (about 60 times a second)
+FRAME_MS = 16
 
 
 class Communicate(QObject):
@@ -19,8 +32,110 @@ class Communicate(QObject):
     Custom communication class that inherits from QObject.
     This enables signal-slot communication between threads safely.
     """
-    # Define a custom signal that carries a string payload
-    message_received = pyqtSignal(str)
+    # Emitted when the first message of a new batch is waiting to be shown
+    messages_pending = pyqtSignal()
+    # Emitted when connecting finished, with the error message ("" on success)
+    connected = pyqtSignal(str)
+    # Emitted when the connection ended, with the error message ("" after Disconnect)
+    disconnected = pyqtSignal(str)
+    # Emitted with a list of (name, color) roster changes, color None = went offline
+    roster_changed = pyqtSignal(list)
+
+
+class MessageModel(QAbstractListModel):
+    """
+    The chat lines shown in the message list, at most `limit` of them.
+    A batch of messages is inserted with one insert and the oldest lines are
+    dropped with one remove, so the view lays itself out once per batch
+    instead of once per message.
+    """
+
+    def __init__(self, limit=MAX_SCROLLBACK):
+        super().__init__()
+        self.limit = limit
+        self.lines = []  # (text, color) for every row
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.lines)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        text, color = self.lines[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return text
+        if role == Qt.ItemDataRole.ForegroundRole:
+            return QColor(color)
+        return None
+
+    def add_lines(self, lines):
+        """Append a batch of lines and drop the oldest ones beyond the limit."""
+        lines = lines[-self.limit:]
+        if not lines:
+            return
+        first = len(self.lines)
+        self.beginInsertRows(QModelIndex(), first, first + len(lines) - 1)
+        self.lines.extend(lines)
+        self.endInsertRows()
+
+        extra = len(self.lines) - self.limit
+        if extra > 0:
+            self.beginRemoveRows(QModelIndex(), 0, extra - 1)
+            del self.lines[:extra]
+            self.endRemoveRows()
+
+
+class RosterModel(QAbstractListModel):
+    """
+    The users online, sorted by name, shown next to the chat.
+    Only the rows that changed are inserted or removed, so an update from the
+    server costs the view O(changes), not a reload of the whole list.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.names = []    # Sorted usernames, one per row
+        self.colors = dict()  # username -> color
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.names)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        name = self.names[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return name
+        if role == Qt.ItemDataRole.ForegroundRole:
+            return QColor(self.colors[name])
+        return None
+
+    def apply(self, changes):
+        """Apply (name, color) changes from the server, color None removes the user."""
+        for name, color in changes:
+            row = bisect_left(self.names, name)
+            present = row < len(self.names) and self.names[row] == name
+            if color is None:
+                if present:
+                    self.beginRemoveRows(QModelIndex(), row, row)
+                    del self.names[row]
+                    del self.colors[name]
+                    self.endRemoveRows()
+            elif present:
+                # Same user with another color
+                self.colors[name] = color
+                self.dataChanged.emit(self.index(row), self.index(row))
+            else:
+                self.beginInsertRows(QModelIndex(), row, row)
+                self.names.insert(row, name)
+                self.colors[name] = color
+                self.endInsertRows()
+
+    def clear(self):
+        self.beginResetModel()
+        self.names = []
+        self.colors = dict()
+        self.endResetModel()
 
 
 class ChatWindow(QMainWindow):
@@ -31,9 +146,20 @@ class ChatWindow(QMainWindow):
 
     def __init__(self):
         super().__init__()
-        # Create communication object and connect its signal to display method
+        # Chat lines received but not shown yet: (text, color)
+        self.pending = deque()
+        self.pending_lock = threading.Lock()
+
+        # Create communication object and connect its signal to the batching method
         self.comm = Communicate()
-        self.comm.message_received.connect(self.display_message)
+        self.comm.messages_pending.connect(self.schedule_flush)
+        self.comm.connected.connect(self.on_connected)
+        self.comm.disconnected.connect(self.on_disconnected)
+        self.comm.roster_changed.connect(self.update_roster)
+
+        # The event loop that does all the networking, and the current connection
+        self.network = ClientThread()
+        self.client = None
 
         # Configure main window properties
         self.setWindowTitle("Chat Application")  # Window title
@@ -227,6 +353,14 @@ class ChatWindow(QMainWindow):
         self.username_input = QLineEdit()
         self.username_input.setPlaceholderText("Enter username")
 
+        # TLS encryption, optionally trusting a self-signed server certificate
+        self.tls_checkbox = QCheckBox("Use TLS")
+        self.tls_checkbox.toggled.connect(lambda checked: self.ca_input.setEnabled(checked))
+        self.ca_label = QLabel("CA Certificate:")
+        self.ca_input = QLineEdit()
+        self.ca_input.setPlaceholderText("System certificates")
+        self.ca_input.setEnabled(False)  # Only used with TLS
+
         # Add widgets to the grid layout
         connection_layout.addWidget(self.server_label, 0, 0)
         connection_layout.addWidget(self.server_input, 0, 1)
@@ -234,6 +368,9 @@ class ChatWindow(QMainWindow):
         connection_layout.addWidget(self.port_input, 0, 3)
         connection_layout.addWidget(self.username_label, 1, 0)
         connection_layout.addWidget(self.username_input, 1, 1, 1, 3)
+        connection_layout.addWidget(self.tls_checkbox, 2, 0)
+        connection_layout.addWidget(self.ca_label, 2, 1)
+        connection_layout.addWidget(self.ca_input, 2, 2, 1, 2)
 
         # Text color selection components
         self.text_color_label = QLabel("Text Color:")
@@ -329,22 +466,29 @@ class ChatWindow(QMainWindow):
         bottom_row_layout.addLayout(button_layout)
 
         # Add the combined layout to the grid
-        connection_layout.addLayout(bottom_row_layout, 2, 0, 1, 4)
+        connection_layout.addLayout(bottom_row_layout, 3, 0, 1, 4)
 
         # Set the layout for the connection group and add to main layout
         connection_group.setLayout(connection_layout)
         self.main_layout.addWidget(connection_group)
 
     def create_chat_display(self):
-        """Create the chat message display area with a read-only text edit."""
+        """Create the chat message display area, a list view over the message model, and the user list."""
         chat_group = QGroupBox("Chat Messages")
-        chat_layout = QVBoxLayout()
-
-        # Create text edit for displaying chat messages
-        self.chat_display = QTextEdit()
+        chat_layout = QHBoxLayout()
+
+        # Only the visible rows are drawn, however long the scrollback is
+        self.messages = MessageModel()
+        self.chat_display = QListView()
+        self.chat_display.setModel(self.messages)
+        self.chat_display.setWordWrap(True)
+        self.chat_display.setVerticalScrollMode(QListView.ScrollMode.ScrollPerPixel)
+        # Lay out new rows in batches so a big burst doesn't freeze the window
+        self.chat_display.setLayoutMode(QListView.LayoutMode.Batched)
+        self.chat_display.setBatchSize(200)
         # Custom styling for the chat display
         self.chat_display.setStyleSheet("""
-            QTextEdit {
+            QListView {
                 background-color: white;
                 border: 1px solid #e0e0e0;
                 border-radius: 4px;
@@ -353,10 +497,17 @@ class ChatWindow(QMainWindow):
                 font-size: 18px;
             }
         """)
-        self.chat_display.setReadOnly(True)  # Make it read-only
+
+        # Who is online, kept up to date by the server's presence updates
+        self.roster = RosterModel()
+        self.roster_display = QListView()
+        self.roster_display.setModel(self.roster)
+        self.roster_display.setFixedWidth(120)
+        self.roster_display.setUniformItemSizes(True)  # Rows are never measured one by one
 
         # Add to layout and main window
         chat_layout.addWidget(self.chat_display)
+        chat_layout.addWidget(self.roster_display)
         chat_group.setLayout(chat_layout)
         self.main_layout.addWidget(chat_group, 1)  # Add with stretch factor 1
 
@@ -397,7 +548,7 @@ class ChatWindow(QMainWindow):
         self.main_layout.addWidget(input_group)
 
     def start_connection(self):
-        """Handle the connection process to the chat server."""
+        """Start connecting to the chat server, the window stays responsive meanwhile."""
         # Get input values
         ip_address = self.server_input.text()
         port_number = self.port_input.text()
@@ -409,121 +560,137 @@ class ChatWindow(QMainWindow):
             QMessageBox.warning(self, "Warning", "Please fill the fields correctly.")
             return
 
-        try:
-            port_number = int(port_number)
-            # Attempt to connect to server
-            client_socket.connect((ip_address, port_number))
-
-            # Determine selected text color
-            color = "black"  # Default
-            if self.red_radio.isChecked():
-                color = "red"
-            elif self.green_radio.isChecked():
-                color = "green"
-            elif self.blue_radio.isChecked():
-                color = "blue"
-
-            # Disable color selection after connection
-            self.black_radio.setEnabled(False)
-            self.red_radio.setEnabled(False)
-            self.green_radio.setEnabled(False)
-            self.blue_radio.setEnabled(False)
-            self.username_input.setEnabled(False)
-            self.server_input.setEnabled(False)
-            self.port_input.setEnabled(False)
-
-            # Send username and color to server (separated by pipe)
-            client_socket.send(f"{username}|{color}".encode('utf-8'))
-
-            # Start a thread to receive messages from server
-            receive_thread = threading.Thread(target=self.receive_message)
-            receive_thread.daemon = True  # Daemonize thread so it exits with main program
-            receive_thread.start()
-
-            # Update UI state
-            self.connect_button.setEnabled(False)
-            self.disconnect_button.setEnabled(True)
-            self.send_button.setEnabled(True)
-
-        except Exception as e:
+        # Determine selected text color
+        color = "black"  # Default
+        if self.red_radio.isChecked():
+            color = "red"
+        elif self.green_radio.isChecked():
+            color = "green"
+        elif self.blue_radio.isChecked():
+            color = "blue"
+
+        # Load the certificates to trust before connecting with TLS
+        tls = None
+        if self.tls_checkbox.isChecked():
+            try:
+                tls = client_context(self.ca_input.text() or None)
+            except OSError as error:
+                QMessageBox.warning(self, "Warning", f"Can't load the CA certificate: {error}")
+                return
+
+        # Disable the connection settings while connecting
+        self.set_settings_enabled(False)
+        self.connect_button.setEnabled(False)
+
+        # Ask for the binary format, compression and heartbeats (ChatClient's defaults).
+        # Connecting and the handshake run on the network thread, the result comes back as a signal
+        client = self.client = ChatClient(username, color, on_message=self.show_record,
+                                          on_close=lambda error: self.comm.disconnected.emit(str(error or "")),
+                                          on_roster=self.comm.roster_changed.emit, tls=tls)
+        connecting = self.network.run(client.connect(ip_address, int(port_number)))
+        connecting.add_done_callback(self.connect_done)
+
+    def connect_done(self, future):
+        """Pass the result of connecting to the UI thread (called on the network thread)."""
+        error = future.exception()
+        self.comm.connected.emit("" if error is None else str(error) or "timed out")
+
+    def on_connected(self, error):
+        """Update the window once connecting finished (runs on the UI thread)."""
+        if error:
             # Show error message if connection fails
-            QMessageBox.critical(self, "Error", f"Failed to connect: {str(e)}")
+            self.client = None
+            self.reset_ui()
+            QMessageBox.critical(self, "Error", f"Failed to connect: {error}")
+            return
+
+        # Update UI state
+        self.disconnect_button.setEnabled(True)
+        self.send_button.setEnabled(True)
 
     def disconnect_from_server(self):
         """Handle disconnection from the chat server."""
-        try:
-            # Send exit command to server
-            client_socket.send("/exit".encode('utf-8'))
-            client_socket.close()  # Close socket
-            self.chat_display.append("Disconnected from server")
-        except:
-            pass  # Ignore errors during disconnection
-        finally:
-            # Update UI state
-            self.connect_button.setEnabled(True)
-            self.disconnect_button.setEnabled(False)
-            self.send_button.setEnabled(False)
-            # Re-enable color selection
-            self.black_radio.setEnabled(True)
-            self.red_radio.setEnabled(True)
-            self.green_radio.setEnabled(True)
-            self.blue_radio.setEnabled(True)
+        if self.client is not None:
+            # Send exit command to server, what is still queued is sent first
+            self.network.run(self.client.close())
+
+    def on_disconnected(self, error):
+        """The connection ended, after Disconnect or because of an error (runs on the UI thread)."""
+        self.client = None
+        self.display_message(f"Disconnected from server ({error})" if error else "Disconnected from server")
+        self.roster.clear()
+        self.reset_ui()
+
+    def reset_ui(self):
+        """Put the buttons and settings back to how they are before connecting."""
+        self.connect_button.setEnabled(True)
+        self.disconnect_button.setEnabled(False)
+        self.send_button.setEnabled(False)
+        self.set_settings_enabled(True)
+
+    def set_settings_enabled(self, enabled):
+        """Enable or disable the connection settings and the color selection."""
+        self.black_radio.setEnabled(enabled)
+        self.red_radio.setEnabled(enabled)
+        self.green_radio.setEnabled(enabled)
+        self.blue_radio.setEnabled(enabled)
+        self.username_input.setEnabled(enabled)
+        self.server_input.setEnabled(enabled)
+        self.port_input.setEnabled(enabled)
+        self.tls_checkbox.setEnabled(enabled)
+        self.ca_input.setEnabled(enabled and self.tls_checkbox.isChecked())
 
     def send_message(self):
         """Send a message to the chat server."""
         message = self.message_input.text()
-        if message:  # Only send non-empty messages
-            try:
-                # Send message to server
-                client_socket.send(message.encode('utf-8'))
-                self.message_input.clear()  # Clear input field
-            except Exception as e:
-                # If sending fails, disconnect
-                self.disconnect_from_server()
-
-    def receive_message(self):
-        """
-        Continuously receive messages from server in a separate thread.
-        Emits signals to update the UI thread safely.
-        """
-        while True:
-            try:
-                # Receive message from server
-                message = client_socket.recv(1024).decode('utf-8')
-                if not message or message.lower() == "/exit":
-                    break  # Exit loop if connection closed
-                # Emit signal to update UI (thread-safe)
-                self.comm.message_received.emit(message)
-            except Exception as e:
-                break  # Exit loop on error
-
-        # Disconnect if loop exits
-        self.disconnect_from_server()
+        if message and self.client is not None:  # Only send non-empty messages
+            # Queued on the network thread, written there without blocking the window
+            self.network.call(self.client.send, message)
+            self.message_input.clear()  # Clear input field
+
+    def update_roster(self, changes):
+        """Apply roster changes from the server to the user list (runs on the UI thread)."""
+        self.roster.apply(changes)
+
+    def show_record(self, record):
+        """Queue a message from the server to be shown (called on the network thread)."""
+        self.show_line(format_record(record, datetime.now().strftime("%H:%M")))
 
     def display_message(self, message):
-        self.chat_display.setAcceptRichText(True)
-
-        # Handle private messages (format: "[PM from someone] Hello")
-        if message.startswith("[PM from "):
-            sender = message.split("]")[0][9:]
-            msg = message.split("]")[1].strip()
-            html = f'<span style="color:purple"><b>[Private from {sender}]:</b> {msg}</span> ({datetime.now().strftime("%H:%M")})'
-            self.chat_display.append(html)
+        """Queue a text message to be shown at the next frame (safe to call from any thread)."""
+        self.show_record(parse_text(message))
+
+    def show_line(self, line):
+        """
+        Queue a (text, color) chat line for the next frame (safe to call from any thread).
+        Only the first line of a batch signals the UI thread.
+        """
+        with self.pending_lock:
+            was_empty = not self.pending
+            self.pending.append(line)
+        if was_empty:
+            self.comm.messages_pending.emit()
+
+    def schedule_flush(self):
+        """Show the queued messages one frame from now, together with anything that arrives meanwhile."""
+        QTimer.singleShot(FRAME_MS, self.flush_messages)
+
+    def flush_messages(self):
+        """Add every queued message to the list in one model update."""
+        with self.pending_lock:
+            batch = list(self.pending)
+            self.pending.clear()
+        if not batch:
             return
 
-        # Replace newlines with HTML line breaks (<br>)
-        message = message.replace("\n", "<br>")
+        # Keep following the conversation only if the user hasn't scrolled up
+        scroll_bar = self.chat_display.verticalScrollBar()
+        at_bottom = scroll_bar.value() == scroll_bar.maximum()
 
-        if "|" in message:
-            parts = message.split("|", 2)
-            if len(parts) == 3:
-                username, color, msg = parts
-                html = f'<span style="color:{color}"><b>{username}:</b> {msg}</span> ({datetime.now().strftime("%H:%M")})'
-                self.chat_display.append(html)
-                return
+        self.messages.add_lines(batch)
 
-        # Ensure plain text messages use HTML for proper line breaks
-        self.chat_display.append(f"<pre>{message}</pre>")  # <pre> preserves formatting
+        if at_bottom:
+            self.chat_display.scrollToBottom()
 
 
 # Create QApplication instance
@@ -0,0 +1,185 @@
+# Server configuration.
+#
+# Every setting can be given on the command line or in a config file:
+#   python server.py --config chat.ini --port 12400
+# The file is INI style, one [server] section whose keys are the command line
+# options without the leading dashes. Flags take true/false:
+#   [server]
+#   mode = selectors
+#   host = 0.0.0.0
+#   backlog = 1024
+#   sndbuf = 262144
+#   nodelay = true
+#   no-history = true
+# Options given on the command line win over the file.
+
+import argparse
+import configparser
+import os
+import socket
+import sys
+
+from outbound import POLICIES, DROP_OLDEST
+from protocol import COMPRESS_THRESHOLD
+from presence import PRESENCE_INTERVAL
+from mailboxes import MAILBOX_SIZE, MAILBOX_LIMIT
+from log import LEVELS
+
+TRUE = ("1", "true", "yes", "on")
+FALSE = ("0", "false", "no", "off")
+
+
+def build_parser():
+    """The command line options of the server."""
+    # Choose how clients are served:
+    # threaded  = one thread per client (original behaviour)
+    # selectors = every client served from a single event loop thread
+    parser = argparse.ArgumentParser(description="Multi-client chat server")
+    parser.add_argument("--config", metavar="PATH",
+                        help="read settings from this file (command line options win)")
+    parser.add_argument("--mode", choices=("threaded", "selectors"), default="threaded",
+                        help="serve clients with one thread each or from one event loop")
+    parser.add_argument("--queue-limit", type=int, default=256,
+                        help="how many messages may wait for a slow client")
+    parser.add_argument("--slow-client-policy", choices=POLICIES, default=DROP_OLDEST,
+                        help="what to do when a client's queue is full")
+    parser.add_argument("--host", default="0.0.0.0",
+                        help="address to listen on (0.0.0.0 = every interface)")
+    parser.add_argument("--port", type=int, default=12345,
+                        help="port clients connect to")
+    parser.add_argument("--backlog", type=int, default=socket.SOMAXCONN,
+                        help="connections the kernel may hold before they are accepted")
+    parser.add_argument("--handshake-timeout", type=float, default=10, metavar="SECONDS",
+                        help="drop connections that haven't finished their handshake in this time (0 = never)")
+    parser.add_argument("--max-handshakes", type=int, default=512, metavar="N",
+                        help="handshakes in progress at once, more connections are turned away busy (0 = no limit)")
+    parser.add_argument("--max-clients", type=int, default=0, metavar="N",
+                        help="clients connected at once, more are turned away busy (0 = no limit)")
+    parser.add_argument("--recv-size", type=int, default=1024, metavar="BYTES",
+                        help="bytes asked for in each read from a client")
+    parser.add_argument("--sndbuf", type=int, metavar="BYTES",
+                        help="kernel send buffer of each client socket (SO_SNDBUF, default: the OS's)")
+    parser.add_argument("--rcvbuf", type=int, metavar="BYTES",
+                        help="kernel receive buffer of each client socket (SO_RCVBUF, default: the OS's)")
+    parser.add_argument("--nodelay", action=argparse.BooleanOptionalAction, default=True,
+                        help="send small messages at once instead of waiting to fill a packet (TCP_NODELAY)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes sharing the port (uses SO_REUSEPORT)")
+    parser.add_argument("--bus", metavar="HOST:PORT",
+                        help="join a cluster through the bus hub at this address (python bus.py --listen)")
+    parser.add_argument("--bus-secret", default=os.environ.get("CHAT_BUS_SECRET"), metavar="SECRET",
+                        help="shared secret of the bus hub (default: $CHAT_BUS_SECRET)")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve Prometheus metrics on 127.0.0.1:PORT/metrics (worker N uses PORT+N)")
+    parser.add_argument("--history", default="chat_history.db", metavar="PATH",
+                        help="SQLite file where room messages and /pm are kept")
+    parser.add_argument("--no-history", action="store_true",
+                        help="don't save or replay messages")
+    parser.add_argument("--replay", type=int, default=50, metavar="N",
+                        help="how many earlier messages a user is shown on joining")
+    parser.add_argument("--replay-age", type=float, metavar="SECONDS",
+                        help="only replay messages newer than this")
+    parser.add_argument("--compress-threshold", type=int, default=COMPRESS_THRESHOLD, metavar="BYTES",
+                        help="compress messages at least this long for clients that support zlib")
+    parser.add_argument("--ping-interval", type=float, default=30, metavar="SECONDS",
+                        help="ping clients that have been quiet this long (0 turns heartbeats off)")
+    parser.add_argument("--idle-timeout", type=float, default=90, metavar="SECONDS",
+                        help="disconnect clients that haven't answered for this long")
+    parser.add_argument("--user-rate", type=float, default=5, metavar="PER_SECOND",
+                        help="messages a client may send per second on average (0 = no limit)")
+    parser.add_argument("--user-burst", type=int, default=10,
+                        help="messages a client may send at once before --user-rate applies")
+    parser.add_argument("--room-rate", type=float, default=100, metavar="PER_SECOND",
+                        help="messages a room accepts per second on average (0 = no limit)")
+    parser.add_argument("--room-burst", type=int, default=200,
+                        help="messages a room accepts at once before --room-rate applies")
+    parser.add_argument("--presence-interval", type=float, default=PRESENCE_INTERVAL, metavar="SECONDS",
+                        help="least time between two roster updates sent to clients")
+    parser.add_argument("--resume-grace", type=float, default=120, metavar="SECONDS",
+                        help="how long a dropped client can reconnect and get its session back (0 = never)")
+    parser.add_argument("--resume-backlog", type=int, default=500, metavar="N",
+                        help="recent messages kept per room for clients that resume")
+    parser.add_argument("--mailbox-size", type=int, default=MAILBOX_SIZE, metavar="N",
+                        help="/pm kept for a user who is offline, sent when they log in (0 = refuse them)")
+    parser.add_argument("--mailboxes", type=int, default=MAILBOX_LIMIT, metavar="N",
+                        help="offline users with kept /pm, the least recently written to is dropped first")
+    parser.add_argument("--log-level", choices=tuple(LEVELS), default="info",
+                        help="lowest level of the records written to the log")
+    parser.add_argument("--log-file", metavar="PATH",
+                        help="write the log to this file instead of stdout (worker N writes PATH-N)")
+    parser.add_argument("--log-max-bytes", type=int, default=10 * 1024 * 1024, metavar="BYTES",
+                        help="start a new log file when it grows past this size (0 = never)")
+    parser.add_argument("--log-backups", type=int, default=3, metavar="N",
+                        help="old log files kept when rotating")
+    parser.add_argument("--log-rate", type=float, default=100, metavar="PER_SECOND",
+                        help="info records per second written for each event, the rest are counted (0 = all)")
+    parser.add_argument("--tls-cert", metavar="PATH",
+                        help="encrypt every connection with TLS using this certificate (PEM)")
+    parser.add_argument("--tls-key", metavar="PATH",
+                        help="private key of --tls-cert (default: in the certificate file)")
+    return parser
+
+
+def read_config_file(parser, path):
+    """Turn the [server] section of a config file into command line arguments."""
+    config = configparser.ConfigParser(interpolation=None)
+    try:
+        with open(path, encoding="utf-8") as config_file:
+            config.read_file(config_file)
+    except (OSError, configparser.Error) as error:
+        parser.error(f"can't read config file {path}: {error}")
+    if not config.has_section("server"):
+        parser.error(f"config file {path} has no [server] section")
+
+    arguments = []
+    for key, value in config.items("server"):
+        option = "--" + key.replace("_", "-")
+        action = parser._option_string_actions.get(option)
+        if action is None or option == "--config":
+            parser.error(f"unknown setting '{key}' in {path}")
+        if action.nargs != 0:
+            arguments += [option, value]
+        elif value.lower() in TRUE:
+            arguments.append(option)
+        elif value.lower() in FALSE:
+            # "--nodelay" has a "--no-nodelay", plain flags are just left out
+            if "--no-" + option[2:] in action.option_strings:
+                arguments.append("--no-" + option[2:])
+        else:
+            parser.error(f"setting '{key}' in {path} must be true or false")
+    return arguments
+
+
+def parse_args(argv=None):
+    """Read the settings from the command line and the config file it names."""
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = build_parser()
+    known, _ = parser.parse_known_args(argv)
+    arguments = list(argv)
+    if known.config:
+        # The file goes first so the same options on the command line override it
+        arguments = read_config_file(parser, known.config) + arguments
+    options = parser.parse_args(arguments)
+
+    if options.workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        parser.error("--workers needs SO_REUSEPORT, which this platform doesn't support")
+    if options.tls_key and not options.tls_cert:
+        parser.error("--tls-key needs --tls-cert")
+    return options
+
+
+def defaults():
+    """Every setting at its default value."""
+    return build_parser().parse_args([])
+
+
+def tune_client_socket(sock, config):
+    """Apply the per-connection socket options of the config to an accepted socket."""
+    if config.nodelay:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    # Accepted sockets usually inherit the listening socket's buffer sizes, but not everywhere
+    if config.sndbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, config.sndbuf)
+    if config.rcvbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, config.rcvbuf)
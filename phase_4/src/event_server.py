@@ -0,0 +1,485 @@
+# Import the required modules
+import selectors  # For waiting on many sockets at once from a single thread
+import socket     # For network communication
+import ssl        # For TLS connections (--tls-cert)
+import threading
+import time
+
+from protocol import FrameDecoder, ProtocolError, MSG_NOTICE, MAX_FRAME_SIZE, MAX_HANDSHAKE_SIZE
+from outbound import OutboundQueue, BACKPRESSURE, send_buffers, advance
+from registry import Session
+from chat import ChatService, ChatMessage
+from heartbeat import HeartbeatMonitor, enable_keepalive
+from admission import Admission
+from config import defaults, tune_client_socket
+from tls import server_context, RECORD_SIZE
+import log
+import metrics
+
+# The resource module only exists on Unix-like systems
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Most connections accepted per loop iteration, so a connect storm can't starve the clients already here
+ACCEPT_BATCH = 64
+
+
+class Connection(Session):
+    """
+    Session plus the state the event loop keeps for every accepted socket.
+    __slots__ keeps each idle connection down to a few hundred bytes.
+    The name stays None until the "username|color" handshake arrives.
+    """
+    __slots__ = ("decoder", "outbound", "events", "blocked_on", "waiting_senders", "tls_wait")
+
+    def __init__(self, sock, address, queue, recv_size=1024):
+        super().__init__(sock, address, queue=queue)
+        # Cuts the byte stream back into messages, only a short greeting is accepted before join
+        self.decoder = FrameDecoder(size=1024, max_frame_size=MAX_HANDSHAKE_SIZE, recv_size=recv_size,
+                                    allow_compressed=False)
+        self.outbound = []           # Buffers taken from the queue but not fully written yet
+        self.events = 0              # Selector events we are currently registered for
+        self.blocked_on = set()      # Slow clients this sender waits for (backpressure)
+        self.waiting_senders = set() # Senders paused because this client's queue is full
+        self.tls_wait = 0            # Selector event the TLS handshake waits for, 0 once it is done
+
+
+def raise_file_limit():
+    """Raise the soft open-file limit to the hard limit so we can hold many sockets."""
+    if resource is None:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        pass  # Not allowed to change it, keep the current limit
+
+
+class EventLoopServer:
+    """
+    Serve the chat protocol for every client from one thread.
+    The selector tells us which sockets are ready, so no thread
+    is blocked per client and idle connections cost almost nothing.
+    `config` holds the server settings (see config.py), the defaults if None.
+    """
+
+    def __init__(self, server_socket, config=None, bus=None, history=None):
+        if config is None:
+            config = defaults()
+        self.server_socket = server_socket
+        self.config = config
+        self.selector = selectors.DefaultSelector()
+        # Encrypts every connection when the server has a certificate
+        self.tls = server_context(config.tls_cert, config.tls_key) if config.tls_cert else None
+        # Handshake, /pm, rooms and /exit (shared with the threaded server)
+        self.chat = ChatService(self.send, bus, history, config.compress_threshold, config.ping_interval or None,
+                                (config.user_rate, config.user_burst), (config.room_rate, config.room_burst),
+                                config.resume_grace or None, config.resume_backlog, kick=self.disconnect,
+                                presence_interval=config.presence_interval,
+                                mailbox_size=config.mailbox_size, mailbox_limit=config.mailboxes)
+        # Handshake timeout and the limits on new connections (see admission.py)
+        self.admission = Admission(config.handshake_timeout, config.max_handshakes, config.max_clients)
+        # Its gauges are labelled with its address, other servers in this process report their own
+        host, port = server_socket.getsockname()[:2]
+        metrics.watch(self, f"{host}:{port}", self.chat, self.admission)
+        # Pings quiet clients and reaps dead ones, the loop walks its timer wheel (see heartbeat.py)
+        self.heartbeats = None
+        if config.ping_interval:
+            self.heartbeats = HeartbeatMonitor(self.chat.ping, self.disconnect,
+                                               config.ping_interval, config.idle_timeout)
+        # Connection to the other nodes (workers or cluster servers, see bus.py), or None
+        self.bus = bus
+        # Connections that got new messages during this loop iteration
+        self.dirty = set()
+        # Full clients that senders are waiting for (backpressure) -> when they filled up, oldest first.
+        # One that doesn't drain within its queue's block_timeout is disconnected, as in threaded mode
+        self.stalled = dict()
+        # shutdown() wakes the loop up by writing to this pair of sockets
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.serving = False
+        self.stopping = False
+        self.draining = False  # True while shutting down: only write, don't read
+        self.drain_timeout = 5.0
+        self.stopped = threading.Event()
+
+    def serve_forever(self):
+        """Run the event loop until shutdown() is called."""
+        self.serving = True
+        raise_file_limit()
+        self.server_socket.setblocking(False)
+        # data=None marks the listening socket
+        self.selector.register(self.server_socket, selectors.EVENT_READ, None)
+        if self.bus is not None:
+            self.selector.register(self.bus, selectors.EVENT_READ, self.bus)
+        self.wakeup_reader.setblocking(False)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ, self.wakeup_reader)
+
+        # Wake up at least once per tick while heartbeats are on
+        tick = self.heartbeats.wheel.tick if self.heartbeats is not None else None
+        presence = self.chat.presence
+
+        while not self.stopping:
+            # ... and in time for the next roster update when there are changes to send
+            timeout = tick
+            if presence.changed:
+                wait = max(presence.flushed + presence.interval - time.monotonic(), 0)
+                timeout = wait if timeout is None else min(timeout, wait)
+            # ... and for the next handshake to time out
+            wait = self.admission.next_deadline()
+            if wait is not None:
+                timeout = wait if timeout is None else min(timeout, wait)
+            # ... and for the oldest stalled client to be given up on
+            if self.stalled:
+                connection, since = next(iter(self.stalled.items()))
+                wait = max(since + connection.queue.block_timeout - time.monotonic(), 0)
+                timeout = wait if timeout is None else min(timeout, wait)
+            for key, events in self.selector.select(timeout):
+                if key.data is None:
+                    self.accept_clients()
+                    continue
+                if key.data is self.bus:
+                    self.read_bus()
+                    continue
+                if key.data is self.wakeup_reader:
+                    continue  # shutdown() has set self.stopping
+                connection = key.data
+                if events & selectors.EVENT_READ:
+                    self.read_from(connection)
+                # The read may have closed the connection already
+                if events & selectors.EVENT_WRITE and connection.sock.fileno() != -1:
+                    self.flush(connection)
+
+            # Ping quiet clients and drop the ones that stopped answering
+            if self.heartbeats is not None:
+                self.heartbeats.check()
+
+            # Drop the connections that took too long to say who they are
+            for connection in self.admission.expired():
+                metrics.HANDSHAKE_TIMEOUTS.inc()
+                self.disconnect(connection)
+
+            # Drop the clients that kept their senders waiting too long
+            self.drop_stalled()
+
+            # Send the roster changes of the last interval in one update
+            if presence.due():
+                self.chat.flush_presence()
+
+            # Write everything queued during this iteration, one sendmsg per client
+            self.flush_dirty()
+
+        self.drain()
+        self.stopped.set()
+
+    def shutdown(self, timeout=5.0):
+        """
+        Stop the loop, send every client what is still queued for it
+        (waiting at most `timeout` seconds) and close all connections.
+        Call it from another thread than the one running serve_forever().
+        """
+        self.drain_timeout = timeout
+        self.stopping = True
+        self.wakeup_writer.send(b"\0")
+        if self.serving:
+            self.stopped.wait()
+        # Closed here and not by drain(): the loop may see `stopping` on its own
+        # and finish before the send above
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
+
+    def drain(self):
+        """Stop accepting and reading, write out the queues, then close every connection."""
+        for sock in (self.server_socket, self.wakeup_reader, self.bus):
+            if sock is not None:
+                self.selector.unregister(sock)
+        self.server_socket.close()
+        connections = {key.data for key in self.selector.get_map().values()}
+
+        self.chat.broadcast(ChatMessage(MSG_NOTICE, "The server is shutting down."))
+        self.draining = True
+        for connection in connections:
+            self.update_events(connection)
+        self.flush_dirty()
+
+        # Only connections with something left to write are still registered
+        deadline = time.monotonic() + self.drain_timeout
+        while self.selector.get_map():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            for key, events in self.selector.select(remaining):
+                self.flush(key.data)
+            # Clients that dropped off during the drain are announced to the others
+            self.flush_dirty()
+
+        for connection in connections:
+            if connection.events:
+                self.selector.unregister(connection.sock)
+            connection.sock.close()
+            connection.queue.close()
+        self.selector.close()
+        metrics.forget(self)
+
+    def accept_clients(self):
+        """Accept the connections waiting in the listen backlog, at most ACCEPT_BATCH of them."""
+        for _ in range(ACCEPT_BATCH):
+            try:
+                client_socket, client_address = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+
+            # Log the new connection
+            log.info("connect", address=client_address)
+            metrics.CONNECTIONS.inc()
+
+            # Turn it away at once if the server is full
+            if not self.admission.admit(len(self.chat.registry)):
+                log.info("rejected", address=client_address)
+                metrics.REJECTED.inc()
+                self.admission.reject(client_socket, reply=self.tls is None)
+                continue
+
+            client_socket.setblocking(False)
+            tune_client_socket(client_socket, self.config)
+            enable_keepalive(client_socket)
+            queue = OutboundQueue(self.config.queue_limit, self.config.slow_client_policy)
+            if self.tls is None:
+                connection = Connection(client_socket, client_address, queue, self.config.recv_size)
+            else:
+                # The TLS handshake is done step by step whenever the socket is ready,
+                # so a slow client never holds up the loop
+                client_socket = self.tls.wrap_socket(client_socket, server_side=True, do_handshake_on_connect=False)
+                connection = Connection(client_socket, client_address, queue, max(self.config.recv_size, RECORD_SIZE))
+                connection.tls_wait = selectors.EVENT_READ
+            self.admission.start(connection)
+            self.update_events(connection)
+            if self.heartbeats is not None:
+                self.heartbeats.watch(connection)
+
+    def read_bus(self):
+        """Deliver events from the other workers to our clients."""
+        try:
+            alive = self.bus.read_ready()
+        except (OSError, ProtocolError):
+            alive = False
+        if not alive:
+            # Keep serving our own clients without the other workers
+            log.warning("bus_lost")
+            self.selector.unregister(self.bus)
+            self.chat.bus = self.bus = None
+
+    def tls_handshake(self, connection):
+        """Take the TLS handshake of a connection as far as the socket allows right now."""
+        try:
+            connection.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            connection.tls_wait = selectors.EVENT_READ
+        except ssl.SSLWantWriteError:
+            connection.tls_wait = selectors.EVENT_WRITE
+        except OSError:
+            # Not TLS, a certificate the client refused, or the client went away
+            self.disconnect(connection)
+            return
+        else:
+            connection.tls_wait = 0
+            metrics.TLS_HANDSHAKES.inc()
+            if connection.sock.session_reused:
+                metrics.TLS_RESUMED.inc()
+        self.update_events(connection)
+        if not connection.tls_wait:
+            # The "username|color" greeting may have come along with the end of the handshake
+            self.read_from(connection)
+
+    def read_from(self, connection):
+        """Read whatever the client sent and handle every complete message in it."""
+        if connection.tls_wait:
+            self.tls_handshake(connection)
+            return
+        try:
+            received = connection.decoder.recv_from(connection.sock)
+        except (BlockingIOError, InterruptedError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        except OSError:
+            received = 0
+
+        # An empty read means the client closed the connection
+        if not received:
+            self.disconnect(connection)
+            return
+        metrics.BYTES_IN.inc(received)
+        connection.last_seen = time.monotonic()
+
+        try:
+            while True:
+                payload = connection.decoder.next_frame()
+                if payload is None:
+                    break
+                if connection.name is None:
+                    self.handle_handshake(connection, str(payload, "utf-8", "replace"))
+                else:
+                    self.handle_message(connection, payload)
+                # /exit (or a failed write) may have closed the connection
+                if connection.sock.fileno() == -1:
+                    return
+        except ProtocolError:
+            self.disconnect(connection)
+
+    def handle_handshake(self, connection, client_info):
+        """Register the client from its "username|color" greeting."""
+        self.admission.done(connection)
+        if not self.chat.join(connection, client_info):
+            # The username was refused, send the reason and hang up
+            self.flush(connection)
+            self.disconnect(connection)
+            return
+        connection.decoder.max_frame_size = MAX_FRAME_SIZE
+        connection.decoder.allow_compressed = connection.compress
+
+    def handle_message(self, connection, payload):
+        """Handle /pm, rooms, /exit and public messages from a registered client (text or binary)."""
+        if not self.chat.handle_frame(connection, payload):
+            # The client typed '/exit', treat it as a disconnect request
+            self.disconnect(connection)
+
+    def send(self, connection, data, sender=None):
+        """
+        Queue a framed message for a client and write as much as the socket accepts right now.
+        `sender` is the client whose message caused this send, it is paused
+        when the recipient is full and the policy is backpressure.
+        """
+        if connection.sock.fileno() == -1:
+            return  # Already closed
+
+        # A full queue under the disconnect policy means the client can't keep up
+        if not connection.queue.put(data, block=False):
+            self.disconnect(connection)
+            return
+
+        if (connection.queue.policy == BACKPRESSURE and connection.queue.is_full()
+                and sender is not None and sender is not connection):
+            self.pause(sender, connection)
+
+        # If nothing is in flight the socket is probably writable, write it
+        # at the end of this loop iteration together with anything else queued
+        if not connection.outbound:
+            self.dirty.add(connection)
+
+    def flush_dirty(self):
+        """Flush every connection that got new messages since the last call."""
+        while self.dirty:
+            connection = self.dirty.pop()
+            if connection.sock.fileno() != -1:
+                self.flush(connection)
+
+    def flush(self, connection):
+        """Write queued buffers without blocking, and watch for writability if some remain."""
+        if connection.tls_wait:
+            self.tls_handshake(connection)
+            return
+        while True:
+            # Take the next batch off the queue once the previous one is fully written
+            if not connection.outbound:
+                connection.outbound = connection.queue.pop_all()
+                if not connection.outbound:
+                    break
+                metrics.MESSAGES_OUT.inc(len(connection.outbound))
+
+            try:
+                # One vectored write for every buffer in flight
+                started = time.perf_counter()
+                sent = send_buffers(connection.sock, connection.outbound)
+                metrics.SEND_SECONDS.observe(time.perf_counter() - started)
+            except (BlockingIOError, InterruptedError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                break
+            except OSError:
+                self.disconnect(connection)
+                return
+            metrics.BYTES_OUT.inc(sent)
+            connection.outbound = advance(connection.outbound, sent)
+
+        # The queue has drained, let paused senders talk again
+        if not connection.outbound and connection.waiting_senders:
+            self.resume_senders(connection)
+
+        self.update_events(connection)
+
+    def pause(self, sender, recipient):
+        """Stop reading from a sender until the recipient's queue has drained."""
+        sender.blocked_on.add(recipient)
+        recipient.waiting_senders.add(sender)
+        if recipient not in self.stalled:
+            self.stalled[recipient] = time.monotonic()
+        self.update_events(sender)
+
+    def resume_senders(self, recipient):
+        """Start reading again from every sender that was waiting for this recipient."""
+        self.stalled.pop(recipient, None)
+        for sender in recipient.waiting_senders:
+            sender.blocked_on.discard(recipient)
+            if sender.sock.fileno() != -1:
+                self.update_events(sender)
+        recipient.waiting_senders.clear()
+
+    def drop_stalled(self):
+        """Disconnect the full clients whose senders have waited longer than block_timeout."""
+        now = time.monotonic()
+        while self.stalled:
+            connection, since = next(iter(self.stalled.items()))
+            if now - since < connection.queue.block_timeout:
+                break
+            del self.stalled[connection]
+            metrics.SLOW_DISCONNECTS.inc()
+            self.disconnect(connection)
+
+    def update_events(self, connection):
+        """Register the connection for reading (unless paused) and for writing (if data is pending)."""
+        if connection.tls_wait and not self.draining:
+            # Still in the TLS handshake, wait for what it needs next
+            events = connection.tls_wait
+        else:
+            events = 0 if connection.blocked_on or self.draining else selectors.EVENT_READ
+            if connection.outbound or len(connection.queue):
+                events |= selectors.EVENT_WRITE
+
+        if events == connection.events:
+            return
+        if not connection.events:
+            self.selector.register(connection.sock, events, connection)
+        elif not events:
+            self.selector.unregister(connection.sock)
+        else:
+            self.selector.modify(connection.sock, events, connection)
+        connection.events = events
+
+    def disconnect(self, connection):
+        """Remove a client, close its socket and notify the others."""
+        if connection.sock.fileno() == -1:
+            return  # Already closed
+
+        if connection.events:
+            self.selector.unregister(connection.sock)
+            connection.events = 0
+        connection.sock.close()
+        connection.queue.close()
+        if self.heartbeats is not None:
+            self.heartbeats.forget(connection)
+
+        # Nobody has to wait for this client any more
+        self.resume_senders(connection)
+        for recipient in connection.blocked_on:
+            recipient.waiting_senders.discard(connection)
+            if not recipient.waiting_senders:
+                self.stalled.pop(recipient, None)
+        connection.blocked_on.clear()
+
+        if connection.name is None:
+            # The client left (or was dropped) before finishing the handshake
+            self.admission.done(connection)
+            log.info("handshake_failed", address=connection.address)
+            return
+
+        # Forget the client and notify the others in its room
+        self.chat.leave(connection)
@@ -0,0 +1,166 @@
+# Heartbeats and idle-connection reaping.
+#
+# A client that vanished without closing its socket (crashed machine, pulled
+# cable, NAT dropping the mapping) is only noticed when a write to it fails,
+# which may be never if nobody talks to it. Until then it keeps its thread,
+# its socket and its place in every room.
+#
+# Clients that list "ping" in their handshake are pinged when they have been
+# quiet for --ping-interval seconds and must answer (any message counts) within
+# --idle-timeout seconds of their last message, or they are disconnected.
+# Older clients can't answer pings, so their sockets get TCP keepalive instead
+# and the kernel reports a dead peer as a failed recv().
+#
+# The deadlines live in a timer wheel: an array of slots, one per tick, that
+# is walked as time passes. Scheduling and cancelling are O(1), and a client
+# that sends a message only updates its last_seen time; the wheel notices
+# that when the old deadline comes round and schedules the new one. No timer
+# thread or heap entry per connection is needed.
+
+import socket
+import threading
+import time
+
+import metrics
+
+
+class TimerWheel:
+    """
+    Hashed timing wheel.
+    Items scheduled further ahead than one turn of the wheel come back early,
+    the owner has to check the real deadline and schedule them again.
+    """
+
+    def __init__(self, tick=1.0, slots=256):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.where = dict()  # item -> index of the slot it is in
+        self.current = int(time.monotonic() / tick)  # Last tick that was handled
+        self.lock = threading.Lock()
+
+    def schedule(self, item, when):
+        """Make `item` come back from expired() once the monotonic time `when` has passed."""
+        tick = max(int(when / self.tick) + 1, self.current + 1)
+        index = tick % len(self.slots)
+        with self.lock:
+            previous = self.where.get(item)
+            if previous is not None:
+                self.slots[previous].discard(item)
+            self.slots[index].add(item)
+            self.where[item] = index
+
+    def cancel(self, item):
+        """Forget an item (does nothing if it isn't scheduled)."""
+        with self.lock:
+            index = self.where.pop(item, None)
+            if index is not None:
+                self.slots[index].discard(item)
+
+    def expired(self, now=None):
+        """Remove and return the items of every slot that time has moved past."""
+        if now is None:
+            now = time.monotonic()
+        target = int(now / self.tick)
+        items = []
+        with self.lock:
+            # After a long pause there is no point walking round the wheel more than once
+            first = max(self.current + 1, target - len(self.slots) + 1)
+            for tick in range(first, target + 1):
+                slot = self.slots[tick % len(self.slots)]
+                if slot:
+                    for item in slot:
+                        del self.where[item]
+                    items.extend(slot)
+                    slot.clear()
+            self.current = max(self.current, target)
+        return items
+
+    def __len__(self):
+        return len(self.where)
+
+
+class HeartbeatMonitor:
+    """
+    Pings quiet clients and disconnects the ones that stopped answering.
+    `ping(session)` sends one ping, `close(session)` disconnects a client.
+    Sessions set their last_seen (time.monotonic()) whenever they receive data.
+    check() must be called about once per tick (by the event loop, or by a
+    thread in the threaded server).
+    """
+
+    def __init__(self, ping, close, ping_interval=30.0, idle_timeout=90.0, tick=1.0):
+        self.ping = ping
+        self.close = close
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.wheel = TimerWheel(tick)
+        self.stopped = threading.Event()
+
+    def watch(self, session):
+        """Start watching a new connection (its handshake counts as the first message)."""
+        session.last_seen = time.monotonic()
+        self.wheel.schedule(session, session.last_seen + min(self.ping_interval, self.idle_timeout))
+
+    def forget(self, session):
+        """Stop watching a connection that was closed."""
+        self.wheel.cancel(session)
+
+    def check(self, now=None):
+        """Handle every connection whose deadline has passed."""
+        if now is None:
+            now = time.monotonic()
+        for session in self.wheel.expired(now):
+            self.check_session(session, now)
+
+    def check_session(self, session, now):
+        idle = now - session.last_seen
+        if session.heartbeat:
+            if idle >= self.idle_timeout:
+                metrics.IDLE_DISCONNECTS.inc()
+                self.close(session)
+                return
+            if idle >= self.ping_interval and session.pinged < session.last_seen:
+                session.pinged = now
+                metrics.PINGS.inc()
+                self.ping(session)
+            if session.pinged >= session.last_seen:
+                # Pinged and waiting for an answer
+                self.wheel.schedule(session, session.last_seen + self.idle_timeout)
+            else:
+                self.wheel.schedule(session, session.last_seen + self.ping_interval)
+        elif session.name is None:
+            # Still no handshake, drop the connection once it has been quiet for too long
+            if idle >= self.idle_timeout:
+                metrics.IDLE_DISCONNECTS.inc()
+                self.close(session)
+            else:
+                self.wheel.schedule(session, session.last_seen + self.idle_timeout)
+        # Clients without heartbeats are left to TCP keepalive
+
+    def start(self):
+        """Run check() once per tick from a daemon thread (threaded server) until stop()."""
+        def run():
+            while not self.stopped.wait(self.wheel.tick):
+                self.check()
+        threading.Thread(target=run, daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+
+def enable_keepalive(sock, idle=60, interval=10, count=5):
+    """
+    Let the kernel probe a quiet connection and fail it if the peer is gone,
+    for clients that don't answer application-level pings.
+    """
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # The timings can only be set on some platforms (Linux, recent macOS and Windows)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+        if hasattr(socket, "TCP_KEEPINTVL"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+        if hasattr(socket, "TCP_KEEPCNT"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+    except OSError:
+        pass  # Keepalive is only a safety net
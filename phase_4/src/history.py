@@ -0,0 +1,118 @@
+# Persistent message history.
+#
+# Room messages and /pm are stored in an SQLite database so users who join
+# late (or reconnect) can be shown what they missed. Messages are only ever
+# appended. Indexes on (room, id) and (recipient, id) let a replay read just
+# the last N rows of one room or one user without scanning, or loading, the
+# whole log.
+#
+# Writing must not slow down the hot path, so record() only appends to a
+# list and a writer thread inserts everything recorded since its last write
+# in one transaction. The database runs in WAL mode, which lets the workers
+# of --workers share one file and lets replays read while the writer writes.
+
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id        INTEGER PRIMARY KEY,
+    time      REAL NOT NULL,
+    room      TEXT,           -- NULL for private messages
+    sender    TEXT NOT NULL,
+    color     TEXT NOT NULL,  -- the sender's color
+    recipient TEXT,           -- NULL for room messages
+    body      TEXT NOT NULL   -- what the sender typed
+);
+CREATE INDEX IF NOT EXISTS messages_by_room ON messages (room, id) WHERE room IS NOT NULL;
+CREATE INDEX IF NOT EXISTS messages_by_recipient ON messages (recipient, id) WHERE recipient IS NOT NULL;
+"""
+
+# Last messages of a room plus the last /pm to a user, newest `limit` of them, oldest first
+REPLAY = """
+SELECT room, sender, color, recipient, body FROM (
+    SELECT * FROM (
+        SELECT * FROM messages WHERE room = ? AND time >= ? ORDER BY id DESC LIMIT ?)
+    UNION ALL
+    SELECT * FROM (
+        SELECT * FROM messages WHERE recipient = ? AND time >= ? ORDER BY id DESC LIMIT ?)
+    ORDER BY id DESC LIMIT ?)
+ORDER BY id
+"""
+
+
+def connect(path):
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")  # WAL stays consistent without an fsync per commit
+    connection.execute("PRAGMA busy_timeout=5000")   # Other workers may be writing
+    return connection
+
+
+class HistoryStore:
+    """
+    Append-only store of room messages and private messages.
+    `replay_limit` is how many messages a joining user is shown,
+    `replay_age` (seconds) leaves out older ones if set.
+    """
+
+    def __init__(self, path, replay_limit=50, replay_age=None):
+        self.path = path
+        self.replay_limit = replay_limit
+        self.replay_age = replay_age
+        self.pending = []  # Rows recorded but not written yet
+        self.condition = threading.Condition()
+        self.closed = False
+
+        self.writer = connect(path)
+        self.writer.executescript(SCHEMA)
+        # Replays run in the client threads (or the event loop) while the writer thread inserts
+        self.reader = connect(path)
+        self.reader_lock = threading.Lock()
+
+        self.writer_thread = threading.Thread(target=self.write_batches, daemon=True)
+        self.writer_thread.start()
+
+    def record(self, room, sender, color, body, recipient=None):
+        """Queue one message to be stored (room=None for a /pm)."""
+        with self.condition:
+            self.pending.append((time.time(), room, sender, color, recipient, body))
+            if len(self.pending) == 1:
+                self.condition.notify()
+
+    def write_batches(self):
+        """Writer thread: insert everything recorded since the last write in one transaction."""
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending or self.closed)
+                rows, self.pending = self.pending, []
+            if rows:
+                with self.writer:
+                    self.writer.executemany(
+                        "INSERT INTO messages (time, room, sender, color, recipient, body) VALUES (?, ?, ?, ?, ?, ?)",
+                        rows)
+            elif self.closed:
+                return
+
+    def replay(self, room, user=None, limit=None, since=None):
+        """
+        Return the last `limit` messages of a room, together with the private
+        messages sent to `user`, oldest first, as (room, sender, color, recipient, body)
+        rows. `since` is a Unix time; older messages are left out.
+        """
+        if limit is None:
+            limit = self.replay_limit
+        if since is None:
+            since = time.time() - self.replay_age if self.replay_age else 0
+        with self.reader_lock:
+            return self.reader.execute(REPLAY, (room, since, limit, user, since, limit, limit)).fetchall()
+
+    def close(self):
+        """Write what is still pending and close the database."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.writer_thread.join()
+        self.writer.close()
+        self.reader.close()
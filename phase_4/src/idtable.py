@@ -0,0 +1,46 @@
+# Ids of users and rooms in the binary format.
+#
+# Binary clients are sent a definition (id -> name) the first time they see a
+# user or room, and after that only the id. The table of ids is bounded: once
+# `size` ids are in use, the id of the user or room that went longest without
+# a message is given to the next new one, with a new definition frame.
+#
+# Every message keeps the definition its id had when it was created, and each
+# client remembers which definition it was last sent for each id. A client that
+# gets a message whose id now means something else is sent the definition again
+# first, so replays and resume backlogs that outlive an id stay readable.
+
+import threading
+from collections import OrderedDict
+
+# Ids kept for users and, separately, for rooms
+ID_TABLE_SIZE = 65536
+
+
+class IdTable:
+    """
+    Gives small integer ids to keys (a user's (name, color) or a room name).
+    `define(id, key)` builds the definition frame sent to clients for an id.
+    """
+
+    def __init__(self, define, size=ID_TABLE_SIZE):
+        self.define = define
+        self.size = size
+        self.entries = OrderedDict()  # key -> (id, definition), least recently used first
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return (id, definition) of a key, giving it an id the first time it is seen."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry
+            if len(self.entries) < self.size:
+                new_id = len(self.entries) + 1
+            else:
+                # Full: reuse the id of the key that went unused longest
+                _, (new_id, _) = self.entries.popitem(last=False)
+            entry = (new_id, self.define(new_id, key))
+            self.entries[key] = entry
+            return entry
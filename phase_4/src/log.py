@@ -0,0 +1,234 @@
+# Server log.
+#
+# Every record is one JSON object on its own line:
+#   {"time": "2026-01-02T10:00:00.123Z", "level": "info", "event": "connect", "address": ["10.0.0.7", 51234]}
+# so the log can be searched and aggregated without parsing free text.
+#
+# Logging must never hold up message delivery, so a call only checks the
+# level, takes a sampling token and puts the record on a bounded queue. A
+# writer thread formats the records and writes them to stdout or a file.
+# When the queue is full the record is dropped (and counted) instead of
+# waiting for a slow pipe or disk.
+#
+# Under load (a reconnect storm, thousands of connects per second) info and
+# debug records are sampled per event: each event may log `rate` records per
+# second, the rest are only counted and reported once a second as a
+# "log_suppressed" record. Warnings and errors are always written.
+#
+# With a file, it is rotated when it grows past `max_bytes`:
+# chat.log -> chat.log.1 -> chat.log.2 ..., keeping `backups` old files.
+
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+from ratelimit import make_bucket
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+LEVEL_NAMES = {number: name for name, number in LEVELS.items()}
+
+# Records waiting for the writer thread before new ones are dropped
+QUEUE_LIMIT = 10000
+
+# Most records the writer thread formats and writes at once
+BATCH_SIZE = 1000
+
+
+class Logger:
+    """
+    JSON-lines logger with a background writer.
+    `level` is the lowest level written, `rate` the info/debug records per second
+    allowed for each event (0 = no sampling), `path` a file (None = stdout)
+    rotated at `max_bytes` with `backups` old files kept.
+    """
+
+    def __init__(self, level=INFO, rate=0, path=None, max_bytes=0, backups=3, queue_limit=QUEUE_LIMIT):
+        self.level = level
+        self.rate = rate
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue = queue.Queue(queue_limit)
+        self.buckets = dict()     # event -> TokenBucket of its sampling rate
+        self.suppressed = dict()  # event -> records sampled away since the last report
+        self.dropped = 0          # Records thrown away because the queue was full
+        self.lock = threading.Lock()
+        self.file = None
+        self.size = 0
+        self.thread = None
+
+    def log(self, level, event, fields):
+        """Queue one record. Returns at once, whatever the writer is doing."""
+        if level < self.level:
+            return
+        if self.rate and level < WARNING:
+            bucket = self.buckets.get(event)
+            if bucket is None:
+                bucket = self.buckets.setdefault(event, make_bucket((self.rate, self.rate)))
+            if not bucket.take():
+                with self.lock:
+                    self.suppressed[event] = self.suppressed.get(event, 0) + 1
+                return
+        if self.thread is None:
+            self.start()
+        try:
+            self.queue.put_nowait((time.time(), level, event, fields))
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        """Start the writer thread (again after a fork, threads don't survive it)."""
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.write_records, daemon=True)
+            self.thread.start()
+
+    def configure(self, level=INFO, rate=0, path=None, max_bytes=0, backups=3):
+        """Change the settings; records already queued are written with the new ones."""
+        self.flush()
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            self.level = level
+            self.rate = rate
+            self.path = path
+            self.max_bytes = max_bytes
+            self.backups = backups
+            self.buckets = dict()
+
+    def flush(self, timeout=5.0):
+        """Wait until everything logged so far has been written (at most `timeout` seconds)."""
+        if self.thread is None:
+            return
+        written = threading.Event()
+        try:
+            self.queue.put(written, timeout=timeout)
+        except queue.Full:
+            return
+        written.wait(timeout)
+
+    def write_records(self):
+        """Writer thread: format and write the queued records, report sampling once a second."""
+        reported = time.monotonic()
+        while True:
+            try:
+                batch = [self.queue.get(timeout=1.0)]
+            except queue.Empty:
+                batch = []
+            while batch and len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = []
+            flushed = []
+            for record in batch:
+                if isinstance(record, threading.Event):
+                    flushed.append(record)
+                else:
+                    lines.append(self.format(*record))
+            now = time.monotonic()
+            if now - reported >= 1.0:
+                reported = now
+                lines += self.report()
+            if lines:
+                self.write("".join(lines))
+            for written in flushed:
+                written.set()
+
+    def report(self):
+        """Lines for the records sampled away or dropped since the last report."""
+        with self.lock:
+            suppressed, self.suppressed = self.suppressed, dict()
+            dropped, self.dropped = self.dropped, 0
+        lines = []
+        if suppressed:
+            lines.append(self.format(time.time(), INFO, "log_suppressed", {"counts": suppressed}))
+        if dropped:
+            lines.append(self.format(time.time(), WARNING, "log_dropped", {"count": dropped}))
+        return lines
+
+    def format(self, when, level, event, fields):
+        """One record as a JSON line."""
+        stamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(when)) + f".{int(when % 1 * 1000):03d}Z"
+        record = {"time": stamp, "level": LEVEL_NAMES[level], "event": event}
+        record.update(fields)
+        return json.dumps(record, default=str) + "\n"
+
+    def write(self, text):
+        """Write formatted lines to stdout or the log file, rotating the file when it is full."""
+        try:
+            if self.path is None:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+                return
+            with self.lock:
+                if self.file is None:
+                    self.file = open(self.path, "a", encoding="utf-8")
+                    self.size = self.file.tell()
+                if self.max_bytes and self.size and self.size + len(text) > self.max_bytes:
+                    self.rotate()
+                self.file.write(text)
+                self.file.flush()
+                self.size += len(text)
+        except (OSError, ValueError):
+            pass  # Nowhere to write (closed pipe, full disk), logging must not stop the server
+
+    def rotate(self):
+        """chat.log -> chat.log.1 -> chat.log.2 ..., call with the lock held."""
+        self.file.close()
+        for number in range(self.backups - 1, 0, -1):
+            older = f"{self.path}.{number}"
+            if os.path.exists(older):
+                os.replace(older, f"{self.path}.{number + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        self.file = open(self.path, "w", encoding="utf-8")
+        self.size = 0
+
+    def after_fork(self):
+        """In a forked worker: the writer thread and the queue's locks stayed behind in the parent."""
+        self.queue = queue.Queue(self.queue.maxsize)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.file = None
+
+
+# Log of this server process
+LOG = Logger()
+atexit.register(LOG.flush)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=LOG.after_fork)
+
+
+def debug(event, **fields):
+    LOG.log(DEBUG, event, fields)
+
+
+def info(event, **fields):
+    LOG.log(INFO, event, fields)
+
+
+def warning(event, **fields):
+    LOG.log(WARNING, event, fields)
+
+
+def error(event, **fields):
+    LOG.log(ERROR, event, fields)
+
+
+def configure(config, path=None):
+    """Apply the --log-* settings of a server config (`path` overrides --log-file)."""
+    LOG.configure(LEVELS[config.log_level], config.log_rate, path or config.log_file,
+                  config.log_max_bytes, config.log_backups)
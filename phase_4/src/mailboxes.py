@@ -0,0 +1,75 @@
+# Private messages for users who are offline.
+#
+# A /pm to a user who isn't online (here or on another node of the bus) is
+# kept in a mailbox for that user instead of being refused, and the whole
+# mailbox is sent in one batch when the user next logs in. Both are bounded:
+# a mailbox keeps the last `size` messages, and at most `limit` mailboxes are
+# kept, the one that has gone longest without a new message is dropped first.
+# Only users who have logged in (here or on another node) get a mailbox, so a
+# /pm to made-up names can't push real users' mailboxes out; the last `known`
+# such names are remembered. Mailboxes live in memory, they don't survive a
+# server restart.
+
+import threading
+from collections import OrderedDict, deque
+
+# Messages kept for one offline user
+MAILBOX_SIZE = 50
+
+# Offline users with a mailbox
+MAILBOX_LIMIT = 10000
+
+# Usernames remembered as having logged in, the least recently seen is forgotten first
+KNOWN_LIMIT = 100000
+
+
+class Mailboxes:
+    """Bounded mailboxes of (sender, color, text) for offline users, by username."""
+
+    def __init__(self, size=MAILBOX_SIZE, limit=MAILBOX_LIMIT, known=KNOWN_LIMIT):
+        self.lock = threading.Lock()
+        self.size = size
+        self.limit = limit
+        self.boxes = OrderedDict()  # username -> deque of messages, least recently used first
+        self.known_limit = known
+        self.known = OrderedDict()  # usernames that have logged in -> None, least recently seen first
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def __contains__(self, name):
+        return name in self.boxes
+
+    def seen(self, name):
+        """`name` logged in, /pm to it may be kept from now on."""
+        with self.lock:
+            self.known[name] = None
+            self.known.move_to_end(name)
+            if len(self.known) > self.known_limit:
+                self.known.popitem(last=False)
+
+    def put(self, name, sender, color, text):
+        """
+        Keep a message for `name`. Returns False if it wasn't kept: mailboxes are
+        turned off (size or limit 0) or `name` has never logged in.
+        """
+        if not self.size or not self.limit:
+            return False
+        with self.lock:
+            if name not in self.known:
+                return False
+            box = self.boxes.get(name)
+            if box is None:
+                box = self.boxes[name] = deque(maxlen=self.size)  # The oldest message makes room
+                if len(self.boxes) > self.limit:
+                    self.boxes.popitem(last=False)
+            else:
+                self.boxes.move_to_end(name)
+            box.append((sender, color, text))
+        return True
+
+    def take(self, name):
+        """Remove and return every message kept for `name`, oldest first."""
+        with self.lock:
+            box = self.boxes.pop(name, None)
+        return list(box) if box else []
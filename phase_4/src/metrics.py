@@ -0,0 +1,244 @@
+# Server metrics in the Prometheus text format.
+#
+# Counters and histograms are updated on the hot path (every message read,
+# queued and written), so recording must be cheap. Each thread adds to its own
+# list of numbers (found through threading.local), which needs no lock and
+# no shared cache line. Only a scrape of the endpoint adds the per-thread
+# values together. Gauges such as the number of connected users are not
+# recorded at all: they are computed from the live state when scraped, one
+# series per server (labelled with its address) when a process runs several.
+#
+# Start the endpoint with --metrics-port and read it with
+#   curl http://127.0.0.1:9100/metrics
+
+import threading
+from bisect import bisect_left
+
+# Histogram buckets (upper bounds) for durations in seconds, 10µs .. 5s
+TIME_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# Histogram buckets for how many clients one message was queued for
+FANOUT_BUCKETS = (1, 2, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+
+class ThreadCells:
+    """
+    One list of `size` numbers per thread, summed when read.
+    Values of threads that have finished are folded into `retired`,
+    so a server that starts a thread per client doesn't keep a list per client forever.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.cells = []  # (thread, cell) of every thread that recorded something
+        self.retired = [0] * size
+
+    def new_cell(self):
+        """First value recorded by this thread."""
+        cell = self.local.cell = [0] * self.size
+        with self.lock:
+            self.cells.append((threading.current_thread(), cell))
+        return cell
+
+    def totals(self):
+        """Sum of every thread's values."""
+        with self.lock:
+            live = []
+            for thread, cell in self.cells:
+                if thread.is_alive():
+                    live.append((thread, cell))
+                else:
+                    self.retired = [a + b for a, b in zip(self.retired, cell)]
+            self.cells = live
+            totals = list(self.retired)
+            for _, cell in live:
+                totals = [a + b for a, b in zip(totals, cell)]
+        return totals
+
+
+class Counter:
+    """A number that only goes up (messages, bytes, connections, ...)."""
+    kind = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.cells = ThreadCells(1)
+
+    def inc(self, amount=1):
+        try:
+            self.cells.local.cell[0] += amount
+        except AttributeError:
+            self.cells.new_cell()[0] += amount
+
+    def samples(self):
+        yield self.name, self.cells.totals()[0]
+
+
+class Histogram:
+    """Distribution of observed values (durations, fan-out sizes) over fixed buckets."""
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # One count per bucket, one for +Inf, then the sum of the values
+        self.cells = ThreadCells(len(self.buckets) + 2)
+
+    def observe(self, value):
+        try:
+            cell = self.cells.local.cell
+        except AttributeError:
+            cell = self.cells.new_cell()
+        cell[bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def samples(self):
+        totals = self.cells.totals()
+        # Prometheus buckets are cumulative
+        count = 0
+        for bound, hits in zip(self.buckets + ("+Inf",), totals):
+            count += hits
+            yield f'{self.name}_bucket{{le="{bound}"}}', count
+        yield f"{self.name}_sum", totals[-1]
+        yield f"{self.name}_count", count
+
+
+class Gauge:
+    """A value read from the live state of each server whenever the metrics are scraped."""
+    kind = "gauge"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.sources = dict()  # server -> (label, function returning its current value)
+
+    def watch(self, server, label, function):
+        self.sources[server] = (label, function)
+
+    def forget(self, server):
+        self.sources.pop(server, None)
+
+    def samples(self):
+        for label, function in list(self.sources.values()):
+            yield f'{self.name}{{server="{label}"}}', function()
+
+
+class MetricsRegistry:
+    """Every metric of this process, in the order they were created."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help):
+        return self.add(Counter(name, help))
+
+    def histogram(self, name, help, buckets=TIME_BUCKETS):
+        return self.add(Histogram(name, help, buckets))
+
+    def gauge(self, name, help):
+        return self.add(Gauge(name, help))
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, value in metric.samples():
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+# Metrics of this server process
+REGISTRY = MetricsRegistry()
+
+CONNECTIONS = REGISTRY.counter("chat_connections_total", "Client connections accepted")
+HANDSHAKES = REGISTRY.counter("chat_handshakes_total", "Clients that completed the username|color handshake")
+REJECTED = REGISTRY.counter("chat_connections_rejected_total", "Connections turned away because the server was full")
+HANDSHAKE_TIMEOUTS = REGISTRY.counter("chat_handshake_timeouts_total", "Connections dropped for not finishing their handshake in time")
+MESSAGES_IN = REGISTRY.counter("chat_messages_received_total", "Messages received from clients")
+BYTES_IN = REGISTRY.counter("chat_bytes_received_total", "Bytes received from clients")
+MESSAGES_OUT = REGISTRY.counter("chat_messages_sent_total", "Messages written to client sockets")
+BYTES_OUT = REGISTRY.counter("chat_bytes_sent_total", "Bytes written to client sockets")
+DROPPED = REGISTRY.counter("chat_messages_dropped_total", "Messages thrown away because a client's queue was full")
+SLOW_DISCONNECTS = REGISTRY.counter("chat_slow_client_disconnects_total", "Clients disconnected because they couldn't keep up")
+IDLE_DISCONNECTS = REGISTRY.counter("chat_idle_disconnects_total", "Connections closed because they stopped answering")
+THROTTLED = REGISTRY.counter("chat_messages_throttled_total", "Messages refused by a user or room rate limit")
+PINGS = REGISTRY.counter("chat_pings_sent_total", "Pings sent to quiet clients")
+TLS_HANDSHAKES = REGISTRY.counter("chat_tls_handshakes_total", "TLS handshakes completed")
+TLS_RESUMED = REGISTRY.counter("chat_tls_resumed_total", "TLS handshakes that resumed a session instead of a full handshake")
+RESUMES = REGISTRY.counter("chat_sessions_resumed_total", "Clients that reconnected and got their session back")
+NAMES_REFUSED = REGISTRY.counter("chat_names_refused_total", "Handshakes refused because the username was taken or invalid")
+PM_MAILBOXED = REGISTRY.counter("chat_pm_mailboxed_total", "Private messages kept for a user who was offline")
+BROADCAST_SECONDS = REGISTRY.histogram("chat_broadcast_seconds", "Time to queue one room message for every member")
+FANOUT = REGISTRY.histogram("chat_broadcast_fanout", "Clients one room message was queued for", FANOUT_BUCKETS)
+SEND_SECONDS = REGISTRY.histogram("chat_send_seconds", "Time of one write of queued messages to a client socket")
+
+CONNECTED = REGISTRY.gauge("chat_connected_users", "Users connected to this process")
+REMOTE_USERS = REGISTRY.gauge("chat_remote_users", "Users connected to other nodes of the bus")
+ROOMS = REGISTRY.gauge("chat_rooms", "Rooms that currently exist")
+QUEUED = REGISTRY.gauge("chat_queued_messages", "Messages waiting in all outbound queues")
+MAILBOXES = REGISTRY.gauge("chat_mailboxes", "Offline users with private messages waiting for them")
+PENDING_HANDSHAKES = REGISTRY.gauge("chat_pending_handshakes", "Connections accepted that haven't finished their handshake")
+QUEUE_MAX = REGISTRY.gauge("chat_queue_depth_max", "Messages waiting in the fullest outbound queue")
+
+
+def watch(server, label, chat, admission):
+    """
+    Compute the gauges of one server when scraped, labelled server="<label>": from its
+    ChatService's registry, rooms, mailboxes and queues, and its pending handshakes.
+    """
+    def queue_depths():
+        return [len(session.queue) for session in chat.registry.snapshot()]
+
+    CONNECTED.watch(server, label, lambda: len(chat.registry))
+    REMOTE_USERS.watch(server, label, lambda: len(chat.remote_users))
+    ROOMS.watch(server, label, lambda: len(chat.rooms.list_rooms()))
+    MAILBOXES.watch(server, label, lambda: len(chat.mailboxes))
+    QUEUED.watch(server, label, lambda: sum(queue_depths()))
+    QUEUE_MAX.watch(server, label, lambda: max(queue_depths(), default=0))
+    PENDING_HANDSHAKES.watch(server, label, lambda: len(admission))
+
+
+def forget(server, registry=REGISTRY):
+    """Stop reporting the gauges of a server that shut down."""
+    for metric in registry.metrics:
+        if isinstance(metric, Gauge):
+            metric.forget(server)
+
+
+def start_http_server(port, host="127.0.0.1", registry=REGISTRY):
+    """
+    Serve the metrics at http://host:port/metrics from a background thread.
+    Returns the HTTPServer, shutdown() stops it.
+    """
+    # Only servers that export metrics pay for importing the HTTP server
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Don't print a line for every scrape
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,194 @@
+# Per-client outbound queues.
+#
+# Every client gets its own bounded queue of framed messages. Whoever produces a
+# message (a broadcast, a /pm, ...) only appends to the queues, and a writer
+# drains each queue on its own. A client that reads slowly can therefore only
+# fill up its own queue instead of stalling everyone else.
+#
+# A broadcast is encoded once into an immutable bytes object and that same
+# object is queued for every recipient. The writers hand a whole batch of
+# queued buffers to one sendmsg() call (vectored write), so a burst of N
+# messages costs one system call per client instead of N, and nothing is
+# copied into a per-client buffer first.
+
+import os
+import socket
+import ssl
+import threading
+from collections import deque
+
+import metrics
+from tls import SharedTLSSocket
+
+# Most buffers the kernel accepts in one sendmsg() call
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+# Windows sockets have no sendmsg(), fall back to joining the buffers there
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+# Most bytes joined for one write to a TLS socket
+TLS_WRITE_SIZE = 65536
+
+# What to do when a client's queue is full
+DROP_OLDEST = "drop-oldest"  # Throw away the oldest queued message to make room
+DISCONNECT = "disconnect"    # Kick the slow client off the server
+BACKPRESSURE = "backpressure"  # Make the sender wait until there is room again
+
+POLICIES = (DROP_OLDEST, DISCONNECT, BACKPRESSURE)
+
+# Under BACKPRESSURE without blocking, a queue holding this many times its limit
+# is given up on: its client isn't reading and the paused senders aren't enough
+OVERFLOW = 2
+
+
+class Pinned(bytes):
+    """
+    A frame that DROP_OLDEST never throws away: the definition of a user or room id
+    in the binary format. Later frames refer to the id, and the client is told
+    each definition only once, so losing it would leave them unreadable.
+    """
+    __slots__ = ()
+
+
+class OutboundQueue:
+    """
+    Bounded FIFO of framed messages waiting to be written to one client.
+    Safe to use from several threads at once.
+    """
+
+    def __init__(self, limit=256, policy=DROP_OLDEST, block_timeout=5.0):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown slow client policy: {policy}")
+        self.limit = limit
+        self.policy = policy
+        self.block_timeout = block_timeout  # Longest a sender waits under backpressure
+        self.messages = deque()
+        self.closed = False
+        self.dropped = 0  # Messages thrown away by DROP_OLDEST
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        return len(self.messages)
+
+    def is_full(self):
+        return len(self.messages) >= self.limit
+
+    def put(self, data, block=True):
+        """
+        Queue one framed message.
+        Returns False if the client can't keep up and should be disconnected.
+        With block=False (event loop) a BACKPRESSURE queue accepts the message
+        anyway and the caller checks is_full() to pause the sender. Senders are
+        only paused after their message, so a few more can arrive, but never
+        more than OVERFLOW times the limit.
+        """
+        with self.condition:
+            if self.closed:
+                return False
+
+            if len(self.messages) >= self.limit:
+                if self.policy == DROP_OLDEST:
+                    self.drop_oldest()
+                elif self.policy == DISCONNECT:
+                    metrics.SLOW_DISCONNECTS.inc()
+                    return False
+                elif not block:
+                    if len(self.messages) >= self.limit * OVERFLOW:
+                        metrics.SLOW_DISCONNECTS.inc()
+                        return False
+                else:
+                    # Wait for the writer to make room, give up on a stalled client
+                    if not self.condition.wait_for(
+                            lambda: self.closed or len(self.messages) < self.limit,
+                            self.block_timeout):
+                        metrics.SLOW_DISCONNECTS.inc()
+                        return False
+                    if self.closed:
+                        return False
+
+            self.messages.append(data)
+            self.condition.notify_all()
+            return True
+
+    def drop_oldest(self):
+        """Throw away the oldest message that isn't Pinned (call with the lock held)."""
+        kept = []
+        while self.messages:
+            message = self.messages.popleft()
+            if isinstance(message, Pinned):
+                kept.append(message)
+                continue
+            self.dropped += 1
+            metrics.DROPPED.inc()
+            break
+        # Pinned frames stay where they were, ahead of the messages that need them
+        self.messages.extendleft(reversed(kept))
+
+    def pop_all(self):
+        """Take every queued message without waiting (may return an empty list)."""
+        with self.condition:
+            batch = list(self.messages)
+            self.messages.clear()
+            self.condition.notify_all()  # Wake senders waiting for room
+            return batch
+
+    def get_batch(self):
+        """
+        Wait until there is something to send and take all of it.
+        Returns None once the queue has been closed and emptied.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.messages or self.closed)
+            if not self.messages:
+                return None
+            batch = list(self.messages)
+            self.messages.clear()
+            self.condition.notify_all()  # Wake senders waiting for room
+            return batch
+
+    def close(self):
+        """Stop accepting messages and wake up the writer and any waiting senders."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+def send_buffers(sock, buffers):
+    """
+    Write as many of the buffers as the socket takes in one system call.
+    Returns the number of bytes written.
+    """
+    if isinstance(sock, (ssl.SSLSocket, SharedTLSSocket)):
+        # TLS has no vectored write, join a batch of buffers. A write that would block
+        # must be repeated with the same bytes, which the same buffers give again
+        size = 0
+        count = 0
+        while count < len(buffers) and size < TLS_WRITE_SIZE:
+            size += len(buffers[count])
+            count += 1
+        return sock.send(b"".join(buffers[:count]))
+    if HAS_SENDMSG:
+        return sock.sendmsg(buffers[:IOV_MAX])
+    return sock.send(b"".join(buffers))
+
+
+def advance(buffers, sent):
+    """Drop the first `sent` bytes from a list of buffers and return what is left."""
+    index = 0
+    while index < len(buffers) and sent >= len(buffers[index]):
+        sent -= len(buffers[index])
+        index += 1
+    remaining = buffers[index:]
+    if sent:
+        # Keep the unsent tail of a partly written buffer without copying it
+        remaining[0] = memoryview(remaining[0])[sent:]
+    return remaining
+
+
+def send_all_buffers(sock, buffers):
+    """Blocking write of every buffer, used by the threaded server's writer threads."""
+    while buffers:
+        buffers = advance(buffers, send_buffers(sock, buffers))
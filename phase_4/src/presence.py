@@ -0,0 +1,106 @@
+# Who is online.
+#
+# The roster is a dict of username -> color, updated in O(1) when a user
+# joins or leaves (here or on another node of the bus). Clients that ask for
+# "presence" in their handshake are not sent the whole list every time it
+# changes. They get:
+#   - deltas: what changed since the last update, at most one update per
+#     interval. A user who joins and leaves again within the same interval
+#     (reconnect storms, flapping clients) is not sent at all;
+#   - a snapshot, one page at a time, when they ask for it with "/who <page>".
+#
+# Presence updates are one text payload of lines, sent as a MSG_PRESENCE
+# record to binary clients and as "/presence\n<lines>" to text clients:
+#   +<color> <name>              the user came online
+#   -<name>                      the user went offline
+#   *<page> <pages> <total>      a snapshot page follows (as "+" lines);
+#                                page 1 replaces the whole roster
+#   !<page>                      "/who <page>" went over the client's rate
+#                                limit, ask for it again a little later
+
+import threading
+import time
+
+# Users per page of "/who"
+PAGE_SIZE = 100
+
+# Seconds between two presence updates
+PRESENCE_INTERVAL = 0.5
+
+
+class Presence:
+    """
+    Roster of the users online, with the changes not yet sent to clients.
+    `interval` is the least time between two updates.
+    """
+
+    def __init__(self, interval=PRESENCE_INTERVAL):
+        self.lock = threading.Lock()
+        self.interval = interval
+        self.users = dict()     # username -> color
+        self.changed = dict()   # username -> its color at the last update (None = was offline)
+        self.flushed = 0.0      # time.monotonic() of the last update
+        self.sorted = None      # Cached sorted (name, color) list for snapshots, None when it must be rebuilt
+
+    def __len__(self):
+        return len(self.users)
+
+    def __contains__(self, name):
+        return name in self.users
+
+    def join(self, name, color):
+        """A user came online."""
+        with self.lock:
+            if name not in self.changed:
+                self.changed[name] = self.users.get(name)
+            self.users[name] = color
+            self.sorted = None
+
+    def leave(self, name):
+        """A user went offline."""
+        with self.lock:
+            if name not in self.users:
+                return
+            if name not in self.changed:
+                self.changed[name] = self.users[name]
+            del self.users[name]
+            self.sorted = None
+
+    def due(self, now=None):
+        """True if there are changes to send and the last update is at least an interval old."""
+        if now is None:
+            now = time.monotonic()
+        return bool(self.changed) and now - self.flushed >= self.interval
+
+    def take_delta(self, now=None):
+        """
+        Return the lines of the next update and start a new interval,
+        or None if nothing changed since the last one.
+        """
+        with self.lock:
+            changed, self.changed = self.changed, dict()
+            self.flushed = time.monotonic() if now is None else now
+            lines = []
+            for name, before in changed.items():
+                color = self.users.get(name)
+                if color == before:
+                    continue  # Left and came back (or the other way round) within the interval
+                lines.append(f"-{name}" if color is None else f"+{color} {name}")
+        return "\n".join(lines) if lines else None
+
+    def page(self, number, size=PAGE_SIZE):
+        """Return the snapshot page `number` (from 1) as presence lines."""
+        with self.lock:
+            users = self.sorted
+            if users is None:
+                users = self.sorted = sorted(self.users.items())
+        pages = max((len(users) + size - 1) // size, 1)
+        number = min(max(number, 1), pages)
+        lines = [f"*{number} {pages} {len(users)}"]
+        lines += [f"+{color} {name}" for name, color in users[(number - 1) * size:number * size]]
+        return "\n".join(lines)
+
+    def remove_all(self, names):
+        """Several users went offline at once (another node went away)."""
+        for name in names:
+            self.leave(name)
@@ -0,0 +1,422 @@
+# Wire protocol shared by the server and the client.
+#
+# Every message is sent as a frame:
+#   4-byte big-endian payload length | payload
+# TCP is a byte stream, so a single recv() can return half a message or
+# several messages glued together. The length header lets the reader cut
+# the stream back into the exact messages that were sent.
+#
+# The payload is UTF-8 text ("username|color|message", "[PM from x] ...")
+# unless the client asks for the binary format in its handshake:
+#   client: "username|color|binary"
+#   server: "ok|binary"        (text, the last text frame of the connection)
+# An old server ignores the extra field and answers with its usual welcome,
+# so the client stays in text mode. In binary mode every payload is a record:
+# a one-byte type, struct-packed fields and the UTF-8 text. Users and rooms
+# are sent once as a definition (id -> name) and after that only by id. The
+# server reuses the ids of users and rooms that went quiet, so an id can be
+# defined again later: the last definition received is the one that counts.
+#
+# A client that also lists "zlib" ("username|color|binary,zlib" or just
+# "username|color|zlib") may be sent compressed frames: the top bit of the
+# length header is set and the payload is zlib-compressed bytes that hold one
+# or more ordinary frames. FrameDecoder unpacks them transparently. Such a
+# client may send compressed frames too; anyone else who does is disconnected.
+#
+# A client that lists "ping" is sent a ping when it has been quiet for a while
+# and must answer with a pong (text "/ping" and "/pong", or the MSG_PING and
+# MSG_PONG records). The server answers "ping=<seconds between pings>", so the
+# client knows how long the server may stay silent before it is gone.
+#
+# A binary client that lists "resume" is given a session token
+# ("ok|binary,resume=<token>") and its room messages come as MSG_ROOM_SEQ
+# records carrying the room's sequence number. After a dropped connection it
+# reconnects with a fourth handshake field, "<token> <room> <last sequence>",
+# gets its session back and is sent only the room messages it missed.
+#
+# A client that lists "presence" is sent who comes online and goes offline as
+# MSG_PRESENCE records (text clients: "/presence\n<lines>"), see presence.py.
+#
+# A server at capacity answers a new connection with "busy|<seconds>" instead
+# of waiting for its handshake, and closes it. The client should try again
+# after that many seconds (see admission.py).
+#
+# Usernames are unique. A handshake with a name that is taken (or isn't a
+# valid name) is answered "error|<reason>" (just the reason for clients that
+# asked for no options) and the connection is closed.
+
+import struct
+import time
+import zlib
+from collections import deque
+
+# "!I" = network byte order, unsigned 32-bit integer
+HEADER = struct.Struct("!I")
+
+# Refuse frames larger than this so a broken client can't make us allocate gigabytes
+MAX_FRAME_SIZE = 1024 * 1024
+
+# Longest message (UTF-8 bytes) a client may send. The server adds the sender's
+# name and color (or a record header) before passing it on, which must still fit in a frame
+MAX_MESSAGE_SIZE = MAX_FRAME_SIZE - 1024
+
+# Frame size limit until the client has said who it is, a "username|color|options" greeting is short
+MAX_HANDSHAKE_SIZE = 1024
+
+# The receive buffer grows by at most this much per read, so a frame header alone
+# (without the bytes it announces) can't make us allocate the whole frame
+GROW_STEP = 64 * 1024
+
+# Length header bit marking a compressed frame
+COMPRESSED = 0x80000000
+
+# Frames shorter than this are not worth compressing
+COMPRESS_THRESHOLD = 512
+
+# Start of the reply of a server that is full, followed by the seconds to wait
+BUSY = "busy|"
+
+# Start of the reply to a handshake that was refused, followed by the reason
+REFUSED = "error|"
+
+# Allowed text colors, their index is the color in the binary format
+COLORS = ("black", "red", "green", "blue")
+
+# Binary record types: server -> client
+MSG_NOTICE = 0     # Text from the server (welcome, room list, errors, ...)
+MSG_USER = 1       # Defines user id -> (name, color)
+MSG_ROOM_NAME = 2  # Defines room id -> room name
+MSG_ROOM = 3       # A user said something in a room
+MSG_PM = 4         # A private message from a user
+MSG_PING = 7       # Are you still there?
+MSG_ROOM_SEQ = 9   # MSG_ROOM with the room's sequence number (clients that asked for "resume")
+MSG_PRESENCE = 10  # Roster changes or a roster page (clients that asked for "presence")
+# client -> server
+MSG_SAY = 5        # A chat line (commands such as /join included)
+MSG_PM_TO = 6      # A private message for a user given by name
+MSG_PONG = 8       # Answer to MSG_PING
+
+# Fields of each record type, the UTF-8 text follows them
+RECORDS = {
+    MSG_NOTICE: struct.Struct("!B"),
+    MSG_USER: struct.Struct("!BIB"),     # user id, color index | name
+    MSG_ROOM_NAME: struct.Struct("!BI"), # room id | name
+    MSG_ROOM: struct.Struct("!BII"),     # room id, user id | message
+    MSG_PM: struct.Struct("!BI"),        # sender user id | message
+    MSG_SAY: struct.Struct("!B"),
+    MSG_PM_TO: struct.Struct("!BB"),     # length of the UTF-8 name | name, message
+    MSG_ROOM_SEQ: struct.Struct("!BIII"),  # room id, user id, sequence number | message
+    MSG_PRESENCE: struct.Struct("!B"),
+    MSG_PING: struct.Struct("!B"),
+    MSG_PONG: struct.Struct("!B"),
+}
+
+# Heartbeat messages of the text format
+PING = "/ping"
+PONG = "/pong"
+
+# Start of a presence update in the text format
+PRESENCE = "/presence\n"
+
+
+class ProtocolError(ValueError):
+    """Raised when the peer sends a frame we can't accept."""
+
+
+def encode_message(message, max_frame_size=MAX_FRAME_SIZE):
+    """Turn a str (or already encoded bytes) into a ready-to-send frame."""
+    if isinstance(message, str):
+        message = message.encode("utf-8")
+    # Never send a frame the other side's decoder would refuse
+    if len(message) > max_frame_size:
+        raise ProtocolError(f"frame of {len(message)} bytes is larger than {max_frame_size}")
+    return HEADER.pack(len(message)) + message
+
+
+def compress_frames(frames):
+    """
+    Pack whole frames into as few compressed frames as possible (each holds at
+    most MAX_FRAME_SIZE bytes of frames). Returns the bytes to send; data that
+    doesn't get smaller is sent as it is.
+    """
+    chunks = []
+    chunk = []
+    size = 0
+    for frame in frames:
+        if chunk and size + len(frame) > MAX_FRAME_SIZE:
+            chunks.append(chunk)
+            chunk, size = [], 0
+        chunk.append(frame)
+        size += len(frame)
+    if chunk:
+        chunks.append(chunk)
+
+    packed = []
+    for chunk in chunks:
+        data = b"".join(chunk)
+        compressed = zlib.compress(data)
+        if len(compressed) + HEADER.size < len(data):
+            packed.append(HEADER.pack(len(compressed) | COMPRESSED) + compressed)
+        else:
+            packed.append(data)
+    return packed
+
+
+def send_message(sock, message):
+    """Send one framed message, making sure every byte is written."""
+    sock.sendall(encode_message(message))
+
+
+def encode_record(kind, *fields, text=""):
+    """Build a frame holding one binary record."""
+    return encode_message(RECORDS[kind].pack(kind, *fields) + text.encode("utf-8"))
+
+
+def encode_pm_to(name, text):
+    """Binary /pm from a client: the target name is sent apart from the message."""
+    name = name.encode("utf-8")
+    if len(name) > 255:
+        raise ValueError("username is too long")
+    return encode_message(RECORDS[MSG_PM_TO].pack(MSG_PM_TO, len(name)) + name + text.encode("utf-8"))
+
+
+def decode_record(payload):
+    """
+    Split a binary record into (type, fields, text).
+    For MSG_PM_TO the fields are (target name,).
+    """
+    if not payload or payload[0] not in RECORDS:
+        raise ProtocolError("unknown record type")
+    record = RECORDS[payload[0]]
+    if len(payload) < record.size:
+        raise ProtocolError("record is too short")
+    kind, *fields = record.unpack_from(payload)
+    text_start = record.size
+    if kind == MSG_PM_TO:
+        text_start += fields[0]
+        fields = [str(payload[record.size:text_start], "utf-8", "replace")]
+    return kind, fields, str(payload[text_start:], "utf-8", "replace")
+
+
+class BinaryReader:
+    """
+    Client side of the binary format.
+    Remembers the user and room definitions and turns records back into messages.
+    """
+
+    def __init__(self):
+        self.users = dict()  # user id -> (name, color)
+        self.rooms = dict()  # room id -> room name
+        self.room = None     # Room of the last MSG_ROOM_SEQ record
+        self.seq = 0         # Its sequence number, the point to resume from
+
+    def read(self, payload):
+        """
+        Return (type, room, name, color, text) for a message to show,
+        or None for a definition.
+        """
+        kind, fields, text = decode_record(payload)
+        if kind == MSG_USER:
+            user_id, color = fields
+            self.users[user_id] = (text, COLORS[color] if color < len(COLORS) else COLORS[0])
+            return None
+        if kind == MSG_ROOM_NAME:
+            self.rooms[fields[0]] = text
+            return None
+        if kind == MSG_ROOM:
+            room_id, user_id = fields
+            name, color = self.users.get(user_id, ("?", COLORS[0]))
+            return kind, self.rooms.get(room_id), name, color, text
+        if kind == MSG_ROOM_SEQ:
+            room_id, user_id, seq = fields
+            name, color = self.users.get(user_id, ("?", COLORS[0]))
+            self.room = self.rooms.get(room_id)
+            self.seq = seq
+            return MSG_ROOM, self.room, name, color, text
+        if kind == MSG_PM:
+            name, color = self.users.get(fields[0], ("?", COLORS[0]))
+            return kind, None, name, color, text
+        return kind, None, None, None, text
+
+
+def recv_frame(sock, decoder):
+    """
+    Block until one whole frame has arrived and return its payload as bytes.
+    Returns None when the peer closed the connection.
+    """
+    while True:
+        frame = decoder.next_frame()
+        if frame is not None:
+            return frame
+        if decoder.recv_from(sock) == 0:
+            return None
+
+
+def recv_message(sock, decoder, deadline=None):
+    """
+    Block until one whole message has arrived and return it as a str.
+    Returns None when the peer closed the connection.
+    With a `deadline` (time.monotonic()) raises TimeoutError if the message isn't complete by then.
+    """
+    while True:
+        message = decoder.next_message()
+        if message is not None:
+            return message
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("no complete message before the deadline")
+            sock.settimeout(remaining)
+        if decoder.recv_from(sock) == 0:
+            return None
+
+
+class FrameDecoder:
+    """
+    Streaming frame decoder.
+    Received bytes go straight into one reusable bytearray with recv_into(),
+    and whole frames are decoded from it in place, so a burst of messages
+    is parsed without allocating a new buffer for each read.
+    """
+
+    def __init__(self, size=4096, max_frame_size=MAX_FRAME_SIZE, recv_size=1024, allow_compressed=True):
+        self.size = size  # The buffer goes back to this size after a larger frame
+        self.buffer = bytearray(size)
+        self.start = 0  # First unread byte
+        self.end = 0    # One past the last received byte
+        self.max_frame_size = max_frame_size
+        # Servers only accept compressed frames from clients that negotiated zlib
+        self.allow_compressed = allow_compressed
+        self.recv_size = recv_size  # Bytes asked for in one read (more if a frame needs them)
+        self.unpacked = deque()  # Payloads taken out of a compressed frame, not returned yet
+
+    def make_room(self, needed):
+        """Make sure at least `needed` bytes are free after self.end."""
+        pending = self.end - self.start
+        # Done with a large frame: give its memory back
+        if not pending and len(self.buffer) > max(self.size, needed):
+            self.buffer = bytearray(max(self.size, needed))
+            self.start = self.end = 0
+        if len(self.buffer) - self.end >= needed:
+            return
+        # Move the unread bytes to the front of the buffer
+        if self.start:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, pending
+        # Grow only when a single frame doesn't fit
+        if len(self.buffer) - self.end < needed:
+            self.buffer.extend(bytes(pending + needed - len(self.buffer)))
+
+    def wanted(self):
+        """Number of bytes needed to complete the frame we are waiting for."""
+        pending = self.end - self.start
+        if pending < HEADER.size:
+            return HEADER.size - pending
+        length, _ = self.header()
+        return max(HEADER.size + length - pending, 1)
+
+    def recv_from(self, sock):
+        """
+        Read from the socket straight into the buffer.
+        Returns the number of bytes read (0 means the peer closed).
+        """
+        self.make_room(max(min(self.wanted(), GROW_STEP), self.recv_size))
+        with memoryview(self.buffer) as view:
+            received = sock.recv_into(view[self.end:])
+        self.end += received
+        return received
+
+    def feed(self, data):
+        """Add bytes that were received some other way."""
+        self.make_room(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def next_frame(self):
+        """Return the payload of the next complete frame as bytes, or None."""
+        if self.unpacked:
+            return self.unpacked.popleft()
+        span = self.next_span()
+        if span is None:
+            return None
+        start, end, compressed = span
+        if compressed:
+            self.unpack(self.buffer[start:end])
+            return self.unpacked.popleft()
+        return bytes(self.buffer[start:end])
+
+    def next_message(self):
+        """Return the next complete message as a str, or None if it hasn't fully arrived."""
+        if self.unpacked:
+            return str(self.unpacked.popleft(), "utf-8", "replace")
+        span = self.next_span()
+        if span is None:
+            return None
+        start, end, compressed = span
+        if compressed:
+            self.unpack(self.buffer[start:end])
+            return str(self.unpacked.popleft(), "utf-8", "replace")
+        with memoryview(self.buffer) as view:
+            return str(view[start:end], "utf-8", "replace")
+
+    def unpack(self, data):
+        """Decompress a compressed frame and queue the payloads of the frames inside it."""
+        decompressor = zlib.decompressobj()
+        try:
+            # Stop at the size limit so a tiny frame can't expand into gigabytes
+            data = decompressor.decompress(data, self.max_frame_size + HEADER.size)
+        except zlib.error as error:
+            raise ProtocolError(f"bad compressed frame: {error}")
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise ProtocolError("compressed frame is too large or incomplete")
+
+        position = 0
+        while position < len(data):
+            if len(data) - position < HEADER.size:
+                raise ProtocolError("truncated frame inside a compressed frame")
+            (length,) = HEADER.unpack_from(data, position)
+            position += HEADER.size
+            if length & COMPRESSED or position + length > len(data):
+                raise ProtocolError("bad frame inside a compressed frame")
+            self.unpacked.append(data[position:position + length])
+            position += length
+        if not self.unpacked:
+            raise ProtocolError("empty compressed frame")
+
+    def messages(self):
+        """Yield every complete message currently in the buffer."""
+        while True:
+            message = self.next_message()
+            if message is None:
+                return
+            yield message
+
+    def header(self):
+        """Return (length, compressed) of the frame at self.start, refusing frames over the limit."""
+        (length,) = HEADER.unpack_from(self.buffer, self.start)
+        compressed = bool(length & COMPRESSED)
+        length &= ~COMPRESSED
+        if length > self.max_frame_size:
+            raise ProtocolError(f"frame of {length} bytes is larger than {self.max_frame_size}")
+        if compressed and not self.allow_compressed:
+            raise ProtocolError("compressed frame from a client that did not accept zlib")
+        return length, compressed
+
+    def next_span(self):
+        """
+        Consume the next complete frame and return its (start, end, compressed)
+        in the buffer, or None if it hasn't fully arrived.
+        """
+        pending = self.end - self.start
+        if pending < HEADER.size:
+            return None
+        length, compressed = self.header()
+        if pending < HEADER.size + length:
+            return None
+
+        payload_start = self.start + HEADER.size
+        self.start = payload_start + length
+        # Everything consumed: rewind so the next read starts at the front again
+        if self.start == self.end:
+            self.start = self.end = 0
+        return payload_start, payload_start + length, compressed
@@ -0,0 +1,45 @@
+# Rate limits.
+#
+# Every message a client sends to a room is copied to every member, so one
+# client that floods the server costs N times its own rate in CPU and
+# bandwidth. Each connection (and each room) gets a token bucket: it holds
+# up to `burst` tokens, refills at `rate` tokens per second, and every
+# message takes one. Short bursts pass, a steady flood is cut down to `rate`.
+#
+# The bucket is refilled lazily from the time since the last message, so a
+# check is a few arithmetic operations and needs no timer.
+
+import threading
+import time
+
+
+class TokenBucket:
+    """Allows `rate` events per second on average and bursts of up to `burst`."""
+    __slots__ = ("rate", "burst", "tokens", "updated", "lock")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst  # Start full
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()  # Room buckets are shared by the client threads
+
+    def take(self, now=None):
+        """Use one token. Returns False (and takes nothing) if the bucket is empty."""
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+def make_bucket(limit):
+    """A bucket for a (rate, burst) limit, or None if the limit is off."""
+    if not limit or not limit[0]:
+        return None
+    rate, burst = limit
+    return TokenBucket(rate, max(burst, 1))
@@ -0,0 +1,136 @@
+# Registry of connected clients.
+#
+# The threaded server touches the client list from every receive thread at
+# once, so plain dicts are not safe there. The registry splits its entries
+# over several "stripes", each with its own lock, so threads working on
+# different clients rarely wait for each other. Every stripe also keeps a
+# cached tuple of its sessions, which makes iterating over everyone for a
+# broadcast cheap and safe while clients join and leave.
+
+import threading
+
+
+class Session:
+    """One connected client."""
+    __slots__ = ("sock", "address", "name", "color", "queue", "room", "binary", "compress",
+                 "known_users", "known_rooms", "heartbeat", "last_seen", "pinged", "bucket", "throttled",
+                 "token", "presence")
+
+    def __init__(self, sock, address, name=None, color="black", queue=None):
+        self.sock = sock
+        self.address = address
+        self.name = name
+        self.color = color
+        self.queue = queue  # OutboundQueue with the messages waiting for this client
+        self.room = None    # Name of the room the client is in
+        self.binary = False # True if the client asked for the binary wire format
+        self.compress = False  # True if the client accepts zlib-compressed frames
+        self.known_users = None  # Binary clients: user id -> definition last sent to the client
+        self.known_rooms = None  # Binary clients: room id -> definition last sent to the client
+        self.heartbeat = False   # True if the client answers pings
+        self.last_seen = 0.0     # time.monotonic() of the last data received from the client
+        self.pinged = 0.0        # time.monotonic() of the last ping sent to the client
+        self.bucket = None       # TokenBucket limiting the client's messages, None = no limit
+        self.throttled = False   # True while the client's messages are being refused
+        self.token = None        # Session token of a client that can resume, None if it can't
+        self.presence = False    # True if the client is sent roster changes
+
+
+class Stripe:
+    """One lock and the part of the index that it protects."""
+    __slots__ = ("lock", "entries", "snapshot")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = dict()
+        self.snapshot = ()  # Cached tuple of the values, None when it must be rebuilt
+
+
+class SessionRegistry:
+    """
+    Thread-safe index of sessions by socket and by username.
+    Lookups, inserts and removals are O(1). Usernames are unique:
+    a name belongs to one session at a time (see claim()).
+    """
+
+    def __init__(self, stripes=16):
+        self.by_socket = [Stripe() for _ in range(stripes)]
+        self.by_name = [Stripe() for _ in range(stripes)]
+
+    def socket_stripe(self, sock):
+        return self.by_socket[hash(sock) % len(self.by_socket)]
+
+    def name_stripe(self, name):
+        return self.by_name[hash(name) % len(self.by_name)]
+
+    def claim(self, session, replace=None, claimed=None):
+        """
+        Give `session` its username. Returns False if another session has it,
+        unless that is `replace` (the old connection of a client that resumed).
+        `claimed()` is called before anyone can find the session by name, so the
+        handshake reply is queued ahead of any /pm.
+        """
+        stripe = self.name_stripe(session.name)
+        with stripe.lock:
+            current = stripe.entries.get(session.name)
+            if current is not None and current is not replace:
+                return False
+            stripe.entries[session.name] = session
+            if claimed is not None:
+                claimed()
+        return True
+
+    def add(self, session):
+        """Register a session that has claimed its name and finished its handshake."""
+        stripe = self.socket_stripe(session.sock)
+        with stripe.lock:
+            stripe.entries[session.sock] = session
+            stripe.snapshot = None
+
+    def remove(self, sock):
+        """Remove and return the session for a socket, or None if it wasn't registered."""
+        stripe = self.socket_stripe(sock)
+        with stripe.lock:
+            session = stripe.entries.pop(sock, None)
+            if session is None:
+                return None
+            stripe.snapshot = None
+
+        # Only drop the username if it still points at this session
+        stripe = self.name_stripe(session.name)
+        with stripe.lock:
+            if stripe.entries.get(session.name) is session:
+                del stripe.entries[session.name]
+        return session
+
+    def get(self, sock):
+        """Return the session for a socket, or None."""
+        stripe = self.socket_stripe(sock)
+        with stripe.lock:
+            return stripe.entries.get(sock)
+
+    def find(self, name):
+        """Return the session logged in as `name`, or None."""
+        stripe = self.name_stripe(name)
+        with stripe.lock:
+            return stripe.entries.get(name)
+
+    def snapshot(self):
+        """
+        Return a list of every session at this moment.
+        Only stripes that changed since the last call are copied again.
+        """
+        sessions = []
+        for stripe in self.by_socket:
+            snapshot = stripe.snapshot
+            if snapshot is None:
+                with stripe.lock:
+                    snapshot = stripe.snapshot = tuple(stripe.entries.values())
+            sessions.extend(snapshot)
+        return sessions
+
+    def __contains__(self, sock):
+        return self.get(sock) is not None
+
+    def __len__(self):
+        return sum(len(stripe.entries) for stripe in self.by_socket)
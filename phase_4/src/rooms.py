@@ -0,0 +1,158 @@
+# Chat rooms (channels).
+#
+# Every client is in exactly one room at a time and starts in the default
+# room. Each room keeps its own member index, so publishing to a room only
+# touches the clients in that room instead of everyone on the server.
+
+import threading
+import time
+from collections import OrderedDict, deque
+
+from ratelimit import make_bucket
+
+# Room every client is put in after the handshake
+DEFAULT_ROOM = "general"
+
+# Longest room name we accept
+MAX_ROOM_NAME = 32
+
+
+def valid_room_name(name):
+    """Room names are short and have no spaces or protocol separators."""
+    return 0 < len(name) <= MAX_ROOM_NAME and not any(c.isspace() or c == "|" for c in name)
+
+
+class Room:
+    """One room and the sessions in it."""
+    __slots__ = ("name", "members", "snapshot", "bucket", "recent", "seq")
+
+    def __init__(self, name, limit=None, backlog=0, seq=0):
+        self.name = name
+        self.members = dict()  # socket -> Session
+        self.snapshot = ()     # Cached tuple of the members, None when it must be rebuilt
+        self.bucket = make_bucket(limit)  # Limits the messages sent to the room, None = no limit
+        # Last messages of the room, for clients that resume after a dropped connection
+        self.recent = deque(maxlen=backlog) if backlog else None
+        self.seq = seq  # Sequence number of the last message
+
+
+class RoomDirectory:
+    """
+    Index of rooms and their members.
+    Joining, leaving and finding a room are O(1), getting the members of a
+    room is O(room size) and usually just returns the cached tuple.
+    `limit` is the (messages per second, burst) allowed in each room.
+    `backlog` is how many recent messages each room keeps for resuming clients,
+    who can do so for `grace` seconds after they left.
+    """
+
+    def __init__(self, limit=None, backlog=0, grace=0):
+        self.lock = threading.Lock()
+        self.limit = limit
+        self.backlog = backlog
+        self.grace = grace
+        self.rooms = {DEFAULT_ROOM: Room(DEFAULT_ROOM, limit, backlog)}
+        # Last sequence number of the rooms deleted in the last `grace` seconds:
+        # name -> (seq, time it is forgotten), oldest first. A client that left one
+        # may still resume, so a room created again continues its numbering instead
+        # of starting over. After that nobody can hold its numbers any more.
+        self.retired = OrderedDict()
+
+    def join(self, session, name):
+        """
+        Move a session into a room, creating the room if needed.
+        Returns the name of the room it was in before (or None).
+        """
+        with self.lock:
+            previous = self.remove_member(session)
+            room = self.rooms.get(name)
+            if room is None:
+                seq, _ = self.retired.pop(name, (0, None))
+                room = self.rooms[name] = Room(name, self.limit, self.backlog, seq)
+            room.members[session.sock] = session
+            room.snapshot = None
+            session.room = name
+            return previous
+
+    def leave(self, session):
+        """Take a session out of its room (when it disconnects). Returns the room name."""
+        with self.lock:
+            return self.remove_member(session)
+
+    def remove_member(self, session):
+        """Remove a session from its current room, call with the lock held."""
+        name = session.room
+        room = self.rooms.get(name)
+        if room is None:
+            return None
+        room.members.pop(session.sock, None)
+        room.snapshot = None
+        session.room = None
+        # Empty rooms are deleted, except the default one
+        if not room.members and name != DEFAULT_ROOM:
+            del self.rooms[name]
+            if self.backlog:
+                now = time.monotonic()
+                self.retired[name] = (room.seq, now + self.grace)
+                # Entries all live `grace` seconds, so the expired ones are at the front
+                while self.retired:
+                    oldest, (_, expiry) = next(iter(self.retired.items()))
+                    if expiry > now:
+                        break
+                    del self.retired[oldest]
+        return name
+
+    def allow(self, name):
+        """Take one message from the room's rate limit. False means the room is too busy."""
+        room = self.rooms.get(name)
+        return room is None or room.bucket is None or room.bucket.take()
+
+    def sequence(self, name, message):
+        """Give a room message the room's next sequence number and keep it for resuming clients."""
+        with self.lock:
+            room = self.rooms.get(name)
+            if room is not None:
+                room.seq = message.seq = room.seq + 1
+                if room.recent is not None:
+                    room.recent.append(message)
+            elif name in self.retired:
+                # Nobody is in it here, but someone may resume into it
+                seq, expiry = self.retired[name]
+                message.seq = seq + 1
+                self.retired[name] = (seq + 1, expiry)
+
+    def missed(self, name, seq):
+        """
+        Return the messages of a room after sequence number `seq`, oldest first,
+        or None if some of them are no longer kept.
+        """
+        with self.lock:
+            room = self.rooms.get(name)
+            if room is not None:
+                recent = list(room.recent) if room.recent is not None else []
+                last = room.seq
+            else:
+                recent = []
+                last, _ = self.retired.get(name, (0, None))
+        if seq > last:
+            return None  # Not a sequence number of this room
+        missed = [message for message in recent if message.seq > seq]
+        if len(missed) < last - seq:
+            return None
+        return missed
+
+    def members(self, name):
+        """Return the sessions in a room (empty if the room doesn't exist)."""
+        room = self.rooms.get(name)
+        if room is None:
+            return ()
+        snapshot = room.snapshot
+        if snapshot is None:
+            with self.lock:
+                snapshot = room.snapshot = tuple(room.members.values())
+        return snapshot
+
+    def list_rooms(self):
+        """Return (name, member count) for every room, sorted by name."""
+        with self.lock:
+            return sorted((name, len(room.members)) for name, room in self.rooms.items())
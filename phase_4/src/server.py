@@ -1,177 +1,262 @@
-
 # Import the required modules
 import socket     # For network communication (creating a server and connecting clients)
-import threading  # For handling multiple clients simultaneously using threads
-from datetime import datetime
+import threading  # For serving from a background thread (ChatServer.start)
+import copy
+import os
+import secrets
+import sys
+import signal
 
-# Create a TCP/IP socket using IPv4 addressing
-# AF_INET = IPv4, SOCK_STREAM = TCP (connection-based)
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+# Command line options and the config file (see config.py)
+from config import parse_args, defaults
 
-# Bind the socket to the local IP address and a port number (12345 in this case)
-# This allows the server to receive connections on this IP and port
-server_socket.bind((socket.gethostbyname(socket.gethostname()), 12345))
+# Structured log written from a background thread (see log.py)
+import log
 
-# Set the socket to listen mode to accept incoming connection requests
-server_socket.listen()
+# Everything else is imported when a server is opened, and only what its
+# settings need (the event loop or the threaded server, SQLite history, the
+# bus, the metrics endpoint). Importing this module to embed a server, or to
+# start several in a test, stays cheap.
 
-# Create an empty dictionary to store connected clients
-# Each client is associated with their socket and a tuple containing (name, color)
-clients = dict()
 
-# Add near the clients dictionary (Page 1)
-username_to_socket = dict()  # Maps usernames to their sockets
+def create_server_socket(config, reuse_port=False):
+    """Create, bind and start the listening socket."""
+    # Create a TCP/IP socket using IPv4 addressing
+    # AF_INET = IPv4, SOCK_STREAM = TCP (connection-based)
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
-# Add this to server.py
-def get_connected_clients():
-    """Return formatted string of connected clients"""
-    return "\n".join([f"{name} (Color: {color})" for _, (name, color) in clients.items()])
+    # Let every worker process bind the same port, the kernel spreads new connections over them
+    if reuse_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
-def broadcast(message):
-    """
-    Send a message to all connected clients.
-    This is used for public messages that should be seen by everyone.
-    """
-    for client in clients.keys():
-        try:
-            # Attempt to send the message to the client
-            client.send(message)
-        except:
-            # If an error occurs (e.g., client disconnected), remove them from the list
-            clients.pop(client)
+    # Buffer sizes must be set before listen() so the TCP window can be scaled to them;
+    # accepted sockets inherit them
+    if config.sndbuf:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, config.sndbuf)
+    if config.rcvbuf:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, config.rcvbuf)
+
+    # Bind the socket to the configured address and port (every interface, port 12345 by default).
+    # An address is used rather than looking up our own host name, which hangs when DNS is broken
+    server_socket.bind((config.host, config.port))
+
+    # Set the socket to listen mode to accept incoming connection requests
+    server_socket.listen(config.backlog)
+    return server_socket
 
 
-def receive_message(client_socket):
+class ChatServer:
     """
-    Continuously receive messages from a client.
-    If the message is '/exit', disconnect the client.
+    A chat server running inside the calling process:
+
+        server = ChatServer(port=0, mode="selectors", no_history=True)
+        server.start()            # serve from a background thread
+        host, port = server.address
+        ...
+        server.shutdown()         # send what is still queued, then close everything
+
+    `config` holds the settings (config.parse_args() or config.defaults()),
+    keyword arguments override single settings. serve_forever() serves from
+    the calling thread instead of start().
+    `bus_address`, `reuse_port` and `index` are set for the workers of --workers.
+    `message_bus` is a MessageBus to use instead of connecting to a hub, for example to
+    link several servers in one process:
+
+        hub = InProcessHub()
+        a = ChatServer(port=0, message_bus=hub.connect("a")).start()
+        b = ChatServer(port=0, message_bus=hub.connect("b")).start()
+
+    The server closes it on shutdown().
     """
-    while True:
-        # Extract the client address string (for display/logging)
-        address = str(client_socket)[-26:-3]
-        try:
-            # Receive data from the client (up to 1024 bytes) and decode it
-            message = client_socket.recv(1024).decode("utf-8")
-
-            # Handle private messages (format: "/pm <username> <message>")
-            if message.startswith("/pm "):
-                parts = message.split(" ", 2)  # Split into ["/pm", "username", "message"]
-                if len(parts) == 3:
-                    target_username, pm_content = parts[1], parts[2]
-                    sender_name, _ = clients[client_socket]
-
-                    # Send PM only to the target user
-                    if target_username in username_to_socket:
-                        target_socket = username_to_socket[target_username]
-                        target_socket.send(
-                            f"[PM from {sender_name}] {pm_content}".encode("utf-8")
-                        )
-                        # Optional: Confirm delivery to sender
-                        client_socket.send(f'{sender_name}: {pm_content} ({datetime.now().strftime("%H:%M")})'.encode("utf-8"))
-                    else:
-                        client_socket.send(f"User '{target_username}' not found.".encode("utf-8"))
-                continue
-
-            # If the client types '/exit', treat it as a disconnect request
-            if message.lower() == "/exit":
-                raise Exception
-
-            # Retrieve client's name and color from the dictionary
-            client_name, client_color = clients[client_socket]
-
-            # Format the message with the client's name and color for UI rendering
-            formatted_message = f"{client_name}|{client_color}|{message}"
-
-            # Send the message to all connected clients
-            broadcast(formatted_message.encode("utf-8"))
-
-        except:
-            # Handle client disconnection
-            if client_socket in clients:
-                # Get client name and color
-                client_name, client_color = clients[client_socket]
-
-                # Remove the client from the clients dictionary
-                clients.pop(client_socket)
-
-                # Close the client connection
-                client_socket.close()
-
-                # Notify all other clients that this client has left the chat
-                broadcast(f"{client_name}|{client_color}|has left the server".encode("utf-8"))
-
-                # Log the disconnection on the server side
-                print(f"{client_name} ({address}) has left the server.")
-                print("*" * 30)
-                print(get_connected_clients())
-                print("*" * 30)
-            break
-
-
-def connect_client():
+
+    def __init__(self, config=None, bus_address=None, reuse_port=False, index=0, message_bus=None, **settings):
+        config = defaults() if config is None else copy.copy(config)
+        for name, value in settings.items():
+            if not hasattr(config, name):
+                raise TypeError(f"unknown setting '{name}'")
+            setattr(config, name, value)
+        self.config = config
+        self.bus_address = bus_address
+        self.reuse_port = reuse_port
+        self.index = index
+        self.address = None         # (host, port) the server listens on, once opened
+        self.server = None          # ThreadedServer or EventLoopServer
+        self.thread = None          # Thread running it after start()
+        self.bus = message_bus
+        self.history = None
+        self.metrics_server = None
+        self.closed = False         # True once shutdown() has run
+
+    @property
+    def chat(self):
+        """The ChatService with the connected users and rooms (once opened)."""
+        return self.server.chat
+
+    def open(self):
+        """Bind the listening socket and set everything up, without serving yet."""
+        if self.server is not None:
+            return
+        config = self.config
+        server_socket = create_server_socket(config, self.reuse_port)
+        self.address = server_socket.getsockname()[:2]
+        log.info("listening", address=self.address, mode=config.mode, worker=self.index)
+
+        # Counters and histograms served in the Prometheus format, worker N uses PORT+N
+        if config.metrics_port is not None:
+            import metrics
+            self.metrics_server = metrics.start_http_server(config.metrics_port + self.index)
+
+        # Links the workers (or the servers of a cluster) so rooms and /pm work across them
+        bus_address = self.bus_address
+        if bus_address is None and config.bus:
+            from bus import parse_address
+            bus_address = parse_address(config.bus)
+        if bus_address is not None and self.bus is None:
+            from bus import HubBus
+            # Unique even for several servers in one process, the hub routes by node id
+            self.bus = HubBus(bus_address, f"{socket.gethostname()}-{os.getpid()}-{secrets.token_hex(4)}",
+                              config.bus_secret)
+
+        # Saves messages so users who join late see what they missed.
+        # Opened in every worker after the fork, WAL mode lets them share the file
+        if not config.no_history:
+            from history import HistoryStore
+            self.history = HistoryStore(config.history, config.replay, config.replay_age)
+
+        # threaded  = one thread per client (original behaviour)
+        # selectors = every client served from a single event loop thread
+        if config.mode == "selectors":
+            from event_server import EventLoopServer as Server
+        else:
+            from threaded_server import ThreadedServer as Server
+        self.server = Server(server_socket, config, self.bus, self.history)
+
+    def start(self):
+        """Start serving from a background thread and return the server."""
+        self.open()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def serve_forever(self):
+        """Serve from the calling thread until shutdown() is called from another one."""
+        self.open()
+        self.server.serve_forever()
+
+    def shutdown(self, timeout=5.0):
+        """
+        Stop accepting clients, send every client what is still queued for it
+        (waiting at most `timeout` seconds) and close the connections, the bus,
+        the history and the metrics endpoint. Calling it again does nothing.
+        """
+        if self.server is None or self.closed:
+            return
+        self.closed = True
+        log.info("shutting_down", address=self.address)
+        self.server.shutdown(timeout)
+        if self.thread is not None:
+            self.thread.join(timeout)
+        if self.bus is not None:
+            self.bus.close()
+        if self.history is not None:
+            self.history.close()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+        log.LOG.flush()
+
+
+def run_server(server):
+    """Serve until Ctrl+C or SIGTERM, then shut down gracefully."""
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    server.start()
+    try:
+        # Wake up now and then so Ctrl+C is noticed, and stop if the server thread died
+        while server.thread.is_alive() and not stop.wait(0.5):
+            pass
+    except KeyboardInterrupt:
+        pass
+    server.shutdown()
+
+
+def run_worker(config, bus_address, index):
+    """Serve clients in one of the worker processes of --workers."""
+    # Every worker rotates its own log file, they can't safely share one
+    if config.log_file:
+        root, extension = os.path.splitext(config.log_file)
+        log.configure(config, f"{root}-{index}{extension}")
+    run_server(ChatServer(config, bus_address, reuse_port=True, index=index))
+
+
+def stop_workers(signum, frame):
+    """SIGTERM handler of the parent process."""
+    # Ignore repeated signals while the workers are being cleaned up
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    sys.exit(0)
+
+
+def run_workers(config, bus_address=None):
     """
-    Wait for new client connections.
-    For each connection:
-    - Receive client's name and color
-    - Add them to the clients dictionary
-    - Notify others
-    - Start a new thread to receive messages from that client
+    Start `config.workers` worker processes on the same port.
+    They join the cluster bus if one is given, otherwise this process relays events between them.
     """
-    while True:
-        # Accept an incoming connection, returns a socket object and address
-        client_socket, client_address = server_socket.accept()
-
-        # Log the new connection
-        print(f"{client_address} has connected.")
-        print("*" * 30)
-
-        try:
-            # Receive client's name and color preference, separated by '|'
-            client_info = client_socket.recv(1024).decode('utf-8').split('|')
-            client_name = client_info[0]
-            client_color = client_info[1] if len(client_info) > 1 else "black"
-
-            # Add to username-to-socket mapping
-            username_to_socket[client_name] = client_socket
-
-            # Define allowed colors
-            valid_colors = ("black", "red", "green", "blue")
-
-            # If color is not valid, assign default (black)
-            if client_color not in valid_colors:
-                client_color = "black"
-
-            # Store client data in the dictionary
-            clients.update({client_socket: (client_name, client_color)})
-
-            # Log client details on the server side
-            print(f"client: {client_name} {str(client_socket)[-27:-1]} with color {client_color}")
-            print("*" * 30)
-
-            # Send a welcome message to the client
-            client_socket.send(f"welcome {client_name}\n".encode('utf-8'))
-
-            # Broadcast to everyone that a new client has joined
-            broadcast(f"{client_name}|{client_color}|has joined the server".encode("utf-8"))
-
-        except:
-            # If any error occurs during client info reception, disconnect them
-            print(f"({str(client_socket)[-25:-2]}) has left the server.")
-            print("*" * 30)
-            print(get_connected_clients())
-            print("*" * 30)
-            continue
-
-        # Start a separate thread to handle incoming messages from this client
-        receive_thread = threading.Thread(target=receive_message, args=(client_socket,))
-        receive_thread.start()
-
-
-# Log that the server is ready and waiting for connections
-print()
-print("*" * 30)
-print("server is looking for connection...")
-print("*" * 30)
-
-# Start listening for client connections
-connect_client()
+    import multiprocessing  # For running several worker processes (--workers)
+    from bus import BusHub, default_bus_address, listen_bus
+
+    hub_socket = None
+    if bus_address is None:
+        hub_socket, bus_address = listen_bus(default_bus_address())
+        # Only our own workers get to use the hub
+        config = copy.copy(config)
+        config.bus_secret = secrets.token_hex(16)
+    if config.tls_cert:
+        # Made before the fork so all workers share its session ticket keys: a client
+        # that reconnects to another worker still resumes its TLS session
+        from tls import server_context
+        server_context(config.tls_cert, config.tls_key)
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=run_worker, args=(config, bus_address, index), daemon=True)
+               for index in range(config.workers)]
+    for worker in workers:
+        worker.start()
+
+    log.info("workers_started", workers=config.workers)
+
+    # Turn SIGTERM into SystemExit so the workers and the bus socket file are cleaned up
+    signal.signal(signal.SIGTERM, stop_workers)
+    try:
+        if hub_socket is not None:
+            BusHub(hub_socket, config.bus_secret).serve_forever()
+        else:
+            for worker in workers:
+                worker.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # SIGTERM lets every worker drain its clients' queues before it exits
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join(10)
+        if hub_socket is not None and isinstance(bus_address, str):
+            os.unlink(bus_address)
+
+
+def main(argv=None):
+    # Settings from the command line and the --config file (see config.py)
+    args = parse_args(argv)
+    log.configure(args)
+
+    bus_address = None
+    if args.bus:
+        from bus import parse_address
+        bus_address = parse_address(args.bus)
+    if args.workers > 1:
+        run_workers(args, bus_address)
+    else:
+        run_server(ChatServer(args, bus_address))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+# Import the required modules
+import socket     # For network communication
+import threading  # For handling multiple clients simultaneously using threads
+import time
+
+# Length-prefixed framing so every recv gives back exactly one whole message
+from protocol import FrameDecoder, recv_message, MSG_NOTICE, MAX_FRAME_SIZE, MAX_HANDSHAKE_SIZE
+
+# Bounded per-client queues so one slow reader can't stall everyone else
+from outbound import OutboundQueue, send_all_buffers
+
+# Handshake, /pm, rooms and /exit (shared with the event loop server)
+from chat import ChatService, ChatMessage
+from registry import Session
+
+# Pings quiet clients and reaps dead connections
+from heartbeat import HeartbeatMonitor, enable_keepalive
+
+# Handshake timeout and the limits on new connections
+from admission import Admission
+
+from config import defaults, tune_client_socket
+from tls import server_context, accept_tls, SharedTLSSocket
+import log
+import metrics
+
+
+def drop_client(client_socket):
+    """
+    Shut a client's socket down.
+    Its receive thread then sees the connection close and does the usual cleanup.
+    """
+    try:
+        client_socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass  # Already closed
+
+
+def send_queued(client_socket, queue):
+    """
+    Writer thread: send everything that is queued for one client.
+    Only this thread writes to the socket, so a stalled client blocks nobody else.
+    """
+    while True:
+        # Wait for messages, None means the client is gone
+        batch = queue.get_batch()
+        if batch is None:
+            break
+        try:
+            # One vectored write for the whole batch
+            started = time.perf_counter()
+            send_all_buffers(client_socket, batch)
+            metrics.SEND_SECONDS.observe(time.perf_counter() - started)
+            metrics.MESSAGES_OUT.inc(len(batch))
+            metrics.BYTES_OUT.inc(sum(len(buffer) for buffer in batch))
+        except OSError:
+            queue.close()
+            drop_client(client_socket)
+            break
+
+
+class ThreadedServer:
+    """
+    Serve every client with two threads of its own: one reads its messages,
+    one writes its outbound queue. `config` holds the server settings
+    (see config.py), the defaults if None.
+    """
+
+    def __init__(self, server_socket, config=None, bus=None, history=None):
+        if config is None:
+            config = defaults()
+        self.server_socket = server_socket
+        self.config = config
+        self.bus = bus
+        # Encrypts every connection when the server has a certificate
+        self.tls = server_context(config.tls_cert, config.tls_key) if config.tls_cert else None
+        # Who is connected, which room they are in and who gets each message.
+        # Messages are only queued here, the writer threads do the actual sending.
+        self.chat = ChatService(self.queue_message, bus, history, config.compress_threshold,
+                                config.ping_interval or None,
+                                (config.user_rate, config.user_burst), (config.room_rate, config.room_burst),
+                                config.resume_grace or None, config.resume_backlog,
+                                kick=lambda session: drop_client(session.sock),
+                                presence_interval=config.presence_interval,
+                                mailbox_size=config.mailbox_size, mailbox_limit=config.mailboxes)
+        # One thread walks the timer wheel for every client (see heartbeat.py)
+        self.heartbeats = None
+        if config.ping_interval:
+            self.heartbeats = HeartbeatMonitor(self.chat.ping, lambda session: drop_client(session.sock),
+                                               config.ping_interval, config.idle_timeout)
+        # Handshake timeout and the limits on new connections (see admission.py)
+        self.admission = Admission(config.handshake_timeout, config.max_handshakes, config.max_clients)
+        # Its gauges are labelled with its address, other servers in this process report their own
+        host, port = server_socket.getsockname()[:2]
+        metrics.watch(self, f"{host}:{port}", self.chat, self.admission)
+        self.writers = dict()  # Client socket -> its writer thread
+        self.stopping = False
+        self.stopped = threading.Event()  # Set by shutdown(), stops the presence thread
+
+    def queue_message(self, session, message, sender=None):
+        """
+        Put a framed message on one client's outbound queue.
+        The client is disconnected if it can't keep up (depending on --slow-client-policy).
+        """
+        if not session.queue.put(message):
+            drop_client(session.sock)
+
+    def receive_message(self, session, decoder):
+        """
+        Continuously receive messages from a client.
+        If the message is '/exit', disconnect the client.
+        The decoder is the one used for the handshake, so no bytes are lost in between.
+        """
+        client_socket = session.sock
+        while True:
+            try:
+                # Receive the next whole message from the client (text or binary)
+                payload = decoder.next_frame()
+                while payload is None:
+                    received = decoder.recv_from(client_socket)
+
+                    # 0 bytes means the client closed the connection
+                    if not received:
+                        raise ConnectionError
+                    metrics.BYTES_IN.inc(received)
+                    session.last_seen = time.monotonic()
+                    payload = decoder.next_frame()
+
+                # Handle /pm, /join, /leave, /rooms and public messages.
+                # False means the client typed '/exit', treat it as a disconnect request
+                if not self.chat.handle_frame(session, payload):
+                    raise ConnectionError
+
+            except:
+                # Handle client disconnection
+                # Only the thread that removes the session from the registry cleans up
+                if self.chat.leave(session):
+                    if self.heartbeats is not None:
+                        self.heartbeats.forget(session)
+                    # Stop the client's writer thread and close the connection
+                    session.queue.close()
+                    self.writers.pop(client_socket, None)
+                    client_socket.close()
+                break
+
+    def serve_forever(self):
+        """
+        Wait for new client connections until shutdown() is called.
+        Each connection is handed to a thread of its own at once (see serve_client),
+        so a client that is slow with its handshake never holds up the others.
+        """
+        if self.bus is not None:
+            self.chat.attach_bus(self.bus)
+            threading.Thread(target=self.bus.run, daemon=True).start()
+        if self.heartbeats is not None:
+            self.heartbeats.start()
+        # One thread sends the roster changes of each interval in one update
+        threading.Thread(target=self.send_presence, daemon=True).start()
+
+        while True:
+            # Accept an incoming connection, returns a socket object and address
+            try:
+                client_socket, client_address = self.server_socket.accept()
+            except OSError:
+                if self.stopping:
+                    return
+                raise
+            if self.stopping:
+                # Woken up by shutdown()
+                client_socket.close()
+                return
+
+            # Log the new connection
+            log.info("connect", address=client_address)
+            metrics.CONNECTIONS.inc()
+
+            # Turn it away at once if the server is full, a thread per waiting client would be worse
+            if not self.admission.admit(len(self.chat.registry)):
+                log.info("rejected", address=client_address)
+                metrics.REJECTED.inc()
+                self.admission.reject(client_socket, reply=self.tls is None)
+                continue
+
+            tune_client_socket(client_socket, self.config)
+            enable_keepalive(client_socket)
+
+            # Start a separate thread for the handshake and the messages of this client
+            deadline = self.admission.start(client_socket)
+            threading.Thread(target=self.serve_client, args=(client_socket, client_address, deadline),
+                             daemon=True).start()
+
+    def serve_client(self, client_socket, client_address, deadline=None):
+        """
+        Client thread:
+        - Do the TLS handshake (with --tls-cert)
+        - Receive client's name and color
+        - Add them to the client registry
+        - Notify others
+        - Receive messages from that client until it leaves
+        The handshake must be done by `deadline` (time.monotonic(), None = no limit).
+        """
+        # Each client gets its own decoder that keeps any bytes after the handshake.
+        # Until the client has joined it only accepts a short greeting
+        decoder = FrameDecoder(max_frame_size=MAX_HANDSHAKE_SIZE, recv_size=self.config.recv_size,
+                               allow_compressed=False)
+        pending = client_socket  # Key of the handshake in self.admission, TLS replaces the socket
+
+        try:
+            if self.tls is not None:
+                client_socket = accept_tls(self.tls, client_socket, deadline)
+                metrics.TLS_HANDSHAKES.inc()
+                if client_socket.session_reused:
+                    metrics.TLS_RESUMED.inc()
+
+            # Receive client's name and color preference, separated by '|'
+            client_info = recv_message(client_socket, decoder, deadline)
+            if client_info is None:
+                raise ConnectionError
+            client_socket.settimeout(None)
+            if self.tls is not None:
+                # From here on this thread reads and the writer thread writes: take turns with the TLS state
+                client_socket = SharedTLSSocket(client_socket)
+
+            # Give the client an outbound queue and a writer thread to drain it
+            queue = OutboundQueue(self.config.queue_limit, self.config.slow_client_policy)
+            session = Session(client_socket, client_address, queue=queue)
+            writer = threading.Thread(target=send_queued, args=(client_socket, queue), daemon=True)
+            self.writers[client_socket] = writer
+            writer.start()
+
+            # Register the client, welcome it and tell the others
+            if not self.chat.join(session, client_info):
+                # The username was refused: let the writer send the reason, then hang up
+                queue.close()
+                writer.join(1)
+                self.writers.pop(client_socket, None)
+                client_socket.close()
+                return
+            decoder.max_frame_size = MAX_FRAME_SIZE
+            decoder.allow_compressed = session.compress
+            if self.heartbeats is not None:
+                self.heartbeats.watch(session)
+
+        except Exception as error:
+            # If any error occurs during the handshake, or it takes too long, disconnect them
+            if isinstance(error, TimeoutError):
+                metrics.HANDSHAKE_TIMEOUTS.inc()
+            log.info("handshake_failed", address=client_address)
+            client_socket.close()
+            return
+        finally:
+            self.admission.done(pending)
+
+        # Handle incoming messages from this client on this thread
+        self.receive_message(session, decoder)
+
+    def send_presence(self):
+        """Presence thread: send the roster changes once per interval until shutdown."""
+        while not self.stopped.wait(max(self.chat.presence.interval, 0.01)):
+            if self.chat.presence.due():
+                self.chat.flush_presence()
+
+    def shutdown(self, timeout=5.0):
+        """
+        Stop accepting clients, send every client what is still queued for it
+        (waiting at most `timeout` seconds) and close all connections.
+        Call it from another thread than the one running serve_forever().
+        """
+        self.stopping = True
+        self.stopped.set()
+        # Wake the accept() call up with a connection of our own
+        host, port = self.server_socket.getsockname()[:2]
+        try:
+            socket.create_connection(("127.0.0.1" if host == "0.0.0.0" else host, port), timeout=1).close()
+        except OSError:
+            pass
+        if self.heartbeats is not None:
+            self.heartbeats.stop()
+
+        # Tell everyone, then let the writer threads empty the queues and finish
+        sessions = self.chat.registry.snapshot()
+        self.chat.broadcast(ChatMessage(MSG_NOTICE, "The server is shutting down."))
+        for session in sessions:
+            session.queue.close()
+        deadline = time.monotonic() + timeout
+        for writer in list(self.writers.values()):
+            writer.join(max(deadline - time.monotonic(), 0))
+
+        # The receive threads see their sockets close and clean up
+        for session in sessions:
+            drop_client(session.sock)
+        self.server_socket.close()
+        metrics.forget(self)
@@ -0,0 +1,209 @@
+# Optional TLS for the chat connection.
+#
+# The server encrypts every connection when it is given a certificate:
+#   python server.py --tls-cert server.pem --tls-key server.key
+# and clients connect with --tls (trusting the system's CAs) or with
+# --tls-ca server.pem to trust a self-signed certificate. One for local tests
+# is made with:
+#   python tls.py --make-cert server.pem server.key --host 127.0.0.1
+#
+# A full TLS handshake costs the server an asymmetric key exchange and a
+# signature, which adds up when thousands of clients reconnect at once. After
+# a full handshake the server hands the client a session ticket (TLS 1.3) and
+# the client offers it on its next connection, which then resumes without the
+# certificate and signature. The ticket is encrypted with keys of the server's
+# SSLContext, so the context is made once per process and, with --workers,
+# before the fork: any worker can resume a session that another one started.
+#
+# The threaded server reads a client's socket in one thread and writes it in
+# another. An SSLSocket can't be used by two threads at once (both move the
+# same OpenSSL state), so there the socket is wrapped in a SharedTLSSocket that
+# runs every read and write under one lock and waits for the socket outside it.
+
+import argparse
+import errno
+import ipaddress
+import os
+import select
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Session tickets sent after a full handshake, the client keeps the latest one
+TICKETS = 1
+
+# Largest decrypted TLS record. Reading at least this much at once gets a whole
+# record out of OpenSSL, so no decrypted bytes stay behind where select() can't see them
+RECORD_SIZE = 16384
+
+# Server contexts by (certificate, key), made once so every connection (and worker) shares its ticket keys
+server_contexts = dict()
+
+
+def server_context(cert, key=None):
+    """The server's TLS context for a certificate and its private key (None = in the certificate file)."""
+    context = server_contexts.get((cert, key))
+    if context is None:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+        context.load_cert_chain(cert, key)
+        context.num_tickets = TICKETS
+        server_contexts[(cert, key)] = context
+    return context
+
+
+class ClientContext(ssl.SSLContext):
+    """
+    Client TLS context that offers the session of an earlier connection,
+    so reconnecting (after a drop, or a crowd of bots) skips the full handshake.
+    asyncio doesn't pass sessions on, so they are added where it creates the TLS object.
+    """
+
+    session = None  # Last session the server gave us, offered on the next connection
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.session
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+    def remember(self, ssl_object):
+        """Keep the session of an established connection for the next one."""
+        if ssl_object is not None and ssl_object.session is not None:
+            self.session = ssl_object.session
+
+
+def client_context(cafile=None):
+    """TLS context for clients, trusting `cafile` (a self-signed certificate) or else the system's CAs."""
+    context = ClientContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    if cafile:
+        context.load_verify_locations(cafile)
+    else:
+        context.load_default_certs()
+    return context
+
+
+def accept_tls(context, sock, deadline=None):
+    """
+    Do the server side of the TLS handshake on an accepted socket and return the SSLSocket.
+    With a `deadline` (time.monotonic()) raises TimeoutError if the handshake isn't
+    done by then, however the client spreads its bytes out.
+    """
+    if deadline is None:
+        return context.wrap_socket(sock, server_side=True)
+    sock.setblocking(False)
+    tls_socket = context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+    while True:
+        try:
+            tls_socket.do_handshake()
+            break
+        except ssl.SSLWantReadError:
+            readers, writers = (tls_socket,), ()
+        except ssl.SSLWantWriteError:
+            readers, writers = (), (tls_socket,)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not any(select.select(readers, writers, (), remaining)):
+            raise TimeoutError("TLS handshake not done before the deadline")
+    tls_socket.setblocking(True)
+    return tls_socket
+
+
+class SharedTLSSocket:
+    """
+    An SSLSocket shared by a reader and a writer thread.
+    Every recv and send runs under one lock on the non-blocking socket, and a call
+    that would block waits in select() without the lock, so a reader waiting for
+    the client doesn't hold the writer up (nor the other way round).
+    Everything else is passed on to the SSLSocket.
+    """
+
+    def __init__(self, tls_socket):
+        tls_socket.setblocking(False)
+        self.tls_socket = tls_socket
+        self.lock = threading.Lock()
+
+    def recv_into(self, buffer, nbytes=0):
+        while True:
+            with self.lock:
+                try:
+                    return self.tls_socket.recv_into(buffer, nbytes)
+                except ssl.SSLWantReadError:
+                    readers, writers = (self.tls_socket,), ()
+                except ssl.SSLWantWriteError:
+                    readers, writers = (), (self.tls_socket,)
+            self.wait(readers, writers)
+
+    def send(self, data):
+        while True:
+            with self.lock:
+                try:
+                    return self.tls_socket.send(data)
+                except ssl.SSLWantWriteError:
+                    readers, writers = (), (self.tls_socket,)
+                except ssl.SSLWantReadError:
+                    readers, writers = (self.tls_socket,), ()
+            self.wait(readers, writers)
+
+    def wait(self, readers, writers):
+        """Block until the socket is ready, as a blocking socket would."""
+        try:
+            select.select(readers, writers, ())
+        except ValueError:
+            # Closed by the other thread in the meantime
+            raise OSError(errno.EBADF, "socket closed")
+
+    def shutdown(self, how):
+        with self.lock:
+            self.tls_socket.shutdown(how)
+
+    def close(self):
+        with self.lock:
+            self.tls_socket.close()
+
+    def __getattr__(self, name):
+        return getattr(self.tls_socket, name)
+
+
+def make_self_signed(cert, key, hosts=("localhost", "127.0.0.1"), days=365):
+    """Create a self-signed certificate and its key for `hosts` (names or addresses) with the openssl tool."""
+    names = [f"IP:{host}" if is_address(host) else f"DNS:{host}" for host in hosts]
+    with tempfile.NamedTemporaryFile("w", suffix=".cnf", delete=False) as config:
+        # The subjectAltName is what clients check the host against
+        config.write("[req]\ndistinguished_name = name\nx509_extensions = extensions\nprompt = no\n"
+                     f"[name]\nCN = {hosts[0]}\n"
+                     f"[extensions]\nsubjectAltName = {','.join(names)}\n")
+    try:
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1",
+                        "-nodes", "-days", str(days), "-keyout", key, "-out", cert, "-config", config.name],
+                       check=True, capture_output=True)
+    finally:
+        os.unlink(config.name)
+
+
+def is_address(host):
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Make a self-signed certificate for the chat server")
+    parser.add_argument("--make-cert", nargs=2, metavar=("CERT", "KEY"), required=True,
+                        help="files to write the certificate and its private key to")
+    parser.add_argument("--host", action="append", metavar="NAME_OR_ADDRESS",
+                        help="name or address clients connect to (repeat for several, default: localhost, 127.0.0.1)")
+    parser.add_argument("--days", type=int, default=365, help="how long the certificate is valid")
+    args = parser.parse_args(argv)
+    try:
+        make_self_signed(*args.make_cert, args.host or ("localhost", "127.0.0.1"), args.days)
+    except (OSError, subprocess.CalledProcessError) as error:
+        sys.exit(f"Failed to make the certificate (is openssl installed?): {error}")
+
+
+if __name__ == "__main__":
+    main()
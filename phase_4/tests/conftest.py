@@ -0,0 +1,58 @@
+# Shared helpers for the phase_4 tests.
+#
+# The server modules import each other by their plain names (they are run
+# from src/), so the tests put src/ on the import path the same way.
+
+import os
+import socket
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from protocol import FrameDecoder, send_message, recv_message  # noqa: E402
+
+
+class TextClient:
+    """A text-format chat client talking to a test server."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.decoder = FrameDecoder()
+
+    def send(self, text):
+        send_message(self.sock, text)
+
+    def wait_for(self, text, timeout=5):
+        """Read messages until one contains `text` and return it."""
+        deadline = time.monotonic() + timeout
+        while True:
+            message = recv_message(self.sock, self.decoder, deadline)
+            assert message is not None, f"connection closed while waiting for {text!r}"
+            if text in message:
+                return message
+
+
+@pytest.fixture
+def connect():
+    """
+    connect(address, greeting, tls=None) joins a server and returns a TextClient
+    once the welcome has arrived. The sockets are closed after the test.
+    """
+    sockets = []
+
+    def connect(address, greeting, tls=None):
+        sock = socket.create_connection(address, timeout=5)
+        if tls is not None:
+            sock = tls.wrap_socket(sock, server_hostname=address[0])
+        sockets.append(sock)
+        client = TextClient(sock)
+        client.send(greeting)
+        client.wait_for("welcome")
+        return client
+
+    yield connect
+    for sock in sockets:
+        sock.close()
@@ -0,0 +1,26 @@
+# Two servers in one process linked by an InProcessHub.
+
+import pytest
+
+from bus import InProcessHub
+from server import ChatServer
+
+
+@pytest.mark.parametrize("mode", ["threaded", "selectors"])
+def test_in_process_bus_round_trip(connect, mode):
+    hub = InProcessHub()
+    a = ChatServer(port=0, host="127.0.0.1", mode=mode, no_history=True, message_bus=hub.connect("a")).start()
+    b = ChatServer(port=0, host="127.0.0.1", mode=mode, no_history=True, message_bus=hub.connect("b")).start()
+    try:
+        alice = connect(a.address, "alice|red")
+        bob = connect(b.address, "bob|blue")
+        # Each hears about the other through the hub
+        alice.wait_for("bob")
+
+        bob.send("hello from b")
+        assert "bob" in alice.wait_for("hello from b")
+        alice.send("/pm bob hello from a")
+        assert "alice" in bob.wait_for("hello from a")
+    finally:
+        a.shutdown(1)
+        b.shutdown(1)
@@ -0,0 +1,34 @@
+# Embedding servers with ChatServer.
+
+import metrics
+from server import ChatServer
+
+
+def gauge(name, server):
+    """Current value of a gauge for one server, or None if it isn't reported."""
+    label = "%s:%s" % server.address
+    for metric in metrics.REGISTRY.metrics:
+        if metric.name == name:
+            for sample, value in metric.samples():
+                if sample == f'{name}{{server="{label}"}}':
+                    return value
+    return None
+
+
+def test_two_servers_keep_separate_gauges(connect):
+    a = ChatServer(port=0, host="127.0.0.1", mode="selectors", no_history=True).start()
+    b = ChatServer(port=0, host="127.0.0.1", mode="threaded", no_history=True).start()
+    try:
+        connect(a.address, "alice|red")
+        connect(a.address, "bob|blue")
+        connect(b.address, "carol|green")
+        assert gauge("chat_connected_users", a) == 2
+        assert gauge("chat_connected_users", b) == 1
+
+        # A server that shut down stops being reported, the other one is untouched
+        a.shutdown(1)
+        assert gauge("chat_connected_users", a) is None
+        assert gauge("chat_connected_users", b) == 1
+    finally:
+        a.shutdown(1)
+        b.shutdown(1)
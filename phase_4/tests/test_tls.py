@@ -0,0 +1,21 @@
+# A TLS handshake with a self-signed certificate, then one message.
+
+import pytest
+
+from server import ChatServer
+from tls import make_self_signed, client_context
+
+
+@pytest.mark.parametrize("mode", ["threaded", "selectors"])
+def test_tls_handshake_and_message(tmp_path, connect, mode):
+    cert, key = str(tmp_path / "cert.pem"), str(tmp_path / "key.pem")
+    make_self_signed(cert, key)
+    server = ChatServer(port=0, host="127.0.0.1", mode=mode, no_history=True, tls_cert=cert, tls_key=key).start()
+    try:
+        tls = client_context(cert)
+        alice = connect(server.address, "alice|red", tls)
+        bob = connect(server.address, "bob|blue", tls)
+        bob.send("hello over tls")
+        assert "bob" in alice.wait_for("hello over tls")
+    finally:
+        server.shutdown(1)